@@ -0,0 +1,92 @@
+import numpy as np
+from . import util
+
+
+def median_partition(vec):
+    """
+    Median of a 1D array using a selection (np.partition) instead of a full sort.
+    Gives exactly the same result as np.median.
+    """
+    n = len(vec)
+    kth = [n//2 - 1, n//2] if n % 2 == 0 else [n//2]
+    return np.mean(np.partition(vec, kth)[kth])
+
+
+def median_abs_dev_partition(vec, med=None):
+    """
+    Median absolute deviation using np.partition. Gives the same result as util.median_abs_dev but without masked arrays.
+    """
+    if med is None:
+        med = median_partition(vec)
+    return median_partition(abs(vec - med))
+
+
+def histogram_mode(vec, nbins=100):
+    """
+    Estimates the mode of the distribution of the values in vec.
+    A histogram is created around the median and a Gaussian (a parabola in log space) is fitted to the bins above half of the maximum.
+    """
+    n = len(vec)
+    k16, k50, k84 = int(0.16*(n-1)), int(0.5*(n-1)), int(0.84*(n-1))
+    q16, q50, q84 = np.partition(vec, [k16, k50, k84])[[k16, k50, k84]].astype(float)
+    halfwidth = 1.5*(q84 - q16)
+    if halfwidth == 0:
+        return q50
+    lo = q50 - halfwidth
+    binwidth = 2*halfwidth/nbins
+    inds = np.floor((vec - lo)/binwidth).astype(int)
+    hist = np.bincount(inds[(inds >= 0) & (inds < nbins)], minlength=nbins).astype(float)
+    x = lo + (np.arange(nbins) + 0.5)*binwidth
+    # fits the peak of the histogram
+    sel = hist > 0.5*hist.max()
+    if sum(sel) >= 3:
+        a, b, c = np.polyfit(x[sel], np.log(hist[sel]), 2)
+        if a < 0:
+            return -b/(2*a)
+    return x[np.argmax(hist)]
+
+
+def get_background(frame, meta, mask=None):
+    """
+    Estimates the sky background in a (fullframe) difference image and the uncertainty of this estimate.
+
+    The pixels with a flux below meta.background_thld are considered to be background.
+    The method is chosen with meta.background_method:
+
+    - **median:** median and median absolute deviation using np.median and util.median_abs_dev (the original implementation)
+    - **partition:** the same estimates as "median" (identical results), but using np.partition without masked arrays
+    - **mode:** the background is the mode of a histogram of the background pixels. The uncertainty is the median absolute deviation.
+
+    Parameters
+    -----------
+    frame: numpy array
+        difference image
+    meta
+        metadata object
+    mask: numpy array
+        (optional) boolean array selecting the background pixels. If None, it is calculated using meta.background_thld.
+
+    Returns
+    ----------
+    skymedian: float
+        background counts
+    skyvar: float
+        variance for the background count estimate
+    """
+    if mask is None:
+        mask = frame < meta.background_thld # mask with all pixels below the user defined threshold
+    vec = frame[mask]
+
+    if meta.background_method == 'median':
+        skymedian = np.median(vec)
+        skyvar = util.median_abs_dev(vec)
+    elif meta.background_method == 'partition':
+        skymedian = median_partition(vec)
+        skyvar = median_abs_dev_partition(vec, skymedian)
+    elif meta.background_method == 'mode':
+        skymedian = vec.dtype.type(histogram_mode(vec))
+        skyvar = median_abs_dev_partition(vec)
+    else:
+        raise ValueError('Unknown background_method: {0}. Use median, partition or mode.'.format(meta.background_method))
+
+    return skymedian, skyvar
@@ -0,0 +1,213 @@
+import numpy as np
+from scipy import sparse
+
+
+def interp_matrix(x, xp):
+    """
+    Sparse matrix for linear interpolation.
+    Multiplying it with an array fp gives the same result as np.interp(x, xp, fp) (up to rounding).
+
+    Parameters
+    -----------
+    x: numpy array
+        coordinates at which the values are interpolated
+    xp: numpy array
+        increasing coordinates of the data points
+
+    Returns
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        (len(x), len(xp)) matrix with two non-zero weights per row
+    """
+    n = len(xp)
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, n - 2)
+    # like np.interp, the values outside of xp are the first or the last value in fp
+    t = np.clip((x - xp[j]) / (xp[j+1] - xp[j]), 0, 1)
+    rows = np.repeat(np.arange(len(x)), 2)
+    cols = np.stack([j, j + 1], axis=1).ravel()
+    vals = np.stack([1 - t, t], axis=1).ravel()
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(len(x), n))
+
+
+def bin_matrix(x, wave_edges):
+    """
+    Sparse matrix which assigns the points x to the wavelength bins.
+    A point belongs to a bin if wave_edges[i] <= x <= wave_edges[i+1].
+
+    Parameters
+    -----------
+    x: numpy array
+        wavelengths of the points
+    wave_edges: numpy array
+        edges of the wavelength bins
+
+    Returns
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        (nbins, len(x)) matrix with ones for the points in each bin
+    """
+    inbin = (x[None, :] >= wave_edges[:-1, None]) & (x[None, :] <= wave_edges[1:, None])
+    return sparse.csr_matrix(inbin.astype(float))
+
+
+def bin_interp(w_hires, w, spec_opt, var_opt, wave_edges):
+    """
+    Bins the spectra of all exposures into wavelength bins by interpolating them onto the high resolution grid w_hires.
+
+    The flux in a bin is the weighted mean of the interpolated flux of the points in w_hires falling into the bin.
+    The variance is multiplied by the oversampling factor (len(w_hires)/npix) to account for the decrease in precision when the spectrum is oversampled.
+
+    All exposures and bins are done at once:
+    the interpolation matrices of the exposures are stacked into one block diagonal sparse matrix which is applied to the whole (nexp, npix) flux and variance arrays.
+
+    Parameters
+    -----------
+    w_hires: numpy array
+        high resolution wavelength grid
+    w: numpy array
+        (nexp, npix) wavelength solution of every exposure
+    spec_opt: numpy array
+        (nexp, npix) spectra
+    var_opt: numpy array
+        (nexp, npix) variances of the spectra
+    wave_edges: numpy array
+        edges of the wavelength bins
+
+    Returns
+    ----------
+    meanflux: numpy array
+        (nexp, nbins) binned flux
+    meanvar: numpy array
+        (nexp, nbins) variance of the binned flux
+    f_interp: numpy array
+        (nexp, len(w_hires)) interpolated spectra
+    """
+    nexp, npix = np.shape(w)
+    oversample_factor = len(w_hires)/npix*1.0
+
+    interp = sparse.block_diag([interp_matrix(w_hires, w[j]) for j in range(nexp)], format='csr')
+    f_interp = (interp @ np.ravel(spec_opt)).reshape(nexp, -1)
+    variance_interp = (interp @ np.ravel(var_opt)).reshape(nexp, -1)
+
+    #accounts for decrease in precision when spectrum is oversampled
+    weights = 1.0/(variance_interp*oversample_factor)
+
+    inbin = bin_matrix(w_hires, wave_edges)
+    sum_weights = (inbin @ weights.T).T
+    meanflux = (inbin @ (f_interp*weights).T).T/sum_weights
+    meanvar = 1.0/sum_weights
+
+    return meanflux, meanvar, f_interp
+
+
+def pixel_edges(x):
+    """
+    Edges of the pixels with the central wavelengths x (along the last axis).
+    The edges lie halfway between the pixel centers. The outer edges are half a pixel away from the first and the last pixel center.
+    """
+    x = np.asarray(x)
+    mid = 0.5*(x[..., 1:] + x[..., :-1])
+    first = 1.5*x[..., :1] - 0.5*x[..., 1:2]
+    last = 1.5*x[..., -1:] - 0.5*x[..., -2:-1]
+    return np.concatenate([first, mid, last], axis=-1)
+
+
+def overlap_matrix(w, wave_edges):
+    """
+    Sparse matrix with the fraction of every pixel which falls into each wavelength bin, for all exposures.
+
+    The pixel edges and the bin edges of every exposure are sorted together.
+    Every interval between two neighbouring edges then lies in exactly one pixel and one bin and its length is the overlap of the two.
+
+    Parameters
+    -----------
+    w: numpy array
+        (nexp, npix) central wavelengths of the pixels of every exposure
+    wave_edges: numpy array
+        increasing edges of the wavelength bins
+
+    Returns
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        block diagonal (nexp*nbins, nexp*npix) matrix with the overlap fractions of every exposure
+    """
+    nexp, npix = np.shape(w)
+    nbins = len(wave_edges) - 1
+    edges = pixel_edges(w)
+    alledges = np.concatenate([edges, np.broadcast_to(wave_edges, (nexp, nbins + 1))], axis=1)
+    is_pixel_edge = np.concatenate([np.ones(npix + 1, dtype=int), np.zeros(nbins + 1, dtype=int)])
+
+    order = np.argsort(alledges, axis=1, kind='stable')
+    sorted_edges = np.take_along_axis(alledges, order, axis=1)
+    # index of the pixel and of the bin in which each interval between two sorted edges lies (-1 or npix/nbins if outside)
+    ipix = np.cumsum(is_pixel_edge[order], axis=1)[:, :-1] - 1
+    ibin = np.cumsum(1 - is_pixel_edge[order], axis=1)[:, :-1] - 1
+    length = np.diff(sorted_edges, axis=1)
+
+    iexp = np.broadcast_to(np.arange(nexp)[:, None], ipix.shape)
+    inside = (ipix >= 0) & (ipix < npix) & (ibin >= 0) & (ibin < nbins) & (length > 0)
+    ipix, ibin, iexp, length = ipix[inside], ibin[inside], iexp[inside], length[inside]
+    frac = length/np.diff(edges, axis=1)[iexp, ipix]
+
+    return sparse.csr_matrix((frac, (iexp*nbins + ibin, iexp*npix + ipix)), shape=(nexp*nbins, nexp*npix))
+
+
+def bin_overlap(w, spec_opt, var_opt, wave_edges):
+    """
+    Bins the spectra of all exposures into wavelength bins using the exact fractional overlap of the pixels with the bins.
+
+    The flux in a bin is the sum of the pixel fluxes weighted with the fraction of the pixel falling into the bin, so the flux is conserved.
+    The variance is propagated exactly: it is the sum of the pixel variances weighted with the squared fractions.
+
+    Parameters
+    -----------
+    w: numpy array
+        (nexp, npix) wavelength solution of every exposure
+    spec_opt: numpy array
+        (nexp, npix) spectra
+    var_opt: numpy array
+        (nexp, npix) variances of the spectra
+    wave_edges: numpy array
+        edges of the wavelength bins
+
+    Returns
+    ----------
+    binflux: numpy array
+        (nexp, nbins) binned flux
+    binvar: numpy array
+        (nexp, nbins) variance of the binned flux
+    """
+    nexp = len(w)
+    overlap = overlap_matrix(w, wave_edges)
+    binflux = (overlap @ np.ravel(spec_opt)).reshape(nexp, -1)
+    binvar = (overlap.multiply(overlap) @ np.ravel(var_opt)).reshape(nexp, -1)
+    return binflux, binvar
+
+
+def common_width(npix_exp, w, spec_opt, var_opt):
+    """
+    Cuts the spectra of all exposures to the pixels which were extracted in every exposure.
+
+    s20 pads the spectrum of an exposure with zeros if its trace was cut off at the right edge of the subarray.
+    Only the first npix_exp[i] pixels of exposure i are valid, so the first min(npix_exp) pixels are valid in all exposures.
+
+    Parameters
+    -----------
+    npix_exp: numpy array
+        number of extracted pixels of every exposure
+    w: numpy array
+        (nexp, npix) wavelength solution of every exposure
+    spec_opt: numpy array
+        (nexp, npix) spectra
+    var_opt: numpy array
+        (nexp, npix) variances of the spectra
+
+    Returns
+    ----------
+    w, spec_opt, var_opt: numpy arrays
+        (nexp, min(npix_exp)) arrays without the zero padding
+    """
+    nvalid = int(np.min(npix_exp))
+    if nvalid < 2:
+        raise ValueError('Only {0} pixel(s) were extracted in every exposure. Check the trace and BEAMA_i/BEAMA_f.'.format(nvalid))
+    return w[:, :nvalid], spec_opt[:, :nvalid], var_opt[:, :nvalid]
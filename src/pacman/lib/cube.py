@@ -0,0 +1,76 @@
+import numpy as np
+import h5py
+from astropy.table import Table
+
+
+def write_cube(filename, columns):
+    """
+    Saves arrays into a binary HDF5 file (a "cube").
+
+    The datasets are written contiguously and without compression, so that they can be memory-mapped when reading them in again.
+
+    Parameters
+    -----------
+    filename: str
+        path of the file (ending with .h5)
+    columns: dict
+        names and arrays which will be saved. The order of the columns is saved as well.
+
+    Returns
+    ----------
+    None
+    """
+    with h5py.File(filename, 'w') as f:
+        for name, value in columns.items():
+            f.create_dataset(name, data=np.ascontiguousarray(value))
+        f.attrs['colnames'] = list(columns.keys())
+
+
+def read_cube(filename, mmap=True):
+    """
+    Reads in a file saved with write_cube.
+
+    Parameters
+    -----------
+    filename: str
+        path of the file
+    mmap: bool
+        If True, the arrays are memory-mapped (read-only) instead of being read into memory
+
+    Returns
+    ----------
+    columns: dict
+        names and arrays in the same order as they were saved
+    """
+    columns = {}
+    with h5py.File(filename, 'r') as f:
+        for name in f.attrs['colnames']:
+            dset = f[name]
+            offset = dset.id.get_offset()
+            # empty datasets do not have an offset and cannot be memory-mapped
+            if mmap and offset is not None and dset.size > 0:
+                columns[name] = np.memmap(filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+            else:
+                columns[name] = dset[()]
+    return columns
+
+
+def read_cube_table(filename, mmap=True):
+    """
+    Reads in a file saved with write_cube as an astropy table.
+    Only works if all columns have the same length.
+
+    Parameters
+    -----------
+    filename: str
+        path of the file
+    mmap: bool
+        If True, the columns are memory-mapped (read-only) instead of being read into memory
+
+    Returns
+    ----------
+    table: astropy.table.Table
+        table with the columns saved in the file
+    """
+    columns = read_cube(filename, mmap=mmap)
+    return Table(list(columns.values()), names=list(columns.keys()), copy=False)
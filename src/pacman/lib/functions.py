@@ -1,16 +1,20 @@
 import sys
 sys.path.insert(0, './models')
-from ..lib.models.constant import constant
-from ..lib.models.polynomial1 import polynomial1
-from ..lib.models.polynomial2 import polynomial2
+from ..lib.models.constant import constant, constant_deriv
+from ..lib.models.polynomial1 import polynomial1, polynomial1_deriv
+from ..lib.models.polynomial2 import polynomial2, polynomial2_deriv
 from ..lib.models.sine1 import sine1
-from ..lib.models.sine2 import sine2
-from ..lib.models.upstream_downstream import upstream_downstream
+from ..lib.models.sine2 import sine2, sine2_deriv
+from ..lib.models.upstream_downstream import upstream_downstream, upstream_downstream_deriv
 from ..lib.models.transit import transit
 from ..lib.models.eclipse import eclipse
-from ..lib.models.model_ramp import model_ramp
+from ..lib.models.model_ramp import model_ramp, model_ramp_deriv
 from ..lib.models.divide_white import divide_white
 from ..lib.models.ackbar import ackbar
+from ..lib.models.gp_exp import gp_exp
+
+#systematics models which broadcast over a batch of parameter vectors, i.e. which return a (nbatch, npoints) array if their parameters are (nbatch, 1) columns (see Model.ln_like_batch)
+vectorized_sys = (constant, upstream_downstream, polynomial1, polynomial2, sine2, model_ramp)
 
 #need to automate appending parameters to functions
 class Functions:
@@ -19,25 +23,35 @@ class Functions:
         self.astro_porder = []
         self.sys = []
         self.sys_porder = []
+        #partial derivatives of the systematics models with respect to their parameters (None if they are not known analytically, see Model.jacobian)
+        self.sys_deriv = []
+        #Gaussian process for correlated noise in the residuals (None if the noise is white, see model.calc_gp)
+        self.gp = None
+        self.gp_porder = []
 
         for f in funcs:
             if f == "constant":
                 self.sys.append(constant)
+                self.sys_deriv.append(constant_deriv)
                 self.sys_porder.append([data.par_order['c']*data.nvisit]) #:(1 + data.par_order['c'])*data.nvisit])
             elif f == "upstream_downstream":
                 self.sys.append(upstream_downstream)
+                self.sys_deriv.append(upstream_downstream_deriv)
                 self.sys_porder.append([data.par_order['scale']*data.nvisit])
             elif f == "polynomial1":
                 self.sys.append(polynomial1)
+                self.sys_deriv.append(polynomial1_deriv)
                 self.sys_porder.append([data.par_order['v']*data.nvisit])
             elif f == "polynomial2":
                 self.sys.append(polynomial2)
+                self.sys_deriv.append(polynomial2_deriv)
                 self.sys_porder.append([
                     data.par_order['v']*data.nvisit,
                     data.par_order['v2']*data.nvisit
                 ]) 
             elif f == "sine1":
                 self.sys.append(sine1)
+                self.sys_deriv.append(None)
                 self.sys_porder.append([
                     data.par_order['a1']*data.nvisit,
                     data.par_order['omega1']*data.nvisit,
@@ -45,6 +59,7 @@ class Functions:
                 ]) 
             elif f == "sine2":
                 self.sys.append(sine2)
+                self.sys_deriv.append(sine2_deriv)
                 self.sys_porder.append([
                     data.par_order['a1']*data.nvisit,
                     data.par_order['omega1']*data.nvisit,
@@ -67,6 +82,7 @@ class Functions:
                 ]) 
             elif f == "model_ramp":
                 self.sys.append(model_ramp)
+                self.sys_deriv.append(model_ramp_deriv)
                 self.sys_porder.append([
                     data.par_order['r1']*data.nvisit,
                     data.par_order['r2']*data.nvisit,
@@ -74,6 +90,7 @@ class Functions:
                 ]) 
             elif f == "ackbar":
                 self.sys.append(ackbar)
+                self.sys_deriv.append(None)
                 self.sys_porder.append([
                     data.par_order['trap_pop_s']*data.nvisit,
                     data.par_order['trap_pop_f']*data.nvisit,
@@ -82,7 +99,14 @@ class Functions:
                 ]) 
             elif f == "divide_white":
                 self.sys.append(divide_white)
+                self.sys_deriv.append(None)
                 self.sys_porder.append([])
+            elif f == "gp_exp":
+                self.gp = gp_exp
+                self.gp_porder = [
+                    data.par_order['gp_amp']*data.nvisit,
+                    data.par_order['gp_tau']*data.nvisit
+                ]
             elif f == "transit":
                 self.astro.append(transit)
                 self.astro_porder.append([
@@ -0,0 +1,302 @@
+import numpy as np
+import os
+import time
+from astropy.stats import sigma_clip
+from .read_data import Data
+from .model import Model
+from .least_squares import residuals, weighted_jacobian
+from .formatter import PrintParams, ReturnParams
+from . import plots
+from .plots import plot_raw, plot_fit_lc2, plot_fit_lc3
+from .models import ackbar, batman_cache
+
+
+class JointFit:
+    """
+    Fits several light curves (e.g., the spectroscopic light curves) at once, with some parameters shared by all light curves.
+
+    theta contains the free entries of the shared parameters once, followed by the other free entries of every light curve.
+    Light curve c uses theta[idx[c]] as the free parameters of its ParameterMap (data.param_map).
+    The residuals of a light curve only depend on the shared parameters and on its own parameters, so the Jacobian is block sparse:
+    one dense block per light curve with the columns idx[c]. Only these blocks are calculated and stored.
+    The steps of the fit eliminate the parameters of every light curve with the Schur complement of the normal equations,
+    so the cost of the fit grows linearly with the number of light curves.
+
+    Parameters
+    -----------
+    datas: list
+        Data of every light curve
+    models: list
+        Model of every light curve
+    shared: list
+        names of the parameters (as in fit_par) which are shared by all light curves
+    """
+    def __init__(self, datas, models, shared):
+        self.datas = datas
+        self.models = models
+        maps = [data.param_map for data in datas]
+
+        if any(model.myfuncs.gp is not None for model in models):
+            raise ValueError('The joint fit does not support a Gaussian process (gp_exp) in s30_myfuncs')
+        unknown = [name for name in shared if name not in maps[0].names]
+        if len(unknown) > 0:
+            raise ValueError('Shared parameter(s) {0} not found in fit_par'.format(unknown))
+
+        # is_shared[c] marks the shared entries of the free parameters of light curve c
+        self.is_shared = [np.isin(pm.names[pm.free_idx], shared) for pm in maps]
+        # entries of the full parameter array which are shared (the same for every light curve)
+        self.shared_idx = maps[0].free_idx[self.is_shared[0]]
+        nshared = len(self.shared_idx)
+
+        self.idx = []
+        n = nshared
+        for pm, s in zip(maps, self.is_shared):
+            if not np.array_equal(pm.free_idx[s], self.shared_idx):
+                raise ValueError('The shared parameters have to be free in every light curve')
+            idx = np.empty(pm.nfree, dtype=int)
+            idx[s] = np.arange(nshared)
+            idx[~s] = n + np.arange(np.sum(~s))
+            n += np.sum(~s)
+            self.idx.append(idx)
+        self.nshared = nshared
+        self.nfree = n
+
+        # labels of theta: the shared parameters followed by the parameters of every light curve (with the number of the light curve)
+        self.labels = [maps[0].labels[k] for k in np.flatnonzero(self.is_shared[0])]
+        for c, (pm, s) in enumerate(zip(maps, self.is_shared)):
+            self.labels += [pm.labels[k] + '_' + str(c) for k in np.flatnonzero(~s)]
+
+    def pack(self, params):
+        """
+        Returns theta of the list params with the full parameter array of every light curve.
+        The shared parameters are taken from the first light curve.
+        """
+        theta = np.empty(self.nfree)
+        for c in reversed(range(len(self.datas))):
+            theta[self.idx[c]] = self.datas[c].param_map.pack(params[c])
+        return theta
+
+    def unpack(self, theta, params):
+        """
+        Returns a list with a copy of the full parameter array of every light curve (params), with the free parameters set to theta.
+        """
+        return [data.param_map.unpack(theta[idx], p) for data, idx, p in zip(self.datas, self.idx, params)]
+
+    def bounds(self):
+        """
+        Lower and upper limits of theta (-inf and inf if a parameter is not limited).
+        """
+        lo, hi = np.empty(self.nfree), np.empty(self.nfree)
+        for data, idx in zip(self.datas, self.idx):
+            pm = data.param_map
+            lo[idx] = pm.lo_val[pm.free_idx]
+            hi[idx] = pm.hi_val[pm.free_idx]
+        return lo, hi
+
+    def residuals(self, theta, params):
+        """
+        Residuals divided by the uncertainties of all light curves, one after the other.
+        """
+        params = self.unpack(theta, params)
+        return np.concatenate([residuals(p, data, model)[1] for p, data, model in zip(params, self.datas, self.models)])
+
+    def blocks(self, theta, params):
+        """
+        Residuals (divided by the uncertainties) and Jacobian block of every light curve.
+        Block c contains the derivatives with respect to theta[idx[c]], calculated by Model.jacobian (see least_squares.weighted_jacobian).
+        """
+        blocks = []
+        for p, data, model in zip(self.unpack(theta, params), self.datas, self.models):
+            pm = data.param_map
+            resid = residuals(p, data, model)[1]
+            # the residuals are data - model, so their derivatives are the negative derivatives of the model
+            jac = -weighted_jacobian(p, data, model, pm.free, pm.step, pm.hi_val, pm.tied)[:, pm.free_idx]
+            blocks.append((resid, jac))
+        return blocks
+
+    def normal_equations(self, blocks):
+        """
+        Splits the normal equations J^T J and J^T r into the parts of the shared parameters (A, g) and of every light curve:
+        D = L^T L, B = L^T S and h = L^T r, where S and L are the columns of the shared and of the other parameters of the light curve.
+        """
+        A, g = np.zeros((self.nshared, self.nshared)), np.zeros(self.nshared)
+        local = []
+        for (resid, jac), s in zip(blocks, self.is_shared):
+            S, L = jac[:, s], jac[:, ~s]
+            A += S.T @ S
+            g += S.T @ resid
+            local.append((L.T @ L, L.T @ S, L.T @ resid))
+        return A, g, local
+
+    def step(self, A, g, local, lam):
+        """
+        Levenberg-Marquardt step: solves (J^T J + lam diag(J^T J)) delta = -J^T r.
+        The blocks of the light curves are eliminated first (Schur complement), so only small systems are solved.
+        """
+        def damp(M):
+            d = np.diag(M).copy()
+            d[d == 0] = 1.
+            return M + lam*np.diag(d)
+
+        schur, rhs = damp(A), -g
+        solved = []
+        for D, B, h in local:
+            D = damp(D)
+            DB, Dh = np.linalg.solve(D, B), np.linalg.solve(D, -h)
+            schur -= B.T @ DB
+            rhs -= B.T @ Dh
+            solved.append((DB, Dh))
+        delta = np.empty(self.nfree)
+        delta[:self.nshared] = np.linalg.solve(schur, rhs)
+        for idx, s, (DB, Dh) in zip(self.idx, self.is_shared, solved):
+            delta[idx[~s]] = Dh - DB @ delta[:self.nshared]
+        return delta
+
+    def errors(self, A, local):
+        """
+        Uncertainties of theta from the diagonal of the covariance matrix (J^T J)^-1, like in mpfit.
+        Parameters which do not change the model get an uncertainty of zero (pseudo-inverse).
+        """
+        schur, Dinv = A.copy(), []
+        for D, B, h in local:
+            Di = np.linalg.pinv(D)
+            schur -= B.T @ Di @ B
+            Dinv.append(Di)
+        cov = np.linalg.pinv(schur)
+        err = np.empty(self.nfree)
+        err[:self.nshared] = np.sqrt(np.abs(np.diag(cov)))
+        for idx, s, Di, (D, B, h) in zip(self.idx, self.is_shared, Dinv, local):
+            X = Di @ B
+            err[idx[~s]] = np.sqrt(np.abs(np.diag(Di + X @ cov @ X.T)))
+        return err
+
+    def fit(self, params, maxiter=200, ftol=1e-10, xtol=1e-10):
+        """
+        Fits all light curves with a Levenberg-Marquardt algorithm, starting from params. Steps beyond the limits are clipped at the limits.
+        The fit stops when the relative decrease of chi2 is below ftol, the relative step is below xtol or chi2 cannot be decreased anymore.
+
+        Returns the list of the full parameter arrays and the list of their uncertainties (zero for the fixed and tied parameters).
+        The models of all light curves are evaluated for the best fit parameters.
+        """
+        lo, hi = self.bounds()
+        theta = np.clip(self.pack(params), lo, hi)
+        blocks = self.blocks(theta, params)
+        chi2 = sum(np.sum(resid**2) for resid, jac in blocks)
+        lam = 1e-3
+        self.niter, self.converged = 0, False
+        for self.niter in range(1, maxiter + 1):
+            A, g, local = self.normal_equations(blocks)
+            # increases the damping until chi2 decreases
+            while lam < 1e10:
+                theta_new = np.clip(theta + self.step(A, g, local, lam), lo, hi)
+                chi2_new = np.sum(self.residuals(theta_new, params)**2)
+                if chi2_new < chi2: break
+                lam *= 10.
+            if lam >= 1e10:
+                self.converged = True
+                break
+            small_step = np.all(np.abs(theta_new - theta) <= xtol*(np.abs(theta) + xtol))
+            small_decrease = chi2 - chi2_new <= ftol*chi2
+            theta, chi2, lam = theta_new, chi2_new, lam/10.
+            blocks = self.blocks(theta, params)
+            if small_step or small_decrease:
+                self.converged = True
+                break
+        if not self.converged: print("Joint fit: maximum number of iterations reached")
+
+        A, g, local = self.normal_equations(blocks)
+        theta_err = self.errors(A, local)
+        self.chi2 = chi2
+
+        params = self.unpack(theta, params)
+        perrors = []
+        for p, data, model, idx in zip(params, self.datas, self.models, self.idx):
+            model.fit(data, p)
+            perror = np.zeros(len(p))
+            perror[data.param_map.free_idx] = theta_err[idx]
+            perrors.append(perror)
+        return params, perrors
+
+
+class JointResult:
+    """
+    Result of the joint fit for one light curve. It has the attributes of the mpfit object used by PrintParams and ReturnParams.
+    """
+    def __init__(self, params, perror):
+        self.params = params
+        self.perror = perror
+
+
+def joint_fit(meta, fit_par, files):
+    """
+    Fits the light curves in files jointly (least squares). The parameters listed in s30_joint_shared are shared by all light curves.
+
+    Outliers are clipped in every light curve after each fit like in s30_run.fit_file (run_clipiters, run_clipsigma).
+    Returns a list with one dictionary per light curve, like s30_run.fit_file.
+    """
+    myfuncs = meta.s30_myfuncs
+    datas, models = [], []
+    for counter, f in enumerate(files):
+        print('\n****** File: {0}/{1}'.format(counter+1, len(files)))
+        meta.s30_file_counter = counter
+        meta.run_file = f
+        data = Data(f, meta, fit_par)
+        datas.append(data)
+        models.append(Model(data, myfuncs))
+        if meta.save_raw_lc_plot: plot_raw(data, meta)
+    meta.fittime = time.strftime('%Y-%m-%d_%H-%M-%S')
+
+    # every light curve and visit has its own time array (the outliers are clipped per light curve)
+    # the cached transit/eclipse models and ramp plans of all of them are reused in every step of the fit
+    nkeys = sum(data.nvisit for data in datas)
+    batman_cache.reserve(2*nkeys)
+    ackbar.reserve(nkeys)
+
+    fit = JointFit(datas, models, meta.s30_joint_shared)
+    print('\nJoint fit of {0} light curves with {1} free parameters ({2} shared)'.format(len(files), fit.nfree, fit.nshared))
+
+    params = [data.param_map.value for data in datas]
+    for iii in range(meta.run_clipiters+1):
+        print('\n')
+        print('Sigma Iters: ', iii, 'of', meta.run_clipiters)
+        print('\nRuns the joint fit... ')
+        params, perrors = fit.fit(params)
+        print('Iterations: {0}, chi2: {1}'.format(fit.niter, fit.chi2))
+        if iii == meta.run_clipiters: break
+        nclip = 0
+        for c, (data, model) in enumerate(zip(fit.datas, fit.models)):
+            clip_idx = np.flatnonzero(np.ma.getmask(sigma_clip(model.resid, sigma=meta.run_clipsigma, maxiters=1)))
+            if len(clip_idx) == 0: continue
+            data.clip(clip_idx)
+            model.resize(data)
+            nclip += len(clip_idx)
+        print('Outlier Identified: ', nclip)
+        if nclip == 0: break
+
+    results = []
+    for counter, (data, model, p, perror) in enumerate(zip(fit.datas, fit.models, params, perrors)):
+        meta.s30_file_counter = counter
+        meta.run_file = files[counter]
+        meta.wavelength = data.wavelength
+        m = JointResult(p, perror)
+
+        if meta.save_fit_lc_plot:
+            plot_fit_lc2(data, model, meta)
+            plot_fit_lc3(data, model, meta)
+            plots.save_plot_raw_data(data, meta)
+            plots.save_astrolc_data(data, model, meta)
+
+        result = dict(chi2red=model.chi2red, labels=data.param_map.labels)
+        if meta.run_verbose:
+            print("rms, chi2red = ", model.rms, model.chi2red)
+            if not os.path.isdir(meta.workdir + meta.fitdir + '/lsq_res'):
+                os.makedirs(meta.workdir + meta.fitdir + '/lsq_res', exist_ok=True)
+            f_lsq = open(meta.workdir + meta.fitdir + '/lsq_res/' + "/lsq_res_bin{0}_wvl{1:0.3f}.txt".format(meta.s30_file_counter, meta.wavelength), 'w')
+            PrintParams(m, data, savefile=f_lsq)
+            PrintParams(m, data)
+            result['val'], result['err'], result['idx'] = ReturnParams(m, data)
+        if meta.save_allan_plot:
+            plots.rmsplot(model, data, meta)
+        results.append(result)
+
+    return results
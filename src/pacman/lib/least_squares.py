@@ -8,58 +8,36 @@ import pickle
 from astropy.stats import sigma_clip
 
 
-def residuals(params, data, model, fjac=None):			
+def residuals(params, data, model, fjac=None, step=None, hi_val=None, tied=None):
     fit = model.fit(data, params)
-    return [0, fit.resid/data.err]
-
-def lsq_fit(fit_par, data, meta, model, myfuncs, noclip=False):
+    if fjac is None:
+        #with a Gaussian process the residuals are whitened and include its log determinant (see model.calc_gp)
+        return [0, fit.resid/data.err if fit.gp_resid is None else fit.gp_resid]
+
+    #mpfit asks for the partial derivatives (autoderivative=0); fjac is 1 for the free parameters
+    return [0, fit.resid/data.err, weighted_jacobian(params, data, model, np.asarray(fjac) > 0, step, hi_val, tied)]
+
+def weighted_jacobian(params, data, model, free, step, hi_val, tied):
+    #partial derivatives of the model divided by the uncertainties, for the free parameters (zero for the others)
+    #tied parameters are fixed in the fits, their derivatives are added to the derivatives of the parameters they are tied to
+    free = np.array(free, dtype=bool)
+    free[tied >= 0] = free[tied[tied >= 0]]
+    #steps for the finite differences like in mpfit.fdjac2: step_size from fit_par or a relative step. The steps are reversed at an upper limit
+    h = np.where(step > 0, step, np.sqrt(np.finfo(float).eps)*np.abs(params))
+    h[h == 0] = np.sqrt(np.finfo(float).eps)
+    h[params > hi_val - h] *= -1
+    jac = model.jacobian(data, params, free, h)
+    for k in np.flatnonzero(tied >= 0):
+        jac[:, tied[k]] += jac[:, k]
+    return jac/data.err[:, None]
+
+def lsq_fit(fit_par, data, meta, model, myfuncs, noclip=False, params_start=None):
     #TODO: noclip = True should be standard
-    nvisit = data.nvisit 
-    npar = len(data.parnames)*nvisit
-
-    #initializes least squares fit parameters
-    parinfo = [{'value':0, 'fixed':0, 'limited':[0,0,], 'limits':[0.0,0.0], 
-                'step':0.0} for j in range(npar)]
-    params_s = []
-
-    #loops through parameters and visits
-    #sets initial guess, step size, tie, bounds
-
-    ii=0
-    for i in range(int(len(data.parnames))):
-        if str(fit_par['tied'][ii]) == "-1":
-            for j in range(nvisit):
-                parinfo[i*nvisit+j]['value'] = fit_par['value'][ii]
-                parinfo[i*nvisit+j]['step'] = fit_par['step_size'][ii]
-                parinfo[i*nvisit+j]['fixed'] = fit_par['fixed'][ii].lower() == "true"
-                if j>0 and str(fit_par['tied'][ii]) == "-1":
-                    parinfo[i*nvisit+j]['tied'] = 'p[{0}]'.format(nvisit*i)
-                if fit_par['lo_lim'][ii].lower() == "true":
-                    parinfo[i*nvisit+j]['limited'][0] = True
-                    parinfo[i*nvisit+j]['limits'][0] = fit_par['lo_val'][ii]
-                if fit_par['hi_lim'][ii].lower() == "true":
-                    parinfo[i*nvisit+j]['limited'][1] = True
-                    parinfo[i*nvisit+j]['limits'][1] = fit_par['hi_val'][ii]
-                params_s.append(fit_par['value'][ii])
-            ii = ii+1
-        else:
-            for j in range(nvisit):
-                parinfo[i * nvisit + j]['value'] = fit_par['value'][ii]
-                parinfo[i * nvisit + j]['step'] = fit_par['step_size'][ii]
-                parinfo[i * nvisit + j]['fixed'] = fit_par['fixed'][ii].lower() == "true"
-                if j > 0 and str(fit_par['tied'][ii]) == "-1":
-                    parinfo[i * nvisit + j]['tied'] = 'p[{0}]'.format(nvisit * i)
-                if fit_par['lo_lim'][ii].lower() == "true":
-                    parinfo[i * nvisit + j]['limited'][0] = True
-                    parinfo[i * nvisit + j]['limits'][0] = fit_par['lo_val'][ii]
-                if fit_par['hi_lim'][ii].lower() == "true":
-                    parinfo[i * nvisit + j]['limited'][1] = True
-                    parinfo[i * nvisit + j]['limits'][1] = fit_par['hi_val'][ii]
-                params_s.append(fit_par['value'][ii])
-                ii = ii + 1
-
-
-    params_s = np.array(params_s)
+    #params_start: starting values for mpfit (e.g., the result of the previous clipping iteration). The values in fit_par are used if None
+    #sets initial guess, step size, tie and bounds of every parameter and visit (see ParameterMap)
+    param_map = data.param_map
+    params_s = param_map.value if params_start is None else np.array(params_start, dtype=float)
+    parinfo = param_map.parinfo(params_s)
     if meta.save_raw_lc_plot: plot_raw(data, meta)
     fa = {'data':data, 'model':model}
 
@@ -71,8 +49,16 @@ def lsq_fit(fit_par, data, meta, model, myfuncs, noclip=False):
             #data.dof += 2
 #		print "subtracting 2 from dof for divide-white"
 
+    #Model.jacobian does not include the Gaussian process, mpfit calculates the derivatives with a Gaussian process
+    analytic_jacobian = meta.run_lsq_jacobian and model.myfuncs.gp is None
+    if analytic_jacobian:
+        #the partial derivatives are calculated by Model.jacobian instead of finite differences of the whole model in mpfit
+        fa['step'] = param_map.step
+        fa['hi_val'] = param_map.hi_val
+        fa['tied'] = param_map.tied
+
     print('\nRuns MPFIT... ')
-    m = mpfit.mpfit(residuals, params_s, functkw=fa, parinfo = parinfo, quiet=True)
+    m = mpfit.mpfit(residuals, params_s, functkw=fa, parinfo = parinfo, quiet=True, autoderivative=int(not analytic_jacobian))
 
     if noclip == False:
         #if user wants to sigma clip but there is nothing to clip:
@@ -121,7 +107,7 @@ def lsq_fit(fit_par, data, meta, model, myfuncs, noclip=False):
 
     if meta.run_verbose:
         if not os.path.isdir(meta.workdir + meta.fitdir + '/lsq_res'):
-            os.makedirs(meta.workdir + meta.fitdir + '/lsq_res')
+            os.makedirs(meta.workdir + meta.fitdir + '/lsq_res', exist_ok=True)
         f_lsq = open(meta.workdir + meta.fitdir + '/lsq_res/' + "/lsq_res_bin{0}_wvl{1:0.3f}.txt".format(meta.s30_file_counter, meta.wavelength), 'w')
         PrintParams(m, data, savefile=f_lsq)
         PrintParams(m, data)
@@ -2,229 +2,113 @@ import emcee
 import os
 import numpy as np
 import pickle
+import shutil
+import time
+import h5py
 from datetime import datetime
 from scipy.stats import norm
 from uncertainties import ufloat
 from . import plots
+from . import util
+from .pool import make_pool, close_pool
 
 
 def quantile(x, q):                                                             
         return np.percentile(x, [100. * qi for qi in q]) 
 
-def format_params_for_mcmc(params, meta, fit_par):	#FIXME: make sure this works for cases when nvisit>1
-    nvisit = int(meta.nvisit)
-    #theta = []
-    #print('params', params)
-
-    fixed_array = np.array(fit_par['fixed'])
-    tied_array = np.array(fit_par['tied'])
-    free_array = []
-
-    #print(len(fixed_array))
-
-    for i in range(len(fixed_array)):
-        if fixed_array[i].lower() == 'true' and tied_array[i] == -1:
-            for ii in range(nvisit):
-                free_array.append(False)
-        if fixed_array[i].lower() == 'true' and not tied_array[i] == -1:
-            free_array.append(False)
-        if fixed_array[i].lower() == 'false' and tied_array[i] == -1:
-            free_array.append(True)
-            for ii in range(nvisit-1):
-                free_array.append(False)
-        if fixed_array[i].lower() == 'false' and not tied_array[i] == -1:
-            free_array.append(True)
-    free_array = np.array(free_array)
-
-    #print(len(params))
-    #print(len(free_array))
-
-    theta = params[free_array]
-
-    # if meta.fit_par_new == False:
-    #     for i in range(len(fit_par)):
-    #             if fit_par['fixed'][i].lower() == "false":
-    #                     if fit_par['tied'][i].lower() == "true": theta.append(params[i*nvisit])
-    #                     else:
-    #                             for j in range(nvisit): theta.append(params[i*nvisit+j])
-    # else:
-    #     ii = 0
-    #     for i in range(int(len(params)/nvisit)):
-    #             if fit_par['fixed'][ii].lower() == "false":
-    #                     if str(fit_par['tied'][ii]) == "-1":
-    #                         theta.append(params[i*nvisit])
-    #                         ii = ii + 1
-    #                     else:
-    #                         for j in range(nvisit):
-    #                             theta.append(params[i*nvisit+j])
-    #                             ii = ii + 1
-    #             else:
-    #                 ii = ii + 1
-    #print(len(theta))
-    #print('theta', theta)
-    return np.array(theta)
-
-
-def get_step_size(params, meta, fit_par):
-    nvisit = int(meta.nvisit)
-    step_size = []
-
-    ii = 0
-    for i in range(int(len(params)/nvisit)):
-            if fit_par['fixed'][ii].lower() == "false":
-                    if str(fit_par['tied'][ii]) == "-1":
-                        step_size.append(fit_par['step_size'][ii])
-                        ii = ii + 1
-                    else:
-                        for j in range(nvisit):
-                            step_size.append(fit_par['step_size'][ii])
-                            ii = ii + 1
-            else:
-                ii = ii + 1
-
-    #print(len(step_size))
-    #print('step size', np.array(step_size))
-    return np.array(step_size)
-
-# def labels_gen(params, meta, fit_par):
-#     nvisit = int(meta.nvisit)
-#     labels = []
-#
-#     ii = 0
-#     for i in range(int(len(params)/nvisit)):
-#             if fit_par['fixed'][ii].lower() == "false":
-#                     if str(fit_par['tied'][ii]) == "-1":
-#                         labels.append(fit_par['parameter'][ii])
-#                         ii = ii + 1
-#                     else:
-#                         for j in range(nvisit):
-#                             labels.append(fit_par['parameter'][ii]+str(j))
-#                             ii = ii + 1
-#             else:
-#                 ii = ii + 1
-#
-#     #print('labels', labels)
-#     return labels
-
-
-
-
-def format_params_for_Model(theta, params, meta, fit_par):
-    nvisit = int(meta.nvisit)
-    params_updated = []
-    # iter = 0									#this should be a more informative name FIXME
-    #
-    # if meta.fit_par_new == False:
-    #     for i in range(len(fit_par)):
-    #             if fit_par['fixed'][i].lower() == "true":
-    #                     for j in range(nvisit):
-    #                             params_updated.append(params[i*nvisit+j])
-    #             else:
-    #                     if fit_par['tied'][i].lower() == "true":
-    #                             for j in range(nvisit): params_updated.append(theta[iter])
-    #                             iter += 1
-    #                     else:
-    #                             for j in range(nvisit):
-    #                                     params_updated.append(theta[iter])
-    #                                     iter += 1
-    # else:
-    #     ii = 0
-    #     for i in range(int(len(params)/nvisit)):
-    #             if fit_par['fixed'][ii].lower() == "true":
-    #                     for j in range(nvisit):
-    #                             params_updated.append(params[i*nvisit+j])
-    #                     ii = ii + 1
-    #             else:
-    #                     if str(fit_par['tied'][ii]) == "-1":
-    #                             for j in range(nvisit): params_updated.append(theta[iter])
-    #                             iter += 1
-    #                             ii = ii + 1
-    #                     else:
-    #                             for j in range(nvisit):
-    #                                     params_updated.append(theta[iter])
-    #                                     iter += 1
-    #                                     ii = ii + 1
-
-
-    fixed_array = np.array(fit_par['fixed'])
-    tied_array = np.array(fit_par['tied'])
-    free_array = []
-
-    for i in range(len(fixed_array)):
-        if fixed_array[i].lower() == 'true' and tied_array[i] == -1:
-            for ii in range(nvisit):
-                free_array.append(False)
-        if fixed_array[i].lower() == 'true' and not tied_array[i] == -1:
-            free_array.append(False)
-        if fixed_array[i].lower() == 'false' and tied_array[i] == -1:
-            free_array.append(True)
-            for ii in range(nvisit-1):
-                free_array.append(False)
-        if fixed_array[i].lower() == 'false' and not tied_array[i] == -1:
-            free_array.append(True)
-    free_array = np.array(free_array)
-
-    #TODO: Oida?
-    def repeated(array, index, n_times):
-        array_new = []
-        index_index = 0
-        for ii in range(len(array)):
-            if ii in index:
-                array_new.append([array[index[index_index]]] * n_times)
-            else:
-                array_new.append([array[ii]])
-            index_index = index_index + 1
-        array_new2 = np.array([item for sublist in array_new for item in sublist])
-        return array_new2
-
-    theta_new = theta #repeated(theta, [0, 1], 5)
-
-    #print('params', params)
-    #print(len(params))
-    #print('free array', free_array)
-    #print(len(free_array))
-    #print(sum(free_array))
-    #print('theta new:', theta_new)
-    #print(len(theta_new))
-
-    params_updated = np.copy(params)
-    params_updated[free_array] = theta_new
-
-    #print('params', params)
-    #print('params_updated', params_updated)
-    #print(len(params))
-    #print(len(params_updated))
-    return np.array(params_updated)
-
 def mcmc_fit(data, model, params, file_name, meta, fit_par):
-    theta = format_params_for_mcmc(params, meta, fit_par)
+    param_map = data.param_map
+    theta = param_map.pack(params)
 
     ndim, nwalkers = len(theta), meta.run_nwalkers
 
-    print('Run emcee...')
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = (params, data, model, meta, fit_par))
-    step_size = get_step_size(params, meta, fit_par)
-    pos = [theta + np.array(step_size)*np.random.randn(ndim) for i in range(nwalkers)]
-    sampler.run_mcmc(pos, meta.run_nsteps, progress=True)
-
     if not os.path.isdir(meta.workdir + meta.fitdir + '/mcmc_res'):
-        os.makedirs(meta.workdir + meta.fitdir + '/mcmc_res')
-
-    pickle.dump([data, params, sampler.chain], open(meta.workdir + meta.fitdir + '/mcmc_res/' +  "/mcmc_out_"+"{0:0.2f}".format(data.wavelength)+"_"+meta.fittime+".p", "wb"))
-    nburn = meta.run_nburn
+        os.makedirs(meta.workdir + meta.fitdir + '/mcmc_res', exist_ok=True)
+
+    # the chain is written to the HDF5 file after every step, so it is not lost if the run is killed and it does not have to be kept in memory
+    chain_file = meta.workdir + meta.fitdir + '/mcmc_res/' + "mcmc_chain_bin{0}_wvl{1:0.3f}.h5".format(meta.s30_file_counter, data.wavelength)
+    if meta.run_resume is not None:
+        resume_file = meta.run_resume + '/mcmc_res/' + os.path.basename(chain_file)
+        if not os.path.isfile(resume_file):
+            raise FileNotFoundError('Cannot resume the MCMC: {0} does not exist.'.format(resume_file))
+        # the new steps are added to a copy of the old chain, so the old run stays untouched
+        shutil.copy(resume_file, chain_file)
+    backend = emcee.backends.HDFBackend(chain_file, name='mcmc')
+
+    if meta.run_resume is not None and backend.iteration > 0:
+        print('Resuming the MCMC after step {0}'.format(backend.iteration))
+        pos = backend.get_last_sample()
+        nsteps = meta.run_nsteps - backend.iteration
+    else:
+        backend.reset(nwalkers, ndim)
+        step_size = param_map.step[param_map.free_idx]
+        pos = [theta + np.array(step_size)*np.random.randn(ndim) for i in range(nwalkers)]
+        nsteps = meta.run_nsteps
 
-    if meta.run_nsteps * meta.run_nwalkers > 1000000:
-        thin_corner = int((meta.run_nsteps - meta.run_nburn) * meta.run_nwalkers // 100000)
-        print('Note: Big Corner plot with many steps. Thinning Plot by factor: {0}'.format(thin_corner))
+    print('Run emcee...')
+    pool = make_pool(meta, init_worker, (params, data, model))
+    if pool is not None:
+        # the walkers are distributed over the workers, which already have the data and the model
+        print('Using {0} worker processes'.format(meta.run_ncpu))
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob_worker, pool=pool, backend=backend)
+    elif meta.run_vectorize:
+        # the positions of all walkers are evaluated in one call
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob_vectorized, args = (params, data, model), vectorize=True, backend=backend)
     else:
-        thin_corner = 1
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = (params, data, model), backend=backend)
+    t_start = time.time()
+    converged = None
+    try:
+        if meta.run_autocorr:
+            converged = run_until_converged(sampler, pos, nsteps, meta)
+        elif nsteps > 0:
+            sampler.run_mcmc(pos, nsteps, progress=True)
+    finally:
+        close_pool(pool)
+    walltime = time.time() - t_start
 
     labels = meta.labels
+    niter = backend.iteration
+
+    if meta.run_autocorr:
+        # burn-in and thinning as recommended by the emcee documentation
+        tau = backend.get_autocorr_time(tol=0)
+        nburn = min(int(2*np.max(tau)), niter//2)
+        thin = max(1, int(0.5*np.min(tau)))
+        if not converged:
+            print('Note: The MCMC did not converge within run_nsteps steps. The burn-in and the thinning might not be reliable.')
+    else:
+        nburn, thin = meta.run_nburn, 1
+    # the autocorrelation time and the effective sample size of the samples which are used
+    tau = backend.get_autocorr_time(discard=nburn, tol=0)
+    n_eff = (niter - nburn)*nwalkers/tau
+
+    # the burn-in and the thinning are saved with the chain, so the samples can be read again later (see util.read_mcmc_samples)
+    with h5py.File(chain_file, 'a') as f:
+        f['mcmc'].attrs['nburn'] = nburn
+        f['mcmc'].attrs['thin'] = thin
+
+    f_stats = open(meta.workdir + meta.fitdir + '/mcmc_res/' + "mcmc_stats_bin{0}_wvl{1:0.3f}.txt".format(meta.s30_file_counter, data.wavelength), 'w')
+    print('# steps: {0}, burn-in: {1}, thinning: {2}, converged: {3}, wall time: {4:0.1f} s'.format(niter, nburn, thin, converged, walltime), file=f_stats)
+    print("#{: <24} {: <25} {: <25}".format('parameter', 'tau (steps)', 'n_eff'), file=f_stats)
+    for row in zip(labels, tau, n_eff):
+        print("{: <25} {: <25} {: <25}".format(*row), file=f_stats)
+    f_stats.close()
+    print('MCMC: {0} steps, burn-in: {1}, thinning: {2}, wall time: {3:0.1f} s'.format(niter, nburn, thin, walltime))
+    print('autocorrelation times:', tau)
+    print('effective sample sizes:', n_eff)
+
+    nsamples = (niter - nburn)//thin*nwalkers
+    if nsamples > 1000000:
+        thin_corner = thin*int(nsamples // 100000)
+        print('Note: Big Corner plot with many steps. Thinning Plot by factor: {0}'.format(thin_corner))
+    else:
+        thin_corner = thin
 
-    samples = sampler.chain[:, nburn::thin_corner, :].reshape((-1, ndim))
+    samples = util.read_mcmc_chain(chain_file, nburn, thin_corner).reshape((-1, ndim))
     plots.mcmc_pairs(samples, params, meta, fit_par, data)
-    plots.mcmc_chains(ndim, sampler, 0, labels, meta)
-    plots.mcmc_chains(ndim, sampler, nburn, labels, meta)
+    plots.mcmc_chains(ndim, chain_file, 0, labels, meta)
+    plots.mcmc_chains(ndim, chain_file, nburn, labels, meta)
 
     # medians = []
     # errors_lower = []
@@ -265,7 +149,7 @@ def mcmc_fit(data, model, params, file_name, meta, fit_par):
             q = quantile(samples[:, i], [0.16, 0.5, 0.84])
             medians.append(q[1])
 
-    updated_params = format_params_for_Model(medians, params, meta, fit_par)
+    updated_params = param_map.unpack(medians, params)
     fit = model.fit(data, updated_params)
     #print(fit.rms)
     plots.plot_fit_lc2(data, fit, meta, mcmc=True)
@@ -273,6 +157,31 @@ def mcmc_fit(data, model, params, file_name, meta, fit_par):
     #return data.wavelength, medians[0], errors_mean, samples
 
 
+def run_until_converged(sampler, pos, nsteps, meta, check_interval=100):
+    """
+    Runs the sampler for at most nsteps steps and stops it as soon as the chains have converged.
+
+    Every check_interval steps, the integrated autocorrelation time tau of every parameter is estimated.
+    The chains are considered converged if they are longer than run_autocorr_factor times tau
+    and tau changed by less than the fraction run_autocorr_rtol since the last estimate.
+
+    Returns
+    ----------
+    converged: bool
+        True if the sampler was stopped because the chains converged
+    """
+    old_tau = np.inf
+    for sample in sampler.sample(pos, iterations=nsteps, progress=True):
+        if sampler.iteration % check_interval:
+            continue
+        tau = sampler.get_autocorr_time(tol=0)
+        if np.all(meta.run_autocorr_factor*tau < sampler.iteration) and np.all(np.abs(old_tau - tau) < meta.run_autocorr_rtol*tau):
+            print('The chains converged after {0} steps'.format(sampler.iteration))
+            return True
+        old_tau = tau
+    return False
+
+
 def lnprior(theta, data):
     lnprior_prob = 0.
     n = len(data.prior)
@@ -290,8 +199,8 @@ def lnprior(theta, data):
     
 
 
-def lnprob(theta, params, data, model, meta, fit_par):
-    updated_params = format_params_for_Model(theta, params, meta, fit_par)
+def lnprob(theta, params, data, model):
+    updated_params = data.param_map.unpack(theta, params)
     #print('updated_params', updated_params[12*5:14*5])
     fit = model.fit(data, updated_params)
     #print('fit', fit)
@@ -301,6 +210,50 @@ def lnprob(theta, params, data, model, meta, fit_par):
 
 
 
+def lnprior_vectorized(theta, data):
+    """
+    Log-prior of the (nwalkers, ndim) array theta. Every parameter is evaluated for all walkers at once.
+    """
+    lnprior_prob = np.zeros(len(theta))
+    for i in range(len(data.prior)):
+        if data.prior[i][0] == 'U':
+            outside = np.logical_or(theta[:, i] < data.prior[i][1], theta[:, i] > data.prior[i][2])
+            lnprior_prob[outside] += - np.inf
+        if data.prior[i][0] == 'N':
+            lnprior_prob -= 0.5*(((theta[:, i] - data.prior[i][1])/data.prior[i][2])**2 +
+              np.log(2.0*np.pi*(data.prior[i][2])**2))
+    return lnprior_prob
+
+
+def lnprob_vectorized(theta, params, data, model):
+    """
+    Log-probability of the (nwalkers, ndim) array theta (used by emcee with vectorize=True).
+    """
+    theta = np.atleast_2d(theta)
+    updated_params = data.param_map.unpack(theta, params)
+    return model.ln_like_batch(data, updated_params) + lnprior_vectorized(theta, data)
+
+
+
+worker_args = None
+
+
+def init_worker(params, data, model):
+    """
+    Stores the arguments of lnprob in the worker process, so they are not sent again with every set of parameters.
+    """
+    global worker_args
+    worker_args = (params, data, model)
+
+
+def lnprob_worker(theta):
+    """
+    lnprob in a worker process (see init_worker).
+    """
+    return lnprob(theta, *worker_args)
+
+
+
 #mcmc_fit
 #format_params_for_mcmc
 #mcmc_fit
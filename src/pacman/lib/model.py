@@ -2,11 +2,13 @@ import sys
 sys.path.insert(0, './models')
 import numpy as np
 from ..lib.formatter import FormatParams
-from ..lib.functions import Functions
+from ..lib.functions import Functions, vectorized_sys
 
-def calc_astro(t, params, data, funcs, visit):
+def calc_astro(t, params, data, funcs, visit, out=None):
 
-    flux = np.ones_like(t)
+    #the model is multiplied into out if an (preallocated) array is given
+    flux = np.ones_like(t) if out is None else out
+    if out is not None: flux.fill(1.)
     for i, f in enumerate(funcs.astro): 
         #selects parameters to pass to function
         funcparams = [params[j:j + data.nvisit] for j in funcs.astro_porder[i]]
@@ -14,9 +16,11 @@ def calc_astro(t, params, data, funcs, visit):
 
     return flux 
 
-def calc_sys(t, params, data, funcs, visit):
+def calc_sys(t, params, data, funcs, visit, out=None):
 
-    flux = np.ones_like(t)
+    #the model is multiplied into out if an (preallocated) array is given
+    flux = np.ones_like(t) if out is None else out
+    if out is not None: flux.fill(1.)
     for i, f in enumerate(funcs.sys): 
         #selects parameters to pass to function
         funcparams = [params[j: j + data.nvisit] for j in funcs.sys_porder[i]]
@@ -24,12 +28,39 @@ def calc_sys(t, params, data, funcs, visit):
 
     return flux 
 
+def calc_gp(params, data, funcs, resid):
+
+    #correlated noise: the Gaussian process is evaluated for the residuals of every visit relative to the mean flux of the visit
+    #returns the prediction of the Gaussian process (in flux) and the residuals for the fits, whose sum of squares is
+    #resid^T (S + C)^-1 resid + log det(S + C) - log det S (see models/gp_exp.py)
+    gp_model = np.zeros_like(resid)
+    gp_resid = []
+    for visit in range(data.nvisit):
+        s = data.vis_slice[visit]
+        norm = np.mean(data.flux[s])
+        funcparams = [params[j:j + data.nvisit] for j in funcs.gp_porder]
+        mean, whitened, logdet = funcs.gp(data.vis_time[visit], resid[s]/norm, data.err[s]/norm, funcparams, visit)
+        gp_model[s] = mean*norm
+        gp_resid += [whitened, [np.sqrt(max(logdet, 0.))]]
+
+    return gp_model, np.concatenate(gp_resid)
+
 class Model:
     """
     Stores model fit and related parameters
     """
     def __init__(self, data, myfuncs):
-        npoints = len(data.time)
+        self.myfuncs = Functions(data, myfuncs)
+        self.resize(data)
+
+
+    def resize(self, data):
+        """
+        Allocates the arrays of the model for the data.npoints exposures of the light curve.
+
+        Called again after outliers were clipped (see Data.clip). Only the per-point arrays are reallocated, the functions (myfuncs) are kept.
+        """
+        npoints = data.npoints
 
         self.model = np.zeros(npoints)
         self.model_sys = np.zeros(npoints)
@@ -38,6 +69,12 @@ class Model:
         self.phase = np.zeros(npoints)
         self.resid = np.zeros(npoints)
         self.norm_resid = np.zeros(npoints)
+        self.data_nosys = np.zeros(npoints)
+        self.all_sys = np.zeros(npoints)
+        self.model_gp = np.zeros(npoints)
+        self.gp_resid = None
+        self._buffer = np.zeros(npoints)
+        self._buffer2 = np.zeros(npoints)
         self.chi2 = 0.
         self.chi2red = 0.
         self.rms = 0.
@@ -46,40 +83,152 @@ class Model:
         self.ln_like = 0.
         self.bic = 0.
         self.params = []
-        self.myfuncs = Functions(data, myfuncs)
+        return self
 
 
     def fit(self, data, params):
         #print(params)
         #loop over each observation
+        #the visits are contiguous slices of the light curve (see data.vis_slice), so the results are written directly into the preallocated arrays
         for visit in range(data.nvisit):
-            #FIXME don't do this every time fit is run
-            ind = data.vis_num == visit
-
-            #t = data.time[ind]
-            t = data.time
+            s = data.vis_slice[visit]
+            t = data.vis_time[visit]
             per  = params[data.par_order['per']*data.nvisit + visit]
             t0  = params[data.par_order['t0']*data.nvisit + visit] + data.toffset
-            self.phase[ind] = (t[ind] - t0)/per - np.floor((t[ind] - t0)/per)
-            self.model_sys[ind] = calc_sys(t[ind], params, data, self.myfuncs, visit)
-            self.model_astro[ind] = calc_astro(t[ind], params, data, self.myfuncs, visit)
+            phase = (t - t0)/per
+            self.phase[s] = phase - np.floor(phase)
+            if isinstance(s, slice):
+                calc_sys(t, params, data, self.myfuncs, visit, out=self.model_sys[s])
+                calc_astro(t, params, data, self.myfuncs, visit, out=self.model_astro[s])
+            else:
+                self.model_sys[s] = calc_sys(t, params, data, self.myfuncs, visit)
+                self.model_astro[s] = calc_astro(t, params, data, self.myfuncs, visit)
 
         self.phase[self.phase > 0.5] -= 1.      #centers phase around 0 for transits
 
         self.params = params
-        self.model = self.model_sys*self.model_astro
-        self.data_nosys = data.flux/self.model_sys
-        self.norm_flux = data.flux/self.model
-        self.all_sys = data.flux/self.model_astro
-        self.resid = data.flux - self.model
-        self.norm_resid = self.resid/data.flux
-        self.chi2 = np.sum((self.resid/data.err)**2)		
+        np.multiply(self.model_sys, self.model_astro, out=self.model)
+        np.divide(data.flux, self.model_sys, out=self.data_nosys)
+        np.divide(data.flux, self.model, out=self.norm_flux)
+        np.divide(data.flux, self.model_astro, out=self.all_sys)
+        np.subtract(data.flux, self.model, out=self.resid)
+        np.divide(self.resid, data.flux, out=self.norm_resid)
+
+        chi = self._buffer
+        np.divide(self.resid, data.err, out=chi)
+        np.square(chi, out=chi)
+        self.chi2 = np.sum(chi)
         self.chi2red = self.chi2/data.dof
-        self.rms = 1.0e6*np.sqrt(np.mean((self.resid/data.flux)**2))
-        self.ln_like = (-0.5*(np.sum((self.resid/data.err)**2 
-            + np.log(2.0*np.pi*(data.err)**2)))
-        )
+        self.rms = 1.0e6*np.sqrt(np.mean(np.square(self.norm_resid, out=self._buffer2)))
+        np.square(data.err, out=self._buffer2)
+        self._buffer2 *= 2.0*np.pi
+        np.log(self._buffer2, out=self._buffer2)
+        if self.myfuncs.gp is None:
+            chi += self._buffer2
+            self.ln_like = -0.5*np.sum(chi)
+        else:
+            #the residuals are correlated, chi2 above still assumes white noise
+            self.model_gp, self.gp_resid = calc_gp(params, data, self.myfuncs, self.resid)
+            self.ln_like = -0.5*(np.sum(np.square(self.gp_resid)) + np.sum(self._buffer2))
         self.bic = -2.*self.ln_like + data.nfree_param*np.log(data.npoints)
         return self
 
 
+    def ln_like_batch(self, data, params):
+        """
+        Calculates the log-likelihood for a batch of parameter vectors at once (e.g., the positions of all emcee walkers).
+
+        params has the shape (nbatch, nparams). Every parameter is passed to the systematics models as a (nbatch, 1) column,
+        so the models in functions.vectorized_sys broadcast to (nbatch, npoints) and are evaluated for all parameter vectors in one call.
+        The other systematics models, the astrophysical models (batman only takes scalar parameters) and the Gaussian process are evaluated for one parameter vector after the other.
+        The results are the same as Model.fit(data, params[k]).ln_like for every k.
+
+        Returns
+        ----------
+        ln_like: numpy array
+            log-likelihood of every parameter vector
+        """
+        params = np.atleast_2d(params)
+        nbatch = len(params)
+        columns = params.T[:, :, None]
+        model = np.empty((nbatch, len(data.time)))
+        for visit in range(data.nvisit):
+            s = data.vis_slice[visit]
+            t = data.vis_time[visit]
+            model_sys = np.ones((nbatch, len(t)))
+            for i, f in enumerate(self.myfuncs.sys):
+                if f in vectorized_sys:
+                    funcparams = [columns[j:j + data.nvisit] for j in self.myfuncs.sys_porder[i]]
+                    model_sys *= f(t, data, funcparams, visit)
+                else:
+                    for k in range(nbatch):
+                        funcparams = [params[k, j:j + data.nvisit] for j in self.myfuncs.sys_porder[i]]
+                        model_sys[k] *= f(t, data, funcparams, visit)
+            model_astro = np.empty_like(model_sys)
+            for k in range(nbatch):
+                calc_astro(t, params[k], data, self.myfuncs, visit, out=model_astro[k])
+            model[:, s] = model_sys*model_astro
+
+        if self.myfuncs.gp is not None:
+            resid = data.flux - model
+            gp_resid = [calc_gp(params[k], data, self.myfuncs, resid[k])[1] for k in range(nbatch)]
+            return -0.5*(np.sum(np.square(gp_resid), axis=1) + np.sum(np.log(np.square(data.err)*(2.0*np.pi))))
+
+        chi = (data.flux - model)/data.err
+        np.square(chi, out=chi)
+        chi += np.log(np.square(data.err)*(2.0*np.pi))
+        return -0.5*np.sum(chi, axis=1)
+
+    def jacobian(self, data, params, free, step):
+        """
+        Calculates the partial derivatives of the model with respect to the parameters.
+
+        The model is the product of the systematics and astrophysical models, so the derivative with respect to a parameter of
+        one of the models is the derivative of that model times all other models.
+        The derivatives of the systematics models are calculated analytically if they are given in functions.Functions.sys_deriv.
+        For the other models (e.g., transit and eclipse) forward differences of only that model are used.
+
+        Parameters
+        -----------
+        params: numpy array
+            parameters
+        free: numpy array
+            boolean array, the derivatives are only calculated for the parameters which are True
+        step: numpy array
+            steps used for the finite differences
+
+        Returns
+        ----------
+        jac: numpy array
+            (npoints, nparams) array with the partial derivatives of the model (zero for the parameters which are not free)
+        """
+        funcs = self.myfuncs
+        allfuncs = funcs.sys + funcs.astro
+        porders = funcs.sys_porder + funcs.astro_porder
+        derivs = funcs.sys_deriv + [None]*len(funcs.astro)
+
+        jac = np.zeros((len(data.time), len(params)))
+        for visit in range(data.nvisit):
+            s = data.vis_slice[visit]
+            t = data.vis_time[visit]
+            funcparams = [[params[j:j + data.nvisit] for j in porder] for porder in porders]
+            values = [f(t, data, funcparams[i], visit)*np.ones_like(t) for i, f in enumerate(allfuncs)]
+            for i, f in enumerate(allfuncs):
+                #index of every parameter of the function for this visit
+                idx = [j + visit for j in porders[i]]
+                if not np.any(free[idx]): continue
+                others = np.ones_like(t)
+                for k in range(len(allfuncs)):
+                    if k != i: others *= values[k]
+                if derivs[i] is not None:
+                    dfunc = derivs[i](t, data, funcparams[i], visit)
+                for n, j in enumerate(idx):
+                    if not free[j]: continue
+                    if derivs[i] is not None:
+                        jac[s, j] += others*dfunc[n]
+                    else:
+                        params_step = np.copy(params)
+                        params_step[j] += step[j]
+                        value_step = f(t, data, [params_step[jj:jj + data.nvisit] for jj in porders[i]], visit)
+                        jac[s, j] += others*(value_step - values[i])/step[j]
+        return jac
@@ -1,143 +1,293 @@
-# ! /usr/bin/env python
-import sys
-sys.path.insert(0,'..')
-import numpy as np
-import itertools
-
-"""ramp effect model
-2 means two types of traps
-
-original author: Daniel Apai
-
-Version 0.3 fixing trapping parameters
-
-Version 0.2.1 introduce two types of traps, slow traps and fast traps
-
-Version 0.2: add extra keyword parameter to indicate scan or staring
-mode observations for staring mode, the detector receive flux in the
-same rate during overhead time as that during exposure
-precise mathematics forms are included
-
-Version 0.1: Adapted original IDL code to python by Yifan Zhou
-
-"""
-
-
-def ackbar(t, data, params, visit = 0):
-    """Hubble Space Telescope ramp effect model
-
-    Parameters:
-    cRates -- intrinsic count rate of each exposures, unit e/s
-    tExp -- start time of every exposures
-    expTime -- (default 180 seconds) exposure time of the time series
-    trap_pop -- (default 0) number of occupied traps at the beginning of the observations
-    dTrap -- (default [0])number of extra trap added between two orbits
-    dt0 -- (default 0) possible exposures before very beginning, e.g.,
-     guiding adjustment
-    lost -- (default 0, no lost) proportion of trapped electrons that are not eventually detected
-    (mode) -- (default scanning, scanning or staring, or others), for scanning mode
-      observation , the pixel no longer receive photons during the overhead
-      time, in staring mode, the pixel keps receiving elctrons
-    """
-    trap_pop_s, trap_pop_f, dTrap_s, dTrap_f = params
-
-    trap_pop_s = trap_pop_s[visit]
-    trap_pop_f = trap_pop_f[visit]
-    dTrap_s = dTrap_s[visit]
-    dTrap_f = dTrap_f[visit]
-
-    #print trap_pop_s, trap_pop_f
-    #t = data.time[idx]
-
-    mean = 12173979.5                                                           
-    cRates = 328.1*np.ones_like(t)#*np.mean(data.flux)/mean
-    #cRates = 316.*np.ones_like(t)#*np.mean(data.flux)/mean
-
-    tExp = (t - t[0])*24.*60.*60.
-
-    exptime = data.exp_time
-    dt0=0
-    lost=0
-    mode='scanning'
-
-
-    #nTrap_s = 1525.38  # 1320.0
-    #eta_trap_s = 0.013318  # 0.01311
-    nTrap_s = 1525.38  # 1320.0
-    eta_trap_s = 0.013318  # 0.01311
-    tau_trap_s = 1.63e4
-    nTrap_f = 162.38
-    eta_trap_f = 0.008407
-    tau_trap_f = 281.463
-    try:
-        dTrap_f = itertools.cycle(dTrap_f)
-        dTrap_s = itertools.cycle(dTrap_s)
-        dt0 = itertools.cycle(dt0)
-    except TypeError:
-        # if dTrap, dt0 provided in scala, convert them to list
-        dTrap_f = itertools.cycle([dTrap_f])
-        dTrap_s = itertools.cycle([dTrap_s])
-        dt0 = itertools.cycle([dt0])
-    obsCounts = np.zeros(len(tExp))
-    # ensure initial values do not exceed the total trap numbers
-    trap_pop_s = min(trap_pop_s, nTrap_s)
-    trap_pop_f = min(trap_pop_f, nTrap_f)
-
-    #print "trap_pop_f", trap_pop_f
-
-    for i in range(len(tExp)):
-        try:
-            dt = tExp[i+1] - tExp[i]
-        except IndexError:
-            dt = exptime
-        f_i = cRates[i]
-        c1_s = eta_trap_s * f_i / nTrap_s + 1 / tau_trap_s  # a key factor
-        c1_f = eta_trap_f * f_i / nTrap_f + 1 / tau_trap_f
-        # number of trapped electron during one exposure
-        dE1_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * exptime))
-        dE1_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * exptime))
-        dE1_s = min(trap_pop_s + dE1_s, nTrap_s) - trap_pop_s
-        dE1_f = min(trap_pop_f + dE1_f, nTrap_f) - trap_pop_f
-        trap_pop_s = min(trap_pop_s + dE1_s, nTrap_s)
-        trap_pop_f = min(trap_pop_f + dE1_f, nTrap_f)
-        obsCounts[i] = f_i * exptime - dE1_s - dE1_f
-        if dt < 5 * exptime:  # whether next exposure is in next batch of exposures
-            # same orbits
-            if mode == 'scanning':
-                # scanning mode, no incoming flux between exposures
-                dE2_s = - trap_pop_s * (1 - np.exp(-(dt - exptime)/tau_trap_s))
-                dE2_f = - trap_pop_f * (1 - np.exp(-(dt - exptime)/tau_trap_f))
-            elif mode == 'staring':
-                # for staring mode, there is flux between exposures
-                dE2_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * (dt - exptime)))
-                dE2_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * (dt - exptime)))
-            else:
-                # others, same as scanning
-                dE2_s = - trap_pop_s * (1 - np.exp(-(dt - exptime)/tau_trap_s))
-                dE2_f = - trap_pop_f * (1 - np.exp(-(dt - exptime)/tau_trap_f))
-            trap_pop_s = min(trap_pop_s + dE2_s, nTrap_s)
-            trap_pop_f = min(trap_pop_f + dE2_f, nTrap_f)
-        elif dt < 1200:
-            # considering in-orbit buffer download scenario
-            if mode == 'staring':
-                trap_pop_s = min(trap_pop_s * np.exp(-(dt-exptime)/tau_trap_s), nTrap_s)
-                trap_pop_f = min(trap_pop_f * np.exp(-(dt-exptime)/tau_trap_f), nTrap_f)
-        else:
-            # switch orbit
-            dt0_i = next(dt0)
-            trap_pop_s = min(trap_pop_s * np.exp(-(dt-exptime-dt0_i)/tau_trap_s) + next(dTrap_s), nTrap_s)
-            trap_pop_f = min(trap_pop_f * np.exp(-(dt-exptime-dt0_i)/tau_trap_f) + next(dTrap_f), nTrap_f)
-            f_i = cRates[i + 1]
-            c1_s = eta_trap_s * f_i / nTrap_s + 1 / tau_trap_s  # a key factor
-            c1_f = eta_trap_f * f_i / nTrap_f + 1 / tau_trap_f
-            dE3_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * dt0_i))
-            dE3_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * dt0_i))
-            dE3_s = min(trap_pop_s + dE3_s, nTrap_s) - trap_pop_s
-            dE3_f = min(trap_pop_f + dE3_f, nTrap_f) - trap_pop_f
-            trap_pop_s = min(trap_pop_s + dE3_s, nTrap_s)
-            trap_pop_f = min(trap_pop_f + dE3_f, nTrap_f)
-        trap_pop_s = max(trap_pop_s, 0)
-        trap_pop_f = max(trap_pop_f, 0)
-
-    return (obsCounts/np.max(obsCounts))
-
+# ! /usr/bin/env python
+import sys
+sys.path.insert(0,'..')
+import numpy as np
+import itertools
+from collections import OrderedDict
+
+"""ramp effect model
+2 means two types of traps
+
+original author: Daniel Apai
+
+Version 0.3 fixing trapping parameters
+
+Version 0.2.1 introduce two types of traps, slow traps and fast traps
+
+Version 0.2: add extra keyword parameter to indicate scan or staring
+mode observations for staring mode, the detector receive flux in the
+same rate during overhead time as that during exposure
+precise mathematics forms are included
+
+Version 0.1: Adapted original IDL code to python by Yifan Zhou
+
+"""
+
+
+# number of traps, trapping efficiency and trapping timescale (s) of the slow and the fast traps
+nTrap = np.array([1525.38, 162.38])
+eta_trap = np.array([0.013318, 0.008407])
+tau_trap = np.array([1.63e4, 281.463])
+
+# intrinsic count rate of the exposures (e/s)
+cRate = 328.1
+
+# AckbarPlan objects which were already computed (least recently used first), keyed on the time array and the exposure time
+_plans = OrderedDict()
+_max_plans = 32
+
+
+class AckbarPlan:
+    """
+    Everything in the ramp model which only depends on the times of the exposures.
+
+    With a constant count rate in scanning mode, every step of the trap population recurrence in ackbar_reference is affine:
+    during an exposure the population relaxes towards the equilibrium value A = eta*f/c1 and between the exposures of an orbit it decays.
+    The coefficients of these steps do not depend on the fitted parameters.
+    Within an orbit the population therefore is x_k = P_k*x_start + Q_k, where x_start is the population at the beginning of the orbit.
+    The clipping of the population to [0, nTrap] can only matter at the start of an orbit
+    (A < nTrap, so a population in [0, nTrap] stays in this range during the orbit).
+    The only exception is a negative initial population, which is set to zero after the first exposure (coefficients R).
+    """
+    def __init__(self, t, exptime):
+        n = len(t)
+        tExp = (t - t[0])*24.*60.*60.
+        dt = np.append(np.diff(tExp), exptime)
+        f = cRate*np.ones(n)
+
+        c1 = eta_trap[:, None]*f/nTrap[:, None] + 1/tau_trap[:, None]
+        self.A = eta_trap[:, None]*f/c1
+        self.one_minus_e1 = 1 - np.exp(-c1*exptime)
+        self.counts = f*exptime
+
+        same_orbit = dt < 5*exptime
+        switch = ~same_orbit & (dt >= 1200)
+        # decay between the exposures of an orbit (no decay during a buffer download in scanning mode)
+        decay = np.where(same_orbit, np.exp(-(dt - exptime)/tau_trap[:, None]), 1.)
+
+        iswitch = np.flatnonzero(switch)
+        self.starts = np.concatenate([[0], iswitch + 1])
+        self.ends = np.concatenate([iswitch + 1, [n]])
+        self.switch_decay = np.exp(-(dt[iswitch] - exptime)/tau_trap[:, None])
+
+        self.P, self.Q = np.zeros((2, n)), np.zeros((2, n))
+        self.Pend, self.Qend = np.zeros((2, len(self.starts))), np.zeros((2, len(self.starts)))
+        for i, (s, e) in enumerate(zip(self.starts, self.ends)):
+            self.Pend[:, i], self.Qend[:, i] = self._propagate(s, e, 1., 0., decay, self.P, self.Q)
+        self.R = np.zeros((2, n))
+        _, self.Rend = self._propagate(1, self.ends[0], 0., 0., decay, np.zeros((2, n)), self.R)
+
+    def _propagate(self, s, e, p, q, decay, P, Q):
+        """
+        Coefficients of the population at the exposures s to e-1 of an orbit (stored in P and Q) and after the last exposure (returned).
+        """
+        for k in range(s, e):
+            P[:, k], Q[:, k] = p, q
+            p = p*(1 - self.one_minus_e1[:, k])
+            q = q + (self.A[:, k] - q)*self.one_minus_e1[:, k]
+            if k < e - 1:
+                p, q = p*decay[:, k], q*decay[:, k]
+        return p, q
+
+
+def get_plan(t, exptime):
+    """
+    Returns the AckbarPlan for the times t.
+
+    The plan is cached and reused whenever the ramp is calculated for the same times again (e.g., in every step of a fit).
+    """
+    t = np.ascontiguousarray(t)
+    key = (t.tobytes(), exptime)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = AckbarPlan(t, exptime)
+        _plans[key] = plan
+        if len(_plans) > _max_plans:
+            _plans.popitem(last=False)
+    else:
+        #least recently used plans are removed first
+        _plans.move_to_end(key)
+    return plan
+
+
+def reserve(n):
+    """
+    Makes room for at least n plans in the cache, e.g., for every light curve and visit of a joint fit.
+    """
+    global _max_plans
+    _max_plans = max(_max_plans, n)
+
+
+def ackbar(t, data, params, visit = 0):
+    """Hubble Space Telescope ramp effect model
+
+    Same model as ackbar_reference, but the trap populations of all exposures in an orbit are calculated at once
+    from coefficients which only depend on the times of the exposures (see AckbarPlan).
+    Only the start of every orbit is calculated one after the other.
+
+    Parameters:
+    trap_pop_s, trap_pop_f -- number of occupied slow and fast traps at the beginning of the observations
+    dTrap_s, dTrap_f -- number of extra slow and fast traps added between two orbits
+    """
+    trap_pop_s, trap_pop_f, dTrap_s, dTrap_f = params
+    plan = get_plan(t, data.exp_time)
+
+    # ensure initial values do not exceed the total trap numbers
+    x_start = np.minimum([trap_pop_s[visit], trap_pop_f[visit]], nTrap)
+    dTrap = np.array([dTrap_s[visit], dTrap_f[visit]])
+
+    trap_pop = np.empty_like(plan.P)
+    for i, (s, e) in enumerate(zip(plan.starts, plan.ends)):
+        trap_pop[:, s:e] = plan.P[:, s:e]*x_start[:, None] + plan.Q[:, s:e]
+        x_end = plan.Pend[:, i]*x_start + plan.Qend[:, i]
+        if i == 0 and e - s > 1:
+            # a negative initial population is set to zero after the first exposure
+            clipped = trap_pop[:, 1] < 0
+            trap_pop[clipped, 1:e] = plan.R[clipped, 1:e]
+            x_end[clipped] = plan.Rend[clipped]
+        if i < len(plan.starts) - 1:
+            # switch orbit
+            x_start = np.maximum(np.minimum(x_end*plan.switch_decay[:, i] + dTrap, nTrap), 0)
+
+    dE1 = (plan.A - trap_pop)*plan.one_minus_e1
+    obsCounts = plan.counts - dE1[0] - dE1[1]
+
+    return (obsCounts/np.max(obsCounts))
+
+
+def ackbar_reference(t, data, params, visit = 0):
+    """Hubble Space Telescope ramp effect model (reference implementation with a loop over the exposures)
+
+    Parameters:
+    cRates -- intrinsic count rate of each exposures, unit e/s
+    tExp -- start time of every exposures
+    expTime -- (default 180 seconds) exposure time of the time series
+    trap_pop -- (default 0) number of occupied traps at the beginning of the observations
+    dTrap -- (default [0])number of extra trap added between two orbits
+    dt0 -- (default 0) possible exposures before very beginning, e.g.,
+     guiding adjustment
+    lost -- (default 0, no lost) proportion of trapped electrons that are not eventually detected
+    (mode) -- (default scanning, scanning or staring, or others), for scanning mode
+      observation , the pixel no longer receive photons during the overhead
+      time, in staring mode, the pixel keps receiving elctrons
+    """
+    trap_pop_s, trap_pop_f, dTrap_s, dTrap_f = params
+
+    trap_pop_s = trap_pop_s[visit]
+    trap_pop_f = trap_pop_f[visit]
+    dTrap_s = dTrap_s[visit]
+    dTrap_f = dTrap_f[visit]
+
+    #print trap_pop_s, trap_pop_f
+    #t = data.time[idx]
+
+    mean = 12173979.5                                                           
+    cRates = 328.1*np.ones_like(t)#*np.mean(data.flux)/mean
+    #cRates = 316.*np.ones_like(t)#*np.mean(data.flux)/mean
+
+    tExp = (t - t[0])*24.*60.*60.
+
+    exptime = data.exp_time
+    dt0=0
+    lost=0
+    mode='scanning'
+
+
+    #nTrap_s = 1525.38  # 1320.0
+    #eta_trap_s = 0.013318  # 0.01311
+    nTrap_s = 1525.38  # 1320.0
+    eta_trap_s = 0.013318  # 0.01311
+    tau_trap_s = 1.63e4
+    nTrap_f = 162.38
+    eta_trap_f = 0.008407
+    tau_trap_f = 281.463
+    try:
+        dTrap_f = itertools.cycle(dTrap_f)
+        dTrap_s = itertools.cycle(dTrap_s)
+        dt0 = itertools.cycle(dt0)
+    except TypeError:
+        # if dTrap, dt0 provided in scala, convert them to list
+        dTrap_f = itertools.cycle([dTrap_f])
+        dTrap_s = itertools.cycle([dTrap_s])
+        dt0 = itertools.cycle([dt0])
+    obsCounts = np.zeros(len(tExp))
+    # ensure initial values do not exceed the total trap numbers
+    trap_pop_s = min(trap_pop_s, nTrap_s)
+    trap_pop_f = min(trap_pop_f, nTrap_f)
+
+    #print "trap_pop_f", trap_pop_f
+
+    for i in range(len(tExp)):
+        try:
+            dt = tExp[i+1] - tExp[i]
+        except IndexError:
+            dt = exptime
+        f_i = cRates[i]
+        c1_s = eta_trap_s * f_i / nTrap_s + 1 / tau_trap_s  # a key factor
+        c1_f = eta_trap_f * f_i / nTrap_f + 1 / tau_trap_f
+        # number of trapped electron during one exposure
+        dE1_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * exptime))
+        dE1_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * exptime))
+        dE1_s = min(trap_pop_s + dE1_s, nTrap_s) - trap_pop_s
+        dE1_f = min(trap_pop_f + dE1_f, nTrap_f) - trap_pop_f
+        trap_pop_s = min(trap_pop_s + dE1_s, nTrap_s)
+        trap_pop_f = min(trap_pop_f + dE1_f, nTrap_f)
+        obsCounts[i] = f_i * exptime - dE1_s - dE1_f
+        if dt < 5 * exptime:  # whether next exposure is in next batch of exposures
+            # same orbits
+            if mode == 'scanning':
+                # scanning mode, no incoming flux between exposures
+                dE2_s = - trap_pop_s * (1 - np.exp(-(dt - exptime)/tau_trap_s))
+                dE2_f = - trap_pop_f * (1 - np.exp(-(dt - exptime)/tau_trap_f))
+            elif mode == 'staring':
+                # for staring mode, there is flux between exposures
+                dE2_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * (dt - exptime)))
+                dE2_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * (dt - exptime)))
+            else:
+                # others, same as scanning
+                dE2_s = - trap_pop_s * (1 - np.exp(-(dt - exptime)/tau_trap_s))
+                dE2_f = - trap_pop_f * (1 - np.exp(-(dt - exptime)/tau_trap_f))
+            trap_pop_s = min(trap_pop_s + dE2_s, nTrap_s)
+            trap_pop_f = min(trap_pop_f + dE2_f, nTrap_f)
+        elif dt < 1200:
+            # considering in-orbit buffer download scenario
+            if mode == 'staring':
+                trap_pop_s = min(trap_pop_s * np.exp(-(dt-exptime)/tau_trap_s), nTrap_s)
+                trap_pop_f = min(trap_pop_f * np.exp(-(dt-exptime)/tau_trap_f), nTrap_f)
+        else:
+            # switch orbit
+            dt0_i = next(dt0)
+            trap_pop_s = min(trap_pop_s * np.exp(-(dt-exptime-dt0_i)/tau_trap_s) + next(dTrap_s), nTrap_s)
+            trap_pop_f = min(trap_pop_f * np.exp(-(dt-exptime-dt0_i)/tau_trap_f) + next(dTrap_f), nTrap_f)
+            f_i = cRates[i + 1]
+            c1_s = eta_trap_s * f_i / nTrap_s + 1 / tau_trap_s  # a key factor
+            c1_f = eta_trap_f * f_i / nTrap_f + 1 / tau_trap_f
+            dE3_s = (eta_trap_s * f_i / c1_s - trap_pop_s) * (1 - np.exp(-c1_s * dt0_i))
+            dE3_f = (eta_trap_f * f_i / c1_f - trap_pop_f) * (1 - np.exp(-c1_f * dt0_i))
+            dE3_s = min(trap_pop_s + dE3_s, nTrap_s) - trap_pop_s
+            dE3_f = min(trap_pop_f + dE3_f, nTrap_f) - trap_pop_f
+            trap_pop_s = min(trap_pop_s + dE3_s, nTrap_s)
+            trap_pop_f = min(trap_pop_f + dE3_f, nTrap_f)
+        trap_pop_s = max(trap_pop_s, 0)
+        trap_pop_f = max(trap_pop_f, 0)
+
+    return (obsCounts/np.max(obsCounts))
+
+
+if __name__ == '__main__':
+    # benchmark of ackbar against the loop in ackbar_reference (python -m pacman.lib.models.ackbar)
+    import timeit
+    from types import SimpleNamespace
+
+    exptime = 103.
+    # 4 orbits with 18 exposures each
+    t = np.concatenate([i*96*60 + np.arange(18)*(exptime + 20) for i in range(4)])/86400.
+    data = SimpleNamespace(exp_time=exptime)
+    params = [np.array([v]) for v in (100., 20., 50., 30.)]
+
+    diff = np.max(np.abs(ackbar(t, data, params) - ackbar_reference(t, data, params)))
+    n = 1000
+    t_ref = timeit.timeit(lambda: ackbar_reference(t, data, params), number=n)/n
+    t_vec = timeit.timeit(lambda: ackbar(t, data, params), number=n)/n
+    print('max. difference: {0:.2e}'.format(diff))
+    print('ackbar_reference: {0:.1f} us, ackbar: {1:.1f} us, speedup: {2:.1f}'.format(t_ref*1e6, t_vec*1e6, t_ref/t_vec))
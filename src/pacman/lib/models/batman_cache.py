@@ -0,0 +1,55 @@
+import batman
+import numpy as np
+from collections import OrderedDict
+
+# batman.TransitModel objects which were already initialized (least recently used first), keyed on the time array, exposure time, supersampling and transit type
+_models = OrderedDict()
+_max_models = 32
+
+
+def get_transit_model(p, t, exp_time, transittype="primary", supersample_factor=3):
+    """
+    Returns a batman.TransitModel for the times t.
+
+    Initializing a TransitModel computes the supersampled time array, which is slow compared to calculating the light curve itself.
+    The models are therefore cached and reused whenever a light curve is calculated for the same times again (e.g., in every step of a fit).
+    model.light_curve(p) recalculates everything which depends on the transit parameters, so the light curve is the same as with a new model.
+
+    Parameters
+    -----------
+    p: batman.TransitParams
+        transit parameters. Only used when a new model has to be initialized
+    t: numpy array
+        times
+    exp_time: float
+        exposure time in days
+    transittype: str
+        "primary" or "secondary"
+    supersample_factor: int
+        number of supersampled points per exposure
+
+    Returns
+    ----------
+    m: batman.TransitModel
+        model for the times t
+    """
+    t = np.ascontiguousarray(t)
+    key = (t.tobytes(), exp_time, supersample_factor, transittype, p.limb_dark)
+    m = _models.get(key)
+    if m is None:
+        m = batman.TransitModel(p, t, transittype=transittype, supersample_factor=supersample_factor, exp_time=exp_time)
+        _models[key] = m
+        if len(_models) > _max_models:
+            _models.popitem(last=False)
+    else:
+        #least recently used models are removed first
+        _models.move_to_end(key)
+    return m
+
+
+def reserve(n):
+    """
+    Makes room for at least n models in the cache, e.g., for every light curve and visit of a joint fit.
+    """
+    global _max_models
+    _max_models = max(_max_models, n)
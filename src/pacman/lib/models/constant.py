@@ -9,3 +9,13 @@ def constant(t, data, params, visit = 0):
     C = 10.**C
 
     return 1. + C*np.ones_like(t)
+
+
+def constant_deriv(t, data, params, visit = 0):
+    """
+    Partial derivative of constant with respect to its parameter.
+    """
+    C = params
+    C = C[0][visit]
+
+    return [np.log(10.)*10.**C*np.ones_like(t)]
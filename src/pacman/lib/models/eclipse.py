@@ -1,4 +1,5 @@
 import batman
+from .batman_cache import get_transit_model
 
 def eclipse(t, data, params, visit = 0.):
     p = batman.TransitParams()
@@ -24,7 +25,7 @@ def eclipse(t, data, params, visit = 0.):
     p.limb_dark = 'quadratic'
     p.u = [0.1, 0.2]
     
-    m = batman.TransitModel(
-        p, t, transittype = "secondary", supersample_factor=3, exp_time = data.exp_time/24./60./60.
-    )
+    #the model is only initialized once for every time array and reused afterwards
+    m = get_transit_model(p, t, data.exp_time/24./60./60., transittype = "secondary", supersample_factor=3)
+    p.t0 = m.get_t_conjunction(p)
     return m.light_curve(p)
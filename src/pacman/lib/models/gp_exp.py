@@ -0,0 +1,64 @@
+import sys
+sys.path.insert(0,'..')
+import numpy as np
+from scipy.linalg import cholesky_banded, cho_solve_banded
+
+def gp_exp(t, resid, err, params, visit = 0):
+    """
+    Gaussian process with the exponential (Ornstein-Uhlenbeck) kernel k(dt) = gp_amp**2 exp(-|dt|/gp_tau) for correlated noise.
+
+    The kernel is the real term of celerite. Its covariance matrix C is semiseparable and the inverse Q of C is tridiagonal,
+    because the process is Markovian. With the white noise S = diag(err**2) of the residuals the likelihood only needs the
+    tridiagonal matrix M = Q + S^-1:
+        resid^T (S + C)^-1 resid = min_x [(resid - x)^T S^-1 (resid - x) + x^T Q x], with M x = S^-1 resid
+        log det(S + C) = log det S + log det C + log det M
+    M is factorized with a banded Cholesky decomposition, so the cost grows linearly with the number of exposures.
+
+    Parameters
+    -----------
+    t: numpy array
+        times in days (increasing)
+    resid: numpy array
+        residuals (relative to the mean flux of the visit)
+    err: numpy array
+        uncertainties of the residuals
+    params: list
+        gp_amp (amplitude relative to the mean flux) and gp_tau (time scale in days)
+
+    Returns
+    ----------
+    mean: numpy array
+        prediction of the Gaussian process for the residuals (x)
+    whitened: numpy array
+        2N values with whitened @ whitened = resid^T (S + C)^-1 resid
+    logdet: float
+        log det(S + C) - log det S (always >= 0)
+    """
+    gp_amp, gp_tau = params
+    a = gp_amp[visit]**2
+    tau = np.abs(gp_tau[visit])
+    n = len(t)
+    if a == 0. or n == 0:
+        return np.zeros(n), np.concatenate([resid/err, np.zeros(n)]), 0.
+
+    # the process is x_0 ~ N(0, a) and x_k = phi_k x_k-1 + N(0, v_k) with phi_k = exp(-(t_k - t_k-1)/tau)
+    phi = np.exp(-np.diff(t)/tau)
+    v = a*(1. - phi**2)
+
+    # upper banded form of M = Q + S^-1
+    w = 1./err**2
+    ab = np.zeros((2, n))
+    ab[0, 1:] = -phi/v
+    ab[1] = w
+    ab[1, 0] += 1./a
+    ab[1, 1:] += 1./v
+    ab[1, :-1] += phi**2/v
+    cb = cholesky_banded(ab)
+    mean = cho_solve_banded((cb, False), w*resid)
+
+    whitened = np.empty(2*n)
+    whitened[:n] = (resid - mean)/err
+    whitened[n] = mean[0]/np.sqrt(a)
+    whitened[n+1:] = (mean[1:] - phi*mean[:-1])/np.sqrt(v)
+    logdet = np.log(a) + np.sum(np.log(v)) + 2.*np.sum(np.log(cb[1]))
+    return mean, whitened, logdet
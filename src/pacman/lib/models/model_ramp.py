@@ -8,7 +8,23 @@ def model_ramp(t, data, params, visit = 0):
     r2 = r2[visit]
     r3 = r3[visit]
 
-    t_orb = data.t_orb[data.vis_idx[visit]]
-    t_delay = data.t_delay[data.vis_idx[visit]]
+    t_orb = data.vis_t_orb[visit]
+    t_delay = data.vis_t_delay[visit]
 
     return 1.0 - np.exp(-r1*t_orb - r2 - r3*t_delay)
+
+
+def model_ramp_deriv(t, data, params, visit = 0):
+    """
+    Partial derivatives of model_ramp with respect to its parameters.
+    """
+    r1, r2, r3 = params
+    r1 = r1[visit]
+    r2 = r2[visit]
+    r3 = r3[visit]
+
+    t_orb = data.vis_t_orb[visit]
+    t_delay = data.vis_t_delay[visit]
+
+    ramp = np.exp(-r1*t_orb - r2 - r3*t_delay)
+    return [t_orb*ramp, ramp, t_delay*ramp]
@@ -6,6 +6,15 @@ def polynomial1(t, data, params, visit = 0):
     v = params
     v = v[0][visit]
 
-    t_vis = data.t_vis[data.vis_idx[visit]]
+    t_vis = data.vis_t_vis[visit]
 
     return 1. + v*t_vis
+
+
+def polynomial1_deriv(t, data, params, visit = 0):
+    """
+    Partial derivative of polynomial1 with respect to its parameter.
+    """
+    t_vis = data.vis_t_vis[visit]
+
+    return [t_vis]
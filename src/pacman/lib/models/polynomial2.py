@@ -7,6 +7,15 @@ def polynomial2(t, data, params, visit = 0):
     v = v[visit]
     v2 = v2[visit]
 
-    idx = data.vis_idx[visit]
+    t_vis = data.vis_t_vis[visit]
 
-    return 1. + v*data.t_vis[idx] + v2*(data.t_vis[idx])**2
+    return 1. + v*t_vis + v2*(t_vis)**2
+
+
+def polynomial2_deriv(t, data, params, visit = 0):
+    """
+    Partial derivatives of polynomial2 with respect to its parameters.
+    """
+    t_vis = data.vis_t_vis[visit]
+
+    return [t_vis, t_vis**2]
@@ -30,7 +30,7 @@ def sine2(t, data, params, visit):
 
     TWOPI = np.pi*2.
 
-    t_vis = data.t_vis[data.vis_idx[visit]]
+    t_vis = data.vis_t_vis[visit]
 
     if t[0] < 2456300.:
         return ( 1. + a1*np.sin(TWOPI*omega1*t_vis) + phi1*np.cos(TWOPI*omega1*t_vis)
@@ -44,3 +44,26 @@ def sine2(t, data, params, visit):
                )
 
            
+
+
+def sine2_deriv(t, data, params, visit):
+    """
+    Partial derivatives of sine2 with respect to its parameters.
+    Only the parameters of the sines which are used for the times t have non-zero derivatives.
+    """
+    TWOPI = np.pi*2.
+
+    t_vis = data.vis_t_vis[visit]
+    zero = np.zeros_like(t_vis)
+
+    derivs = []
+    for a, omega, phi in zip(params[0::3], params[1::3], params[2::3]):
+        a, omega, phi = a[visit], omega[visit], phi[visit]
+        sin = np.sin(TWOPI*omega*t_vis)
+        cos = np.cos(TWOPI*omega*t_vis)
+        derivs.append([sin, TWOPI*t_vis*(a*cos - phi*sin), cos])
+
+    if t[0] < 2456300.:
+        return derivs[0] + derivs[1] + derivs[2] + [zero]*9
+    else:
+        return [zero]*9 + derivs[3] + derivs[4] + derivs[5]
@@ -1,4 +1,5 @@
 import batman
+from .batman_cache import get_transit_model
 
 def transit(t, data, params, visit = 0):
     p = batman.TransitParams()
@@ -18,7 +19,6 @@ def transit(t, data, params, visit = 0):
     p.w = w[visit]
     p.u = [u1[visit], u2[visit]]
 
-    m = batman.TransitModel(
-    p, t, supersample_factor=3, exp_time = data.exp_time/24./60./60.
-    )
+    #the model is only initialized once for every time array and reused afterwards
+    m = get_transit_model(p, t, data.exp_time/24./60./60., supersample_factor=3)
     return m.light_curve(p)
@@ -6,4 +6,11 @@ def upstream_downstream(t, data, params, visit = 0):
     scale = params
     scale = scale[0][visit]
 
-    return 1. + scale*data.scan_direction[data.vis_idx[visit]]
+    return 1. + scale*data.vis_scan_direction[visit]
+
+
+def upstream_downstream_deriv(t, data, params, visit = 0):
+    """
+    Partial derivative of upstream_downstream with respect to its parameter.
+    """
+    return [data.vis_scan_direction[visit]]
@@ -1527,22 +1527,21 @@ class mpfit:
 			mperr = 0
 			fjac = numpy.zeros(nall, dtype=float)
 			fjac[ifree] = 1.0  # Specify which parameters need derivatives
-			[status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+			[status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+			if status < 0:
+				return None
 
-			if len(fjac) != m*nall:
+			pderiv = numpy.asarray(pderiv, dtype=float)
+			if pderiv.size != m*nall:
 				print('ERROR: Derivative matrix was not computed properly.')
 				return None
 
 			# This definition is consistent with CURVEFIT
 			# Sign error found (thanks Jesus Fernandez <fernande@irm.chu-caen.fr>)
-			fjac.shape = [m,nall]
-			fjac = -fjac
+			fjac = -pderiv.reshape(m, nall)
 
 			# Select only the free parameters
-			if len(ifree) < nall:
-				fjac = fjac[:,ifree]
-				fjac.shape = [m, n]
-				return fjac
+			return fjac[:, ifree]
 
 		fjac = numpy.zeros([m, n], dtype=float)
 
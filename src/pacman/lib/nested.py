@@ -1,12 +1,17 @@
 import numpy as np
+import os
 import pickle
+import shutil
+import time
 from datetime import datetime
 from scipy.stats import norm
+from scipy.special import ndtri
 import dynesty
 import inspect
 from dynesty import plotting as dyplot
 import matplotlib.pyplot as plt
 import corner
+from .pool import make_pool, close_pool
 
 
 def name_and_args():
@@ -23,68 +28,9 @@ def transform_uniform(x,a,b):
 def transform_normal(x,mu,sigma):
     return norm.ppf(x,loc=mu,scale=sigma)
 
-def format_params_for_mcmc(params, meta, fit_par):	#FIXME: make sure this works for cases when nvisit>1
-    nvisit = int(meta.nvisit)
-    theta = []
-
-    if meta.fit_par_new == False:
-        for i in range(len(fit_par)):
-                if fit_par['fixed'][i].lower() == "false":
-                        if fit_par['tied'][i].lower() == "true": theta.append(params[i*nvisit])
-                        else:
-                                for j in range(nvisit): theta.append(params[i*nvisit+j])
-    else:
-        ii = 0
-        for i in range(int(len(params)/nvisit)):
-                if fit_par['fixed'][ii].lower() == "false":
-                        if str(fit_par['tied'][ii]) == "-1":
-                            theta.append(params[i*nvisit])
-                            ii = ii + 1
-                        else:
-                            for j in range(nvisit):
-                                theta.append(params[i*nvisit+j])
-                                ii = ii + 1
-                else:
-                    ii = ii + 1
-
-    return np.array(theta)
-
-
-
-def labels_gen(params, meta, fit_par):
-    nvisit = int(meta.nvisit)
-    labels = []
-
-    if meta.fit_par_new == False:
-        for i in range(len(fit_par)):
-                if fit_par['fixed'][i].lower() == "false":
-                        if fit_par['tied'][i].lower() == "true": labels.append(fit_par['parameter'][i])
-                        else:
-                                for j in range(nvisit): labels.append(fit_par['parameter'][i]+str(j))
-    else:
-        ii = 0
-        for i in range(int(len(params)/nvisit)):
-                if fit_par['fixed'][ii].lower() == "false":
-                        if str(fit_par['tied'][ii]) == "-1":
-                            labels.append(fit_par['parameter'][ii])
-                            ii = ii + 1
-                        else:
-                            for j in range(nvisit):
-                                labels.append(fit_par['parameter'][ii]+str(j))
-                                ii = ii + 1
-                else:
-                    ii = ii + 1
-
-    #print('labels', labels)
-    return labels
-
-
-
-
-
 def mcmc_output(samples, params, meta, fit_par, data):	#FIXME: make sure this works for cases when nvisit>1
     nvisit = int(meta.nvisit)
-    labels = labels_gen(params, meta, fit_par)
+    labels = meta.labels
 
     fig = corner.corner(samples, labels=labels, show_titles=True)
     current_time = datetime.now().time()
@@ -92,66 +38,73 @@ def mcmc_output(samples, params, meta, fit_par, data):	#FIXME: make sure this wo
     fig.savefig(figname)
 
 
-def format_params_for_Model(theta, params, meta, fit_par):
-    nvisit = int(meta.nvisit)
-    params_updated = []
-    iter = 0									#this should be a more informative name FIXME
-    if meta.fit_par_new == False:
-        for i in range(len(fit_par)):
-                if fit_par['fixed'][i].lower() == "true":
-                        for j in range(nvisit):
-                                params_updated.append(params[i*nvisit+j])
-                else:
-                        if fit_par['tied'][i].lower() == "true":
-                                for j in range(nvisit): params_updated.append(theta[iter])
-                                iter += 1
-                        else:
-                                for j in range(nvisit):
-                                        params_updated.append(theta[iter])
-                                        iter += 1
-    else:
-        ii = 0
-        for i in range(int(len(params)/nvisit)):
-                if fit_par['fixed'][ii].lower() == "true":
-                        for j in range(nvisit):
-                                params_updated.append(params[i*nvisit+j])
-                        ii = ii + 1
-                else:
-                        if str(fit_par['tied'][ii]) == "-1":
-                                for j in range(nvisit): params_updated.append(theta[iter])
-                                iter += 1
-                                ii = ii + 1
-                        else:
-                                for j in range(nvisit):
-                                        params_updated.append(theta[iter])
-                                        iter += 1
-                                        ii = ii + 1
-
-    return np.array(params_updated)
-
 def nested_sample(data, model, params, file_name, meta, fit_par):
-    x = format_params_for_mcmc(params, meta, fit_par)
-
-    ndim = len(x) 
-
-    l_args = [params, data, model, meta, fit_par]
-    p_args = [data]
-    
-    #dsampler = dynesty.DynamicNestedSampler(loglike, ptform, ndim,
-    #                                        logl_args = l_args,
-    #                                       ptform_args = p_args,
-    #                                        update_interval=float(ndim))
-    #dsampler.run_nested(wt_kwargs={'pfrac': 1.0})#, maxiter = 20000)
-    #results = dsampler.results
-
-    sampler = dynesty.NestedSampler(loglike, ptform, ndim, logl_args = l_args,ptform_args = p_args,update_interval=float(ndim), nlive=meta.run_nlive)
-    sampler.run_nested(dlogz=meta.run_dlogz)
+    ndim = data.param_map.nfree
+
+    # the prior transform is only set up once
+    prior_transform = PriorTransform(data.prior)
+    l_args = [params, data, model]
+
+    if not os.path.isdir(meta.workdir + meta.fitdir + '/nested_res'):
+        os.makedirs(meta.workdir + meta.fitdir + '/nested_res', exist_ok=True)
+
+    # dynesty saves its state in the checkpoint file every run_nested_checkpoint seconds, so a run which was killed can be resumed
+    checkpoint_file = meta.workdir + meta.fitdir + '/nested_res/' + "nested_checkpoint_bin{0}_wvl{1:0.3f}.save".format(meta.s30_file_counter, data.wavelength)
+    if meta.run_resume is not None:
+        resume_file = meta.run_resume + '/nested_res/' + os.path.basename(checkpoint_file)
+        if not os.path.isfile(resume_file):
+            raise FileNotFoundError('Cannot resume the nested sampling: {0} does not exist.'.format(resume_file))
+        # the run is continued in a copy of the old checkpoint, so the old run stays untouched
+        shutil.copy(resume_file, checkpoint_file)
+
+    if meta.run_nested_dynamic:
+        # after the initial run, batches of live points are added where they improve the posterior most (pfrac=1)
+        Sampler = dynesty.DynamicNestedSampler
+        run_kwargs = dict(nlive_init=meta.run_nlive, dlogz_init=meta.run_dlogz, wt_kwargs={'pfrac': 1.0})
+    else:
+        Sampler = dynesty.NestedSampler
+        run_kwargs = dict(dlogz=meta.run_dlogz)
+    if meta.run_nested_checkpoint is not None:
+        run_kwargs.update(checkpoint_file=checkpoint_file, checkpoint_every=meta.run_nested_checkpoint)
+
+    pool = make_pool(meta, init_worker, l_args)
+    if pool is not None:
+        # the workers already have the data and the model, so only the parameters are sent to them.
+        # run_ncpu new live points are proposed at once and evaluated in parallel
+        print('Using {0} worker processes'.format(meta.run_ncpu))
+    else:
+        # a run which used a pool is resumed with loglike_worker, which then needs the arguments in this process
+        init_worker(*l_args)
+    t_start = time.time()
+    try:
+        if meta.run_resume is not None:
+            print('Resuming the nested sampling from {0}'.format(resume_file))
+            sampler = Sampler.restore(checkpoint_file, pool=pool)
+            sampler.run_nested(resume=True, **run_kwargs)
+        elif pool is not None:
+            sampler = Sampler(loglike_worker, prior_transform, ndim, update_interval=float(ndim), nlive=meta.run_nlive, pool=pool, queue_size=meta.run_ncpu)
+            sampler.run_nested(**run_kwargs)
+        else:
+            sampler = Sampler(loglike, prior_transform, ndim, logl_args = l_args, update_interval=float(ndim), nlive=meta.run_nlive)
+            sampler.run_nested(**run_kwargs)
+    finally:
+        close_pool(pool)
+    walltime = time.time() - t_start
     results = sampler.results
 
-    pickle.dump(results, open( "nested_results.p", "wb" ) )
+    # wall time (of this run, without an earlier run which was resumed) and number of likelihood calls
+    ncall = int(np.sum(results.ncall))
+    f_stats = open(meta.workdir + meta.fitdir + '/nested_res/' + "nested_stats_bin{0}_wvl{1:0.3f}.txt".format(meta.s30_file_counter, data.wavelength), 'w')
+    print('# iterations: {0}, likelihood calls: {1}, efficiency: {2:0.2f} %, wall time: {3:0.1f} s, dynamic: {4}, resumed: {5}'.format(
+        results.niter, ncall, results.eff, walltime, bool(meta.run_nested_dynamic), meta.run_resume is not None), file=f_stats)
+    print('logz: {0} +/- {1}'.format(results.logz[-1], results.logzerr[-1]), file=f_stats)
+    f_stats.close()
+    print('Nested sampling: {0} iterations, {1} likelihood calls, wall time: {2:0.1f} s'.format(results.niter, ncall, walltime))
+
+    pickle.dump(results, open(meta.workdir + meta.fitdir + "/nested_results_bin{0}_{1}.p".format(meta.s30_file_counter, meta.fittime), "wb"))
     results.summary()
 
-    labels = labels_gen(params, meta, fit_par)
+    labels = meta.labels
 
 
     # Plot a summary of the run.
@@ -162,26 +115,60 @@ def nested_sample(data, model, params, file_name, meta, fit_par):
     #plt.savefig(meta.workdir + meta.fitdir + '/nested_traceplot_' + meta.fittime + '.png')
     # Plot the 2-D marginalized posteriors.
     cfig, caxes = dyplot.cornerplot(results, show_titles=True, title_fmt='.4',labels=labels, color='blue', hist_kwargs=dict(facecolor='blue', edgecolor='blue'))
-    plt.savefig(meta.workdir + meta.fitdir + '/nested_cornerplot_' + meta.fittime + '.png')
+    plt.savefig(meta.workdir + meta.fitdir + '/nested_cornerplot_bin{0}_{1}.png'.format(meta.s30_file_counter, meta.fittime))
     #plt.show()
 
 
     return 0.
 
 
-def ptform(u, data):
-    p = np.zeros_like(u) 
-    n = len(data.prior)
-    for i in range(n):
-        if data.prior[i][0] == 'U':  p[i] = transform_uniform(u[i], 
-                                            data.prior[i][1],data.prior[i][2])
-        if data.prior[i][0] == 'N':  p[i] = transform_normal(u[i], 
-                                            data.prior[i][1],data.prior[i][2])
-    return p
-    
-
-
-def loglike(x, params, data, model, meta, fit_par):
-    updated_params = format_params_for_Model(x, params, meta, fit_par)
+class PriorTransform:
+    """
+    Transforms the unit cube to the free parameters for dynesty.
+
+    The uniform and the normal priors in data.prior are sorted into index arrays once,
+    so every call transforms all parameters with the same kind of prior in one array operation.
+    Parameters with another kind of prior are set to zero.
+    """
+    def __init__(self, prior):
+        kind = np.array([p[0] for p in prior])
+        p1 = np.array([p[1] for p in prior], dtype=float)
+        p2 = np.array([p[2] for p in prior], dtype=float)
+        self.idx_uniform = np.flatnonzero(kind == 'U')
+        self.idx_normal = np.flatnonzero(kind == 'N')
+        self.lower, self.upper = p1[self.idx_uniform], p2[self.idx_uniform]
+        self.mu, self.sigma = p1[self.idx_normal], p2[self.idx_normal]
+
+    def __call__(self, u):
+        p = np.zeros_like(u)
+        p[..., self.idx_uniform] = transform_uniform(u[..., self.idx_uniform], self.lower, self.upper)
+        # same as norm.ppf(u, loc=mu, scale=sigma) without the argument checks of scipy.stats
+        p[..., self.idx_normal] = ndtri(u[..., self.idx_normal])*self.sigma + self.mu
+        return p
+
+
+def loglike(x, params, data, model):
+    """
+    Log-likelihood of the free parameters x.
+    """
+    updated_params = data.param_map.unpack(x, params)
     fit = model.fit(data, updated_params)
     return fit.ln_like 
+
+
+worker_args = None
+
+
+def init_worker(params, data, model):
+    """
+    Stores the arguments of loglike in the worker process, so they are not sent again with every set of parameters.
+    """
+    global worker_args
+    worker_args = (params, data, model)
+
+
+def loglike_worker(x):
+    """
+    loglike in a worker process (see init_worker).
+    """
+    return loglike(x, *worker_args)
@@ -1,4 +1,5 @@
 import scipy.signal
+import scipy.ndimage
 import numpy as np
 import matplotlib.pyplot as plt
 #from pylab import *
@@ -20,6 +21,40 @@ def smooth(x, nsmooth):
 	return scipy.signal.medfilt(x, nsmooth)				#median filters the data
 
 
+def smooth_rows(x, nsmooth):
+	"""
+	Vectorized version of smooth(): applies smooth() to every row (last axis) of the array x at once.
+	x can have any number of leading dimensions (e.g., a stack of several up-the-ramp reads).
+	The result is identical to calling smooth() row by row.
+	"""
+	x = np.array(x)
+	ncol = x.shape[-1]
+	cols = np.arange(ncol)
+	#interpolates over masked values in the rows which contain zeros and have a positive sum
+	#(the sum is accumulated sequentially in float64 like the builtin sum() in smooth())
+	rows = (x==0).any(axis=-1) & (np.cumsum(x, axis=-1, dtype=float)[..., -1] > 0)
+	if rows.any():
+		xr = x[rows]
+		gpix = xr != 0.0
+		#index of the previous and next good pixel for every pixel in the row
+		prev = np.maximum.accumulate(np.where(gpix, cols, -1), axis=-1)
+		nxt = np.minimum.accumulate(np.where(gpix, cols, ncol)[:, ::-1], axis=-1)[:, ::-1]
+		first, last = nxt[:, :1], prev[:, -1:]
+		#outside of the good pixels the value of the first/last good pixel is used (like in np.interp)
+		prev = np.where(prev < 0, first, prev)
+		nxt = np.where(nxt >= ncol, last, nxt)
+		y_prev = np.take_along_axis(xr, prev, axis=-1).astype(float)
+		y_next = np.take_along_axis(xr, nxt, axis=-1).astype(float)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			slope = (y_next - y_prev)/(nxt - prev)
+			interp = np.where(nxt == prev, y_prev, slope*(cols - prev) + y_prev)
+		xr[~gpix] = interp[~gpix].astype(np.float32)
+		x[rows] = xr
+	#median filters the data along the rows (zero padded at the edges like scipy.signal.medfilt)
+	size = (1,)*(x.ndim - 1) + (nsmooth,)
+	return scipy.ndimage.median_filter(x, size=size, mode='constant', cval=0.0)
+
+
 def diagnostics_plot(D, M, indmax, outlier_array, f_opt, profile, i, ii, meta):
 	indmax = np.argmax(outlier_array)			#finds biggest outlier
 	indmax = np.unravel_index(indmax, outlier_array.shape)	#converts it from flat to tuple
@@ -90,66 +125,99 @@ def optextr(D, err, f_std, var_std, M, nsmooth, sig_cut, save_optextr_plot, i_sp
 		optimally extracted spectrum and its variance
 	"""
 	#STEPS 5-8:  estimating spatial profile and removing cosmic rays
-	f_opt = np.copy(f_std)							#array to store the optimally extracted spectrum
-	outlier_array = np.zeros_like(D)					#array used to find outliers
-	outliers = True
-	numoutliers = 0								#number of outliers rejected by optimal extraction
-	while outliers == True:
+	#M[None] is a view, so the outliers are also masked in the M of the caller
+	f_opt, var_opt, numoutliers, profile, outlier_array = optextr_stack(D[None], np.asarray(err)[None], f_std, M[None], nsmooth, sig_cut)
+
+	if save_optextr_plot == True: diagnostics_plot(D, M, None, outlier_array[0], f_opt[0], profile[0], i_sp, ii_sp, meta)
+
+	return f_opt[0], var_opt[0], int(numoutliers[0])
+
+
+def optextr_stack(D, err, f_std, M, nsmooth, sig_cut):
+	"""
+	Optimally extracts a stack of spectra (e.g., all up-the-ramp reads of an exposure) at once.
+
+	The outlier rejection of every frame runs until no new outliers are found in that frame.
+	Frames which are done are not changed anymore, so the result for every frame is identical to calling optextr() on it.
+
+	Parameters
+    ----------
+	D:
+		data array with shape (nframes, nrows, ncols) (already background subtracted)
+	err:
+		error array (in addition to photon noise); same shape as D or broadcastable to it
+	f_std:
+		box-extracted spectra with shape (nframes, ncols) (or broadcastable to it)
+	M:
+		array masking bad pixels with the same shape as D; 0 is bad and 1 is good. The outliers are masked in M in place.
+	nsmooth:
+		number of pixels to smooth over to estimate the spatial profile
+	sig_cut:
+		cutoff sigma for flagging outliers
+
+	Returns
+    -------
+	f_opt, var_opt:
+		optimally extracted spectra and their variances with shape (nframes, ncols)
+	numoutliers:
+		number of outliers rejected in every frame
+	profile, outlier_array:
+		the final spatial profiles and outlier arrays with the same shape as D
+	"""
+	nframes, nrows, ncols = D.shape
+	err = np.broadcast_to(err, D.shape)
+
+	f_opt = np.copy(f_std)							#array to store the optimally extracted spectra
+	if f_opt.ndim == 1: f_opt = f_opt[None].repeat(nframes, axis=0)
+	numoutliers = np.zeros(nframes, dtype=int)				#number of outliers rejected by optimal extraction
+	active = np.ones(nframes, dtype=bool)					#frames in which outliers are still searched for
+	results = [None]*nframes
+	while active.any():
+		idx = np.nonzero(active)[0]
+		Da, Ma, erra = D[idx], M[idx], err[idx]
+		fa = f_opt[idx][:, None, :] if f_opt.ndim == 2 else f_opt	#a scalar f_std is used for all pixels
+
 		#STEP 5:  construct spatial profile
 		#interpolate over masked regions to better estimate spatial profile
-		profile = np.apply_along_axis(smooth, 1, M*D, nsmooth)
+		profile = smooth_rows(Ma*Da, nsmooth)
 
 		#enforce positivity
-		ind = profile < 0.0
-		profile[ind] = 0.0
+		profile[profile < 0.0] = 0.0
 
 		#handles case where whole column is 0
-		ind = np.where(profile.sum(axis=0)==0)
-		profile[:, ind] = 1.0				#since we normalize by column, we just need to set all the whole column equal to the same (nonzero) value
+		#since we normalize by column, we just need to set all the whole column equal to the same (nonzero) value
+		ind = np.nonzero(profile.sum(axis=1)==0)
+		profile[ind[0], :, ind[1]] = 1.0
 
 		#normalize
-		profile = profile/profile.sum(axis = 0)
-
+		profile = profile/profile.sum(axis=1)[:, None, :]
 
 		#STEP 6:  revise variance estimates
-		var = abs(f_opt*profile) + err
+		var = abs(fa*profile) + erra
 
 		#STEP 7:  mask cosmic rays/bad pixels
-		outlier_array = M*(D - (f_opt*profile))**2/var		#number of standard deviations away from expected is each pixel
-
-		maxes = np.argmax(outlier_array, axis = 0)
-		#print maxes
-		newoutliers = 0
-		for ii in range(len(maxes)):
-			ind2, ind1 = ii, maxes[ii]
-			#print ind1, ind2
-			if outlier_array[ind1, ind2] > sig_cut**2.:
-				M[ind1, ind2] = 0.0
-				numoutliers += 1
-				newoutliers += 1
-		if newoutliers == 0: outliers = False
-
-		indmax = np.argmax(outlier_array)			#finds biggest outlier
-		indmax = np.unravel_index(indmax, outlier_array.shape)	#converts it from flat to tuple
-
-		#if outlier_array[indmax] > sig_cut**2.0:
-		#	M[indmax] = 0.0					#checks to see if the pixel is an outlier > sig_cut, and if so, masks that pixel
-		#	numoutliers += 1
-		#else: outliers = False					#if not outliers, switches outliers flag to false to close loop
-
-		#STEP 8:  extract optimal spectrum
-		f_opt = ((M*profile*D/var).sum(axis = 0))/(M*profile**2/var).sum(axis=0)
-		#(M*profile)[:,0] = 0 breaks everything!
-		#((M*profile)).sum(axis = 0)=[0,1,1,1,1,...,1,1,1,1]
-		#M[:,0]*profile[:,0] = [0,0,0,0,0]
-		#       M[:,0] = [1,0,1,1,1,1,....,1,1,1,1]
-		# profile[:,0] = [0,1,0,0,0,0,....,0,0,0,0]
-		# problem occurs if eg there is only one non zero value in profile and M is zero where profile is non zero
-
-	var_opt = (M*profile).sum(axis = 0)/(M*profile**2/var).sum(axis = 0)
-
-	if save_optextr_plot == True: diagnostics_plot(D, M, indmax, outlier_array, f_opt, profile, i_sp, ii_sp, meta)
-
-	return f_opt, var_opt, numoutliers
+		outlier_array = Ma*(Da - (fa*profile))**2/var		#number of standard deviations away from expected is each pixel
 
+		#only the biggest outlier in every column is masked per iteration
+		maxes = np.argmax(outlier_array, axis=1)
+		newoutliers = np.take_along_axis(outlier_array, maxes[:, None, :], axis=1)[:, 0, :] > sig_cut**2.
+		iframe, icol = np.nonzero(newoutliers)
+		Ma[iframe, maxes[iframe, icol], icol] = 0.0
+		M[idx] = Ma
+		numoutliers[idx] += newoutliers.sum(axis=1)
 
+		#STEP 8:  extract optimal spectrum
+		fa = ((Ma*profile*Da/var).sum(axis=1))/(Ma*profile**2/var).sum(axis=1)
+		if f_opt.ndim < 2: f_opt = np.zeros((nframes, ncols), dtype=fa.dtype)
+		f_opt = f_opt.astype(np.result_type(f_opt, fa), copy=False)
+		f_opt[idx] = fa
+
+		#frames without new outliers are done
+		done = ~newoutliers.any(axis=1)
+		var_opt = (Ma*profile).sum(axis=1)/(Ma*profile**2/var).sum(axis=1)
+		for j in np.nonzero(done)[0]:
+			results[idx[j]] = (fa[j], var_opt[j], profile[j], outlier_array[j])
+		active[idx[done]] = False
+
+	f_opt, var_opt, profile, outlier_array = [np.array(res) for res in zip(*results)]
+	return f_opt, var_opt, numoutliers, profile, outlier_array
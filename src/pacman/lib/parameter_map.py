@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class ParameterMap:
+    """
+    Maps between the full parameter array used by Model.fit and the free parameters of the fits (theta).
+
+    The full array has one entry per parameter and visit: parameter i of visit j is params[i*nvisit + j].
+    A parameter with tied = -1 in fit_par has one row which is used for all visits. Its entries of the visits j > 0 are tied to the entry of the first visit.
+    Otherwise fit_par has one row per visit and the entries are independent.
+    theta contains the free entries which are not tied, in the order of the rows in fit_par.
+
+    The index arrays are built once from fit_par, so packing and unpacking the parameters is a single take or put.
+
+    Parameters
+    -----------
+    fit_par: astropy table
+        the fit parameters (fit_par.txt)
+    nvisit: int
+        number of visits
+    """
+    def __init__(self, fit_par, nvisit):
+        nvisit = int(nvisit)
+        # row of fit_par and entry to which it is tied (-1 if not tied) for every entry of the full array
+        row, tied, visit, shared_row = [], [], [], []
+        ii = 0
+        while ii < len(fit_par):
+            shared = str(fit_par['tied'][ii]) == "-1"
+            i0 = len(row)
+            for j in range(nvisit):
+                row.append(ii if shared else ii + j)
+                tied.append(i0 if shared and j > 0 else -1)
+                visit.append(j)
+                shared_row.append(shared)
+            ii += 1 if shared else nvisit
+
+        self.nvisit = nvisit
+        self.row = np.array(row)
+        self.tied = np.array(tied)
+        self.npar = len(self.row)
+
+        def column(name, dtype=float):
+            return np.array([fit_par[name][r] for r in self.row], dtype=dtype)
+
+        def is_true(name):
+            return np.char.lower(column(name, str)) == "true"
+
+        self.value = column('value')
+        self.step = column('step_size')
+        self.fixed = is_true('fixed')
+        self.lo_lim, self.hi_lim = is_true('lo_lim'), is_true('hi_lim')
+        self.lo_val = np.where(self.lo_lim, column('lo_val'), -np.inf)
+        self.hi_val = np.where(self.hi_lim, column('hi_val'), np.inf)
+
+        # free entries of the full array, in the same order as theta
+        self.free = ~self.fixed & (self.tied < 0)
+        self.free_idx = np.flatnonzero(self.free)
+        self.nfree = len(self.free_idx)
+
+        # index in theta of every entry which is free or tied to a free entry (tie broadcasting)
+        expand = -np.ones(self.npar, dtype=int)
+        expand[self.free_idx] = np.arange(self.nfree)
+        expand[self.tied >= 0] = expand[self.tied[self.tied >= 0]]
+        self.set_idx = np.flatnonzero(expand >= 0)
+        self.set_src = expand[self.set_idx]
+
+        # parameter name of every entry and labels of the free parameters. The visit is added to the parameters with one row per visit
+        self.names = np.array(fit_par['parameter'])[self.row]
+        self.labels = [self.names[k] if shared_row[k] else self.names[k] + str(visit[k]) for k in self.free_idx]
+
+    def pack(self, params):
+        """
+        Returns the free parameters theta of the full parameter array(s) params (the last axis are the parameters).
+        """
+        return np.take(params, self.free_idx, axis=-1)
+
+    def unpack(self, theta, params):
+        """
+        Returns a copy of the full parameter array params with the free parameters (and the entries tied to them) set to theta.
+        If theta is a 2d array (e.g., the positions of all walkers), a 2d array with one row of parameters per row of theta is returned.
+        """
+        theta = np.asarray(theta)
+        updated_params = np.tile(params, theta.shape[:-1] + (1,))
+        updated_params[..., self.set_idx] = theta[..., self.set_src]
+        return updated_params
+
+    def parinfo(self, params):
+        """
+        Parameter information for mpfit with the starting values params.
+        The entries which are tied to the first visit are tied with the mpfit 'tied' keyword.
+        """
+        parinfo = []
+        for k in range(self.npar):
+            par = {'value': params[k], 'fixed': self.fixed[k], 'step': self.step[k],
+                   'limited': [self.lo_lim[k], self.hi_lim[k]],
+                   'limits': [self.lo_val[k] if self.lo_lim[k] else 0., self.hi_val[k] if self.hi_lim[k] else 0.]}
+            if self.tied[k] >= 0:
+                par['tied'] = 'p[{0}]'.format(self.tied[k])
+            parinfo.append(par)
+        return parinfo
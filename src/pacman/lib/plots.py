@@ -23,6 +23,7 @@ import time
 import corner
 import pickle
 import glob
+import h5py
 from .sort_nicely import sort_nicely as sn
 from astropy.io import ascii
 from astropy.table import Table
@@ -691,6 +692,15 @@ def plot_wvl_bins(w_hires, f_interp, wave_bins, wvl_bins, dirname):
 
 
 #30
+def fit_timestamp():
+    """
+    Time stamp for the names of the files saved during a fit.
+    It includes microseconds, so the files of consecutive fits of the same light curve do not overwrite each other.
+    """
+    now = time.time()
+    return time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(now)) + '_{0:06d}'.format(int(now % 1 * 1e6))
+
+
 def plot_raw(data, meta):
     """
     Saves a plot with the raw light curve (which includes the systematics).
@@ -720,11 +730,11 @@ def plot_raw(data, meta):
         ax.legend(loc=1)
         ax.set_ylabel("Flux (e-)")
     plt.xlabel("Time after visit start (hours)")
-    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].split('.txt')[0]), fontsize=15, y=0.998)
+    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].rsplit('.', 1)[0]), fontsize=15, y=0.998)
     plt.tight_layout()
 
     if not os.path.isdir(meta.workdir + meta.fitdir + '/raw_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/raw_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/raw_lc', exist_ok=True)
     plt.savefig(meta.workdir + meta.fitdir + '/raw_lc' + "/raw_lc_{0}.png".format(meta.s30_file_counter))
     plt.close()
 
@@ -733,7 +743,7 @@ def save_plot_raw_data(data, meta):
     """
     Savest the data used for the raw light curve plot.
     """
-    datetime = time.strftime('%Y-%m-%d_%H-%M-%S')
+    datetime = fit_timestamp()
 
     table = Table()
     if data.nvisit>1:
@@ -745,7 +755,7 @@ def save_plot_raw_data(data, meta):
         table['t_vis'] = np.array(data.t_vis, dtype=np.float64)
         table['flux'] = np.array(data.flux, dtype=np.float64)
     if not os.path.isdir(meta.workdir + meta.fitdir + '/raw_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/raw_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/raw_lc', exist_ok=True)
     ascii.write(table, meta.workdir + meta.fitdir +  '/raw_lc/raw_lc_data_{0}_{1}.txt'.format(meta.s30_file_counter, datetime), format='rst', overwrite=True)
 
 
@@ -809,7 +819,7 @@ def rmsplot(model, data, meta):
     plt.yticks(size=12)
     plt.legend()
     if not os.path.isdir(meta.workdir + meta.fitdir + '/corr_plot'):
-        os.makedirs(meta.workdir + meta.fitdir + '/corr_plot')
+        os.makedirs(meta.workdir + meta.fitdir + '/corr_plot', exist_ok=True)
     plt.savefig(meta.workdir + meta.fitdir + '/corr_plot' + '/corr_plot_{0}.png'.format(meta.s30_file_counter))
     plt.close()
 
@@ -817,7 +827,7 @@ def rmsplot(model, data, meta):
 
 
 def plot_fit_lc(data, fit, meta, mcmc=False):
-    datetime = time.strftime('%Y-%m-%d_%H-%M-%S')
+    datetime = fit_timestamp()
     plt.clf()
     fig, ax = plt.subplots(2,1)
     p = FormatParams(fit.params, data)  # FIXME
@@ -885,7 +895,7 @@ def plot_fit_lc(data, fit, meta, mcmc=False):
     plt.tight_layout()
 
     if not os.path.isdir(meta.workdir + meta.fitdir + '/fit_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc', exist_ok=True)
     if mcmc:
         plt.savefig(meta.workdir + meta.fitdir + '/fit_lc' + "/mcmc_lc_{0}.png".format(meta.s30_file_counter))
     else:
@@ -895,7 +905,7 @@ def plot_fit_lc(data, fit, meta, mcmc=False):
 
 
 def plot_fit_lc2(data, fit, meta, mcmc=False):
-    datetime = time.strftime('%Y-%m-%d_%H-%M-%S')
+    datetime = fit_timestamp()
     plt.clf()
     fig, ax = plt.subplots(2,1)
     #print(fit.params)
@@ -958,11 +968,11 @@ def plot_fit_lc2(data, fit, meta, mcmc=False):
     ax[1].set_ylabel("Residuals (ppm)")
     ax[1].set_xlabel("Orbital phase")
 
-    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].split('.txt')[0]), fontsize=15, y=0.998)
+    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].rsplit('.', 1)[0]), fontsize=15, y=0.998)
 
     plt.tight_layout()
     if not os.path.isdir(meta.workdir + meta.fitdir + '/fit_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc', exist_ok=True)
     if mcmc:
         plt.savefig(meta.workdir + meta.fitdir + '/fit_lc' + "/mcmc_lc_{0}_{1}.png".format(meta.s30_file_counter, datetime))
     else:
@@ -1018,12 +1028,12 @@ def plot_fit_lc3(data, fit, meta, mcmc=False):
     ax[1].set_ylabel("Residuals (ppm)")
     ax[1].set_xlabel("Time")
 
-    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].split('.txt')[0]), fontsize=15, y=0.998)
+    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].rsplit('.', 1)[0]), fontsize=15, y=0.998)
 
     plt.tight_layout()
     #plt.show()
     if not os.path.isdir(meta.workdir + meta.fitdir + '/fit_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc', exist_ok=True)
     if mcmc:
         plt.savefig(meta.workdir + meta.fitdir + '/fit_lc' + "/newmcmc_lc_{0}.png".format(meta.s30_file_counter))
     else:
@@ -1037,7 +1047,7 @@ def save_astrolc_data(data, fit, meta):
     Saves the data used to plot the astrophysical model (without the systematics) and the data (without the systematics).
     """
 
-    datetime = time.strftime('%Y-%m-%d_%H-%M-%S')
+    datetime = fit_timestamp()
 
     table_model = Table()
     table_nosys = Table()
@@ -1054,7 +1064,7 @@ def save_astrolc_data(data, fit, meta):
     table_nosys['flux_nosys'] = np.array(fit.data_nosys, dtype=np.float64)
 
     if not os.path.isdir(meta.workdir + meta.fitdir + '/fit_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc', exist_ok=True)
     ascii.write(table_model, meta.workdir + meta.fitdir +  '/fit_lc/fit_lc_data_model_{0}_{1}.txt'.format(meta.s30_file_counter, datetime), format='rst', overwrite=True)
     ascii.write(table_nosys, meta.workdir + meta.fitdir +  '/fit_lc/fit_lc_data_nosys_{0}_{1}.txt'.format(meta.s30_file_counter, datetime), format='rst', overwrite=True)
 
@@ -1112,12 +1122,12 @@ def plot_fit_lc4(data, fit, meta, mcmc=False):
     ax[1].set_ylabel("Residuals (ppm)")
     ax[1].set_xlabel("Time")
 
-    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].split('.txt')[0]), fontsize=15, y=0.998)
+    fig.suptitle('Filename: {0}'.format(meta.run_file.split('/')[-1].rsplit('.', 1)[0]), fontsize=15, y=0.998)
 
     plt.tight_layout()
     #plt.show()
     if not os.path.isdir(meta.workdir + meta.fitdir + '/fit_lc'):
-        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc')
+        os.makedirs(meta.workdir + meta.fitdir + '/fit_lc', exist_ok=True)
     if mcmc:
         plt.savefig(meta.workdir + meta.fitdir + '/fit_lc' + "/new2mcmc_lc_{0}.png".format(meta.s30_file_counter))
     else:
@@ -1152,24 +1162,31 @@ def lsq_rprs(vals, errs, idxs, meta):
     plt.xlabel('Wavelength (micron)')
     plt.ylabel('Transit Depth (ppm)')
     if not os.path.isdir(meta.workdir + meta.fitdir + '/lsq_res'):
-        os.makedirs(meta.workdir + meta.fitdir + '/lsq_res')
+        os.makedirs(meta.workdir + meta.fitdir + '/lsq_res', exist_ok=True)
     plt.savefig(meta.workdir + meta.fitdir + '/lsq_res/' + 'lsq_rprs.png', dpi=300, bbox_inches='tight', pad_inches=0.05)
     plt.close()
 
 
-def mcmc_chains(ndim, sampler, nburn, labels, meta):
+def mcmc_chains(ndim, chain_file, nburn, labels, meta, max_steps=2000):
     """
-    Plots the temporal evolution of the MCMC chain.
+    Plots the temporal evolution of the MCMC chain saved in chain_file.
+    Long chains are thinned, so at most max_steps steps are read and plotted.
     """
+    with h5py.File(chain_file, 'r') as f:
+        niter = f['mcmc'].attrs['iteration']
+    thin = max(1, (niter - nburn) // max_steps)
+    chain = util.read_mcmc_chain(chain_file, nburn, thin)
+    steps = np.arange(nburn, niter, thin)
+
     plt.clf()
     fig, axes = plt.subplots(ndim, 1, sharex=True, figsize=(8, ndim))
     if ndim > 1:
         for i in range(0, ndim):
-            axes[i].plot(sampler.chain[:, nburn:, i].T, alpha=0.4)
+            axes[i].plot(steps, chain[:, :, i], alpha=0.4)
             # axes[i].yaxis.set_major_locator(MaxNLocator(5))
             axes[i].set_ylabel(labels[i])
     elif ndim == 1:
-        axes.plot(sampler.chain[:, nburn:, 0].T, alpha=0.4)
+        axes.plot(steps, chain[:, :, 0], alpha=0.4)
         # axes.yaxis.set_major_locator(MaxNLocator(5))
         axes.set_ylabel(labels)
     fig.tight_layout()
@@ -1197,7 +1214,7 @@ def mcmc_rprs(meta):
     Plots the spectrum (rprs vs wvl) as resulting from the MCMC.
     """
 
-    files_mcmc_res = glob.glob(os.path.join(meta.workdir + meta.fitdir + '/mcmc_res', "mcmc_out_*.p"))
+    files_mcmc_res = glob.glob(os.path.join(meta.workdir + meta.fitdir + '/mcmc_res', "mcmc_chain_*.h5"))
     files_mcmc_res = sn(files_mcmc_res)
 
     medians = []
@@ -1205,12 +1222,9 @@ def mcmc_rprs(meta):
     errors_upper = []
 
     for f in files_mcmc_res:
-        handle = open(f, 'rb')
-        data, params, chain = pickle.load(handle)
-        ndim = chain.shape[-1]
-        samples = chain[:, meta.run_nburn:, :].reshape((-1, ndim))
         # TODO samples[:, 1] has to be fixeD!!!!!
-        q = quantile(samples[:, 1], [0.16, 0.5, 0.84])
+        samples = util.read_mcmc_samples(f, idx=1).ravel()
+        q = quantile(samples, [0.16, 0.5, 0.84])
         medians.append(q[1])
         errors_lower.append(abs(q[1] - q[0]))
         errors_upper.append(abs(q[2] - q[1]))
@@ -0,0 +1,43 @@
+import multiprocessing as mp
+
+
+def make_pool(meta, initializer, initargs):
+    """
+    Creates the pool of worker processes used by emcee and dynesty.
+
+    The worker processes are initialized with initializer(*initargs), so the data and the model are only sent once to every worker.
+    Afterwards only the parameters are sent to the workers for every evaluation of the likelihood.
+
+    With run_mpi True, an mpi4py pool is used instead of multiprocessing (the pipeline has to be started with ``mpiexec ... python -m mpi4py.futures``).
+
+    Returns
+    ----------
+    pool: multiprocessing.Pool or mpi4py.futures.MPIPoolExecutor
+        pool of workers or None if the samplers should run in the current process
+    """
+    if not meta.run_mpi and meta.run_ncpu <= 1:
+        return None
+    # processes of the s30 pool (s30_ncpu > 1) are not allowed to have children
+    if mp.current_process().daemon:
+        print('Note: s30_ncpu > 1, so the sampler is not parallelized (run_ncpu is ignored).')
+        return None
+    if meta.run_mpi:
+        try:
+            from mpi4py.futures import MPIPoolExecutor
+        except ImportError:
+            raise ImportError('run_mpi is True but mpi4py is not installed. Install it with "pip install mpi4py".')
+        return MPIPoolExecutor(initializer=initializer, initargs=initargs)
+    return mp.Pool(processes=meta.run_ncpu, initializer=initializer, initargs=initargs)
+
+
+def close_pool(pool):
+    """
+    Waits for the workers of the pool to finish and shuts them down.
+    """
+    if pool is None:
+        return
+    if isinstance(pool, mp.pool.Pool):
+        pool.close()
+        pool.join()
+    else:
+        pool.shutdown()
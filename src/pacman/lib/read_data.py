@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import ascii
 import itertools
+from . import cube
+from .parameter_map import ParameterMap
 
 
 class Data:
@@ -26,7 +28,11 @@ class Data:
                 return prior
 
 	    #read in data
-        d = ascii.read(data_file)
+        # the binary light curves (.h5) are memory-mapped. ECSV files (.txt) are still supported for older runs
+        if data_file.endswith('.h5'):
+            d = cube.read_cube_table(data_file)
+        else:
+            d = ascii.read(data_file)
 
         iorbit_sp = meta.iorbit_sp
 
@@ -115,37 +121,16 @@ class Data:
             if fit_par['fixed'][i].lower() == "false":
                 nfree_param += 1
 
-        # The following is for removal of sigma clipped data in the light curve
-        # Running this part the first time; clip_idx will always be emtpy
-        # After performing the least sq it will decide to clip or not and then possible run this here again
-        idx_array = np.arange(len(time), dtype=int)
-        #print('readdata:', clip_idx)
-        if len(clip_idx) == 0: clip_mask = idx_array
-        else:clip_mask = np.bitwise_and.reduce([idx_array!=i for i in clip_idx])
-
-        self.time = time[clip_mask]
-        #print(len(time[clip_mask]))
-        self.flux = flux[clip_mask]
-        print('median log10 raw flux:', np.log10(np.median(flux[clip_mask])))
-        self.err = err[clip_mask]
         self.wavelength = meta.wavelength
         self.exp_time = np.median(np.diff(time))*60*60*24 #for supersampling in batman.py
         self.toffset = float(meta.toffset)
         self.nvisit = nvisit ###
-        self.vis_num = vis_num[clip_mask] ###
-        self.orb_num = orb_num[clip_mask] ###
-        self.scan_direction = scan_direction[clip_mask]
-        self.t_vis = t_vis[clip_mask]
-        self.t_orb = t_orb[clip_mask]
-        self.t_delay = t_delay[clip_mask]
         self.parnames = remove_dupl(fit_par['parameter'])
         #print('self.parnames ', self.parnames )
         par_order = {line: i for i, line in enumerate(self.parnames)}
         #print('par_order', par_order)
         self.par_order = par_order
         self.nfree_param = nfree_param
-        self.npoints = len(self.time)
-        self.dof = self.npoints  - nfree_param
         #TODO: Q: Any need for lc_type?
         self.lc_type = meta.lc_type
         self.all_sys = None
@@ -156,13 +141,73 @@ class Data:
         #plt.show()
 
         self.prior = format_prior_for_mcmc(self, meta, fit_par)
+        # free, fixed and tied parameters of the fits (built after the limb darkening was fixed above)
+        self.param_map = ParameterMap(fit_par, nvisit)
 
-        self.vis_idx = []
-        for i in range(nvisit): self.vis_idx.append(self.vis_num == i)
-        #print(self.vis_idx)
+        # The following is for removal of sigma clipped data in the light curve
+        # The full light curve is kept in memory and valid marks the exposures which were not clipped.
+        # Clipping outliers (see clip) only updates the mask, the file is not read again
+        self._full = dict(time=time, flux=flux, err=err, vis_num=vis_num, orb_num=orb_num, scan_direction=scan_direction,
+                          t_vis=t_vis, t_orb=t_orb, t_delay=t_delay)
+        self.valid = np.ones(len(time), dtype=bool)
+        self.valid[np.asarray(clip_idx, dtype=int)] = False
+        self.apply_mask()
+        print('median log10 raw flux:', np.log10(np.median(self.flux)))
         #FIXME
         #self.white_systematics = np.genfromtxt("white_systematics.txt")
 
+    def clip(self, clip_idx):
+        """
+        Removes the exposures clip_idx from the light curve.
+
+        clip_idx are indices into the current (already clipped) light curve, e.g., the outliers found by lsq_fit.
+        The exposures are marked as invalid, so the mask only grows with every clipping iteration.
+        """
+        self.valid[np.flatnonzero(self.valid)[clip_idx]] = False
+        self.apply_mask()
+
+    def apply_mask(self):
+        """
+        Selects the valid exposures of the light curve and prepares the arrays used by the models.
+        """
+        valid = self.valid
+        self.time = self._full['time'][valid]
+        self.flux = self._full['flux'][valid]
+        self.err = self._full['err'][valid]
+        self.vis_num = self._full['vis_num'][valid] ###
+        self.orb_num = self._full['orb_num'][valid] ###
+        self.scan_direction = self._full['scan_direction'][valid]
+        self.t_vis = self._full['t_vis'][valid]
+        self.t_orb = self._full['t_orb'][valid]
+        self.t_delay = self._full['t_delay'][valid]
+        self.npoints = len(self.time)
+        self.dof = self.npoints  - self.nfree_param
+
+        self.vis_idx = []
+        for i in range(self.nvisit): self.vis_idx.append(self.vis_num == i)
+        #print(self.vis_idx)
+
+        # evaluation plan for the model: the exposures are in time order, so every visit is a contiguous block of the light curve
+        # and can be selected with a slice instead of a boolean mask. The arrays used by the models are sliced once here
+        self.vis_slice = [visit_slice(idx) for idx in self.vis_idx]
+        self.vis_time = [np.asarray(self.time[s], dtype=float) for s in self.vis_slice]
+        self.vis_t_vis = [np.asarray(self.t_vis[s], dtype=float) for s in self.vis_slice]
+        self.vis_t_orb = [np.asarray(self.t_orb[s], dtype=float) for s in self.vis_slice]
+        self.vis_t_delay = [np.asarray(self.t_delay[s], dtype=float) for s in self.vis_slice]
+        self.vis_scan_direction = [np.asarray(self.scan_direction[s], dtype=float) for s in self.vis_slice]
+
+
+def visit_slice(idx):
+    """
+    Converts the boolean mask idx of a visit into a slice if the visit is contiguous. Otherwise the indices of the visit are returned.
+    """
+    where = np.flatnonzero(idx)
+    if len(where) == 0:
+        return slice(0, 0)
+    if where[-1] - where[0] + 1 == len(where):
+        return slice(where[0], where[-1] + 1)
+    return where
+
 
 def remove_dupl(seq):
     #https://stackoverflow.com/questions/480214/how-do-you-remove-duplicates-from-a-list-whilst-preserving-order
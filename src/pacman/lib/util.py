@@ -13,6 +13,8 @@ from scipy.optimize import leastsq
 from .sort_nicely import sort_nicely as sn
 import glob
 import pickle
+import hashlib
+import h5py
 
 
 #s00
@@ -247,18 +249,42 @@ def get_wave_grid(meta):
     elif meta.grism == 'G141':
         from ..lib import geometry141 as geo
 
-    wave_grid = np.empty((meta.norbit*meta.nvisit, meta.subarray_size, meta.subarray_size))
+    wave_grid = np.empty((meta.norbit, meta.subarray_size, meta.subarray_size))
 
-    #calculates wavelength solution row by row for each orbit
+    #calculates wavelength solution for all rows at once for each orbit
+    rows = -meta.LTV2 + np.arange(meta.subarray_size)
     for i in range(meta.norbit):
-        for j in range(meta.subarray_size):
-            disp_solution = geo.dispersion(meta.refpix[i,1], -meta.LTV2+j)
-            delx = 0.5 + np.arange(meta.subarray_size) - (meta.refpix[i,2] + meta.LTV1 + meta.POSTARG1/meta.platescale)
-            wave_grid[i, j, :] = disp_solution[0] + delx*disp_solution[1]
+        disp_solution = geo.dispersion(meta.refpix[i,1], rows)
+        delx = 0.5 + np.arange(meta.subarray_size) - (meta.refpix[i,2] + meta.LTV1 + meta.POSTARG1/meta.platescale)
+        wave_grid[i] = disp_solution[:, 0, None] + delx[None, :]*disp_solution[:, 1, None]
 
     return wave_grid
 
 
+def read_ima_sci(d, nreads):
+    """
+    Reads the SCI extensions of an _ima file into one array.
+
+    Every read is decoded only once (astropy memory-maps the extensions if the file allows it) and copied directly into the cube.
+
+    Parameters
+    -----------
+    d
+        the opened _ima fits file (HDUList)
+    nreads: int
+        number of reads which will be loaded (starting with the last and longest read, which is the first SCI extension)
+
+    Returns
+    ----------
+    sci: numpy array
+        array with shape (nreads, ny, nx)
+    """
+    sci = np.empty((nreads,) + d[1].data.shape, dtype=d[1].data.dtype.newbyteorder('='))
+    for ii in range(nreads):
+        sci[ii] = d[ii*5 + 1].data
+    return sci
+
+
 def get_flatfield(meta):                    #function that flatfields a data array D, which starts at [minr, cmin] of hdu[1].data
     """
     Opens the flat file and uses it for bad pixel masking.
@@ -270,16 +296,54 @@ def get_flatfield(meta):                    #function that flatfields a data arr
     a0 = flat[0].data[-meta.LTV1:-meta.LTV1+meta.subarray_size, -meta.LTV2:-meta.LTV2+meta.subarray_size]
     a1 = flat[1].data[-meta.LTV1:-meta.LTV1+meta.subarray_size, -meta.LTV2:-meta.LTV2+meta.subarray_size]
     a2 = flat[2].data[-meta.LTV1:-meta.LTV1+meta.subarray_size, -meta.LTV2:-meta.LTV2+meta.subarray_size]
+    flat.close()
 
-    flatfield = []
-    for i in range(meta.norbit*meta.nvisit):
-        wave = meta.wave_grid[i, :]
-        x = (wave - WMIN)/(WMAX-WMIN)
-        flatfield.append(a0+a1*x+a2*x**2)
-        flatfield[i][flatfield[i] < 0.5] = -1.        #sets flatfield pixels below 0.5 to -1 so they can be masked
+    #evaluates the flatfield for all orbits at once
+    x = (meta.wave_grid - WMIN)/(WMAX-WMIN)
+    flatfield = a0+a1*x+a2*x**2
+    flatfield[flatfield < 0.5] = -1.        #sets flatfield pixels below 0.5 to -1 so they can be masked
     return flatfield
 
 
+def get_calibration(meta):
+    """
+    Returns the wavelength grid and the bad pixel mask from the flatfield for every orbit.
+
+    Both only depend on the direct image positions, the subarray and the grism, so they are the same for every exposure in the run.
+    They are saved into workdir/ancil/calibration and reused when s20 is run again with the same setup.
+
+    Parameters
+    -----------
+    meta
+        metadata object
+
+    Returns
+    ----------
+    wave_grid: numpy array
+        wavelength solution for every orbit, row and column. Shape: (norbit, subarray_size, subarray_size)
+    flat_mask: numpy array
+        True for pixels with a flatfield value below 0.5. Same shape as wave_grid.
+    """
+    # everything the calibration depends on goes into the name of the file
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(meta.refpix[:meta.norbit], dtype=float).tobytes())
+    key.update(repr((meta.grism, meta.flat, meta.subarray_size, meta.LTV1, meta.LTV2, meta.POSTARG1, meta.platescale)).encode())
+    cal_dir = meta.workdir + '/ancil/calibration'
+    cal_file = cal_dir + '/calibration_{0}.npz'.format(key.hexdigest()[:16])
+
+    if os.path.exists(cal_file):
+        print('Using the saved wavelength grid and flatfield:', cal_file)
+        cal = np.load(cal_file)
+        return cal['wave_grid'], cal['flat_mask']
+
+    meta.wave_grid = get_wave_grid(meta)
+    flat_mask = get_flatfield(meta) == -1.
+    if not os.path.exists(cal_dir):
+        os.makedirs(cal_dir)
+    np.savez(cal_file, wave_grid=meta.wave_grid, flat_mask=flat_mask)
+    return meta.wave_grid, flat_mask
+
+
 def median_abs_dev(vec):
     """
     Used to determine the variance for the background count estimate
@@ -312,27 +376,76 @@ def residuals2(params, x1, y1, x2, y2):
     return fit - y2
 
 
+def drift_template(x, y):
+    """
+    Creates the template for the wavelength drift fit.
+
+    The template spectrum is padded with zeros and interpolated with a cubic spline.
+    Creating the spline is much more expensive than evaluating it, so this is only done once per template
+    (the reference spectrum or the first exposure in a visit) and not for every step of the least squares fit.
+
+    Returns
+    ----------
+    x_model, y_model
+        padded template spectrum
+    spline
+        cubic spline through the padded template spectrum (same as in residuals2)
+    """
+    # TODO: This is so bad
+    x_model = np.concatenate((np.linspace(-5000, min(x), 10, endpoint=False),
+                              x,
+                              np.linspace(max(x) + 350, 30000, 10, endpoint=False)))
+    y_model = np.concatenate((np.zeros(10),
+                              y,
+                              np.zeros(10)))
+    return x_model, y_model, interp1d(x_model, y_model, kind='cubic')
+
+
+def residuals_drift(params, spline, x2, y2):
+    """
+    calculate residuals for leastsq using a spline created by drift_template. Gives the same result as residuals2.
+    """
+    a, b, c = params
+    return spline(a+b*x2)*c - y2
+
+
+def drift_first_guess(spline, x_data, y_data):
+    """
+    Cross-correlates the spectrum with the template to get a first guess for the wavelength shift.
+
+    The template is evaluated for shifts of up to 10 pixels (in steps of 0.1 pixels) at once.
+    For every shift, the best scaling of the template is calculated analytically.
+
+    Returns
+    ----------
+    p0: list
+        initial guess [shift, stretch, scaling] for the least squares fit
+    """
+    dx = np.median(np.diff(x_data))
+    shifts = np.arange(-100, 101)*0.1*dx
+    model = spline(x_data[None, :] + shifts[:, None])
+    scale = (model*y_data).sum(axis=1)/(model**2).sum(axis=1)
+    chi2 = ((scale[:, None]*model - y_data)**2).sum(axis=1)
+    best = np.nanargmin(chi2)
+    return [shifts[best], 1, scale[best]]
+
+
 def correct_wave_shift_fct_0(meta, orbnum, cmin, cmax, spec_opt, i):
     template_waves = meta.wave_grid[0, int(meta.refpix[orbnum, 1]) + meta.LTV1, cmin:cmax]
 
     g102mask = template_waves > 8200  # we dont use the spectrum below 8200 angstrom for the interpolation as the reference bandpass cuts out below this wavelength
 
     x_refspec, y_refspec = read_refspec(meta)
-
-    # TODO: This is so bad
-    x_refspec_new = np.concatenate((np.linspace(-5000, min(x_refspec), 10, endpoint=False),
-                                    x_refspec,
-                                    np.linspace(max(x_refspec) + 350, 30000, 10, endpoint=False)))
-    y_refspec_new = np.concatenate((np.zeros(10),
-                                    y_refspec,
-                                    np.zeros(10)))
+    x_refspec_new, y_refspec_new, spline = drift_template(x_refspec, y_refspec)
 
     # TODO: will break if optimal extractions isnt used!
     x_data = template_waves[g102mask]
     y_data = (spec_opt / max(spec_opt))[g102mask]
 
     p0 = [0, 1, 1]  # initial guess for least squares
-    leastsq_res = leastsq(residuals2, p0, args=(x_refspec_new, y_refspec_new, x_data, y_data))[0]
+    if meta.drift_xcorr_guess:
+        p0 = drift_first_guess(spline, x_data, y_data)
+    leastsq_res = leastsq(residuals_drift, p0, args=(spline, x_data, y_data))[0]
 
     if meta.save_refspec_fit_plot or meta.show_refspec_fit_plot:
         plots.refspec_fit(x_refspec_new, y_refspec_new, p0, x_data, y_data, leastsq_res, meta, i)
@@ -348,20 +461,20 @@ def correct_wave_shift_fct_0(meta, orbnum, cmin, cmax, spec_opt, i):
     return x_data_firstexpvisit, y_data_firstexpvisit, leastsq_res
 
 
-def correct_wave_shift_fct_1(meta, orbnum, cmin, cmax, spec_opt, x_data_firstexpvisit, y_data_firstexpvisit, i):
-    # TODO: So bad too
-    x_model = np.concatenate((np.linspace(-5000, min(x_data_firstexpvisit), 10, endpoint=False),
-                              x_data_firstexpvisit,
-                              np.linspace(max(x_data_firstexpvisit) + 350, 30000, 10, endpoint=False)))
-    y_model = np.concatenate((np.zeros(10),
-                              y_data_firstexpvisit,
-                              np.zeros(10)))
+def correct_wave_shift_fct_1(meta, orbnum, cmin, cmax, spec_opt, x_data_firstexpvisit, y_data_firstexpvisit, i, template=None):
+    # the template (first exposure in the visit) is the same for all exposures in the visit.
+    # If it was already created with drift_template, it does not have to be created again
+    if template is None:
+        template = drift_template(x_data_firstexpvisit, y_data_firstexpvisit)
+    x_model, y_model, spline = template
 
     x_data = meta.wave_grid[0, int(meta.refpix[orbnum, 1]) + meta.LTV1, cmin:cmax]
     y_data = spec_opt / max(spec_opt)
 
     p0 = [0, 1, 1]
-    leastsq_res = leastsq(residuals2, p0, args=(x_model, y_model, x_data, y_data))[0]
+    if meta.drift_xcorr_guess:
+        p0 = drift_first_guess(spline, x_data, y_data)
+    leastsq_res = leastsq(residuals_drift, p0, args=(spline, x_data, y_data))[0]
 
     if meta.save_refspec_fit_plot or meta.show_refspec_fit_plot:
         plots.refspec_fit(x_model, y_model, p0, x_data, y_data, leastsq_res, meta, i)
@@ -376,7 +489,7 @@ def make_lsq_rprs_txt(vals, errs, idxs, meta):
     Saves the rprs vs wvl as a txt file as resulting from the lsq.
     """
     if not os.path.isdir(meta.workdir + meta.fitdir + '/lsq_res'):
-        os.makedirs(meta.workdir + meta.fitdir + '/lsq_res')
+        os.makedirs(meta.workdir + meta.fitdir + '/lsq_res', exist_ok=True)
     f_lsq = open(meta.workdir + meta.fitdir + '/lsq_res' + "/lsq_rprs.txt", 'w')
     rprs_vals_lsq = [vals[ii][idxs[0][1]] for ii in range(len(vals))]
     rprs_errs_lsq = [errs[ii][idxs[0][1]] for ii in range(len(errs))]
@@ -387,11 +500,54 @@ def make_lsq_rprs_txt(vals, errs, idxs, meta):
     f_lsq.close()
 
 
+def read_mcmc_chain(filename, discard=0, thin=1, idx=slice(None)):
+    """
+    Reads the MCMC chain saved by mcmc_fit in an HDF5 file.
+
+    Only the requested steps and parameters are read from the file, so also very long chains can be read.
+
+    Parameters
+    -----------
+    filename: str
+        path of the HDF5 file
+    discard: int
+        number of steps at the beginning of the chain which are not read (e.g., the burn in)
+    thin: int
+        only every thin-th step is read
+    idx: int or slice
+        index of the parameter(s) which are read
+
+    Returns
+    ----------
+    chain: numpy array
+        chain with the shape (nsteps, nwalkers, ndim) or (nsteps, nwalkers) if idx is an integer
+    """
+    with h5py.File(filename, 'r') as f:
+        # the dataset can be longer than the chain if a run was interrupted
+        niter = f['mcmc'].attrs['iteration']
+        return f['mcmc']['chain'][discard:niter:thin, :, idx]
+
+
+def read_mcmc_samples(filename, idx=slice(None)):
+    """
+    Reads the samples of the posterior from the HDF5 file of an MCMC, i.e., the chain without the burn-in and thinned
+    (as chosen by mcmc_fit and saved in the file).
+
+    Returns
+    ----------
+    samples: numpy array
+        (nsteps, nwalkers, ndim) array or (nsteps, nwalkers) if idx is an integer
+    """
+    with h5py.File(filename, 'r') as f:
+        nburn, thin = f['mcmc'].attrs['nburn'], f['mcmc'].attrs['thin']
+    return read_mcmc_chain(filename, nburn, thin, idx)
+
+
 def make_mcmc_rprs_txt(meta):
     """
     Saves the rprs vs wvl as a txt file as resulting from the MCMC.
     """
-    files_mcmc_res = glob.glob(os.path.join(meta.workdir + meta.fitdir + '/mcmc_res', "mcmc_out_*.p"))
+    files_mcmc_res = glob.glob(os.path.join(meta.workdir + meta.fitdir + '/mcmc_res', "mcmc_chain_*.h5"))
     files_mcmc_res = sn(files_mcmc_res)
 
     medians = []
@@ -399,12 +555,9 @@ def make_mcmc_rprs_txt(meta):
     errors_upper = []
 
     for f in files_mcmc_res:
-        handle = open(f, 'rb')
-        data, params, chain = pickle.load(handle)
-        ndim = chain.shape[-1]
-        samples = chain[:, meta.run_nburn:, :].reshape((-1, ndim))
         # TODO samples[:, 1] has to be fixeD!!!!!
-        q = quantile(samples[:, 1], [0.16, 0.5, 0.84])
+        samples = read_mcmc_samples(f, idx=1).ravel()
+        q = quantile(samples, [0.16, 0.5, 0.84])
         medians.append(q[1])
         errors_lower.append(abs(q[1] - q[0]))
         errors_upper.append(abs(q[2] - q[1]))
@@ -414,7 +567,7 @@ def make_mcmc_rprs_txt(meta):
     errors_upper = np.array(errors_upper)
 
     if not os.path.isdir(meta.workdir + meta.fitdir + '/mcmc_res'):
-        os.makedirs(meta.workdir + meta.fitdir + '/mcmc_res')
+        os.makedirs(meta.workdir + meta.fitdir + '/mcmc_res', exist_ok=True)
     f_mcmc = open(meta.workdir + meta.fitdir + '/mcmc_res' + "/mcmc_rprs.txt", 'w')
     file_header = ['wavelength (micron)', 'rprs', 'rprs_err_lower', 'rprs_err_upper']
     print("#{: <24} {: <25} {: <25} {: <25}".format(*file_header), file=f_mcmc)
@@ -2,6 +2,7 @@ import os, glob, scipy, sys
 import numpy as np
 from astropy.io import ascii, fits
 import shutil
+import multiprocessing as mp
 #from numpy import *
 #from pylab import *
 from .lib import optextr
@@ -13,10 +14,17 @@ from tqdm import tqdm
 from .lib import manageevent as me
 from .lib import util
 from .lib import plots
+from .lib import cube
+from .lib import background
 
 def run20(eventlabel, workdir, meta=None):
     """
     This function extracts the spectrum and saves the total flux and the flux as a function of wavelength into files.
+
+    Every exposure is extracted independently by extract_exposure().
+    If s20_ncpu > 1 in the pcf, the exposures are distributed over a pool of worker processes.
+    The results are then merged back in time order, so the output is identical to the serial run.
+    The wavelength drift correction depends on the first exposure of each visit and is therefore applied afterwards in a post-pass.
     """
 
     print('Starting s20')
@@ -38,14 +46,7 @@ def run20(eventlabel, workdir, meta=None):
     # This copy is just for the user to know what parameters they used when running s20
     shutil.copy(meta.workdir + '/obs_par.pcf', dirname)
 
-    # initialize the astropy tables where we will save the extracted spectra
-    if meta.output == True:
-        table_white = QTable(names=('t_mjd', 't_bjd', 't_visit','t_orbit', 'ivisit', 'iorbit', 'scan', 'spec_opt', 'var_opt', 'spec_box', 'var_box'))
-        table_spec = QTable(names=('t_mjd', 't_bjd', 't_visit','t_orbit', 'ivisit', 'iorbit', 'scan', 'spec_opt', 'var_opt', 'template_waves'))
-        table_diagnostics = QTable(names=('nspectra', 't_mjd', 'numoutliers', 'skymedian', "# nans"))
-
     files_sp = meta.files_sp     # spectra files
-    nspectra = 0                 # iterator variable to track number of spectra reduced
     # Only do the first N files, if wanted by the user
     if meta.s20_testing:
         meta.nexp = meta.n_testing
@@ -68,107 +69,50 @@ def run20(eventlabel, workdir, meta=None):
 
     print('in total #visits, #orbits:', (meta.nvisit, meta.norbit), '\n')
 
+    # The wavelength solution and the flatfield are the same for every file in the run
+    # gets grid of wavelength solutions for each orbit and row and the pixels which are masked due to the flatfield
+    meta.wave_grid, meta.flat_mask = util.get_calibration(meta)
+
+    #########################################################################################################################################################
+    # Extracts every exposure. The exposures do not depend on each other, so they can be run in parallel.              #
+    #########################################################################################################################################################
     # in order to have the correct order of print() with tqdm, i added file=sys.stdout
     # source: https://stackoverflow.com/questions/36986929/redirect-print-command-in-python-script-through-tqdm-write
-    for i in tqdm(np.arange(meta.nexp, dtype=int), desc='***************** Looping over files', file=sys.stdout):#tqdm(np.arange(len(files_sp), dtype=int)):
-        f = files_sp[i]                     # current file
-        print("\nFilename: {0}".format(f))
-        d = fits.open(f)                    # opens the file
-        scan = meta.scans_sp[i]             # scan direction of the spectrum.
-
-        # Plot with good visible background
-        if meta.save_sp2d_plot or meta.show_sp2d_plot:
-            plots.sp2d(d, meta, i)
-
-        visnum, orbnum = meta.ivisit_sp[i], meta.iorbit_sp_cumulative[i]     #current visit and cumulative orbit number
-        print('current visit, orbit: ', (visnum, orbnum))
-
-        # Plot trace
-        # y pos in the trace plot is the position of the DI
-        if meta.save_trace_plot or meta.show_trace_plot:
-            plots.trace(d, meta, visnum, orbnum, i)
-
-        #TODO: SPEED UP: calculation of the start and end of the trace could be moved to util.py. It's also used in plots.plot_trace. Also in plots.utr
-        cmin = int(meta.refpix[orbnum, 2] + meta.POSTARG1/meta.platescale) + meta.BEAMA_i + meta.LTV1                      #determines left column for extraction (beginning of the trace)
-        cmax = min(int(meta.refpix[orbnum, 2] + meta.POSTARG1/meta.platescale) + meta.BEAMA_f + meta.LTV1, meta.subarray_size)     #right column (end of trace, or edge of detector)
-        rmin, rmax = int(meta.rmin), int(meta.rmax)                     #top and bottom row for extraction (specified in obs_par.txt)
-
-        #TODO: SPEED UP: This calculation is done for every file again from new!
-        #TODO: Move it to util.py so its done just once
-        meta.wave_grid = util.get_wave_grid(meta)  # gets grid of wavelength solutions for each orbit and row
-
-        M = np.ones_like(d[1].data[rmin:rmax, cmin:cmax])                        #mask for bad pixels
-        flatfield = util.get_flatfield(meta)
-        bpix = d[3].data[rmin:rmax,cmin:cmax]
-        badpixind =  (bpix==4)|(bpix==512)|(flatfield[orbnum][rmin:rmax, cmin:cmax] == -1.)    #selects bad pixels
-        #print('bad pixels', sum(bpix==4), sum(bpix==512),sum(flatfield[orbnum][rmin:rmax, cmin:cmax] == -1.), sum(badpixind))
-        M[badpixind] = 0.0                                        #initializes bad pixel mask
-        #store number of bad pixels
-        spec_box = np.zeros(cmax - cmin)                                #box extracted standard spectrum
-        spec_opt = np.zeros(cmax - cmin)                                #optimally extracted spectrum
-        var_box = np.zeros(cmax - cmin)                              #box spectrum variance
-        var_opt = np.zeros(cmax - cmin)                                #optimal spectrum variance
-
-        #########################################################################################################################################################
-        # loops over up-the-ramp-samples (skipping first two very short exposures); gets all needed input for optextr routine                    #
-        #########################################################################################################################################################
-        # in order to not print a new line with tqdm every time, I added leave=True, position=0
-        # source: https://stackoverflow.com/questions/41707229/tqdm-printing-to-newline
-        for ii in tqdm(np.arange(d[0].header['nsamp']-2, dtype=int), desc='--- Looping over up-the-ramp-samples', leave=True, position=0):
-            diff = d[ii*5 + 1].data[rmin:rmax,cmin:cmax] - d[ii*5 + 6].data[rmin:rmax,cmin:cmax]    #creates image that is the difference between successive scans
-
-            # determine the aperture cutout
-            rowmedian = np.median(diff, axis=1)                   # median of every row
-            rowmedian_absder = abs(rowmedian[1:] - rowmedian[:-1])   # absolute derivative in order to determine where the spectrum is
-            #we use scipy.signal.find_peaks to determine in which rows the spectrum starts and ends
-            #TODO: Think about better values for height and distance
-            #TODO: Finding the row with the highest change in flux (compared to row above and below) isnt robust against outliers!
-            peaks, _ = find_peaks(rowmedian_absder, height=max(rowmedian_absder * 0.2), distance=5)
-            #peaks = peaks[:2] # only take the two biggest peaks (there should be only 2)
-            peaks = np.array([min(peaks[:2]), max(peaks[:2]) + 1])
-            #stores the locations of the peaks for every file and up-the-ramp-samples
-            if meta.save_utr_aper_evo_plot or meta.show_utr_aper_evo_plot:
-                peaks_all.append(peaks)
-
-            #estimates sky background and variance
-            fullframe_diff = d[ii*5 + 1].data - d[ii*5 + 6].data                                       #fullframe difference between successive scans
-
-            ### BACKGROUND SUBTRACTION
-            below_threshold = fullframe_diff < meta.background_thld # mask with all pixels below the user defined threshold
-            skymedian = np.median(fullframe_diff[below_threshold].flatten())  # estimates the background counts by taking the flux median of the pixels below the flux threshold
-            if meta.save_bkg_evo_plot or meta.show_bkg_evo_plot:
-                bkg_evo.append(skymedian)
-            skyvar = util.median_abs_dev(fullframe_diff[below_threshold].flatten())  # variance for the background count estimate
-            if meta.save_bkg_hist_plot or meta.show_bkg_hist_plot:
-                plots.bkg_hist(fullframe_diff, skymedian, meta, i, ii)
-            diff = diff - skymedian                                    #subtracts the background
-
-            #peaks_mid = int((peaks[0]+peaks[1])/2)
-
-            # selects postage stamp centered around spectrum
-            # we use a bit more data by using the user defined window
-            spectrum = diff[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:]
-            #spectrum = diff[max(peaks_mid - 4, 0):min(peaks_mid + 4, rmax),:]
-
-            if meta.save_utr_plot or meta.show_utr_plot:
-                plots.utr(diff, meta, i, ii, orbnum, rowmedian, rowmedian_absder, peaks)
-
-            err = np.zeros_like(spectrum) + float(meta.rdnoise)**2 + skyvar
-            var = abs(spectrum) + float(meta.rdnoise)**2 + skyvar          # variance estimate: Poisson noise from photon counts (first term)  + readnoise (factor of 2 for differencing) + skyvar
-            spec_box_0 = spectrum.sum(axis = 0)                            # initial box-extracted spectrum
-            var_box_0 = var.sum(axis = 0)                                  # initial variance guess
-            #Mnew = np.ones_like(M[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:])
-            Mnew = M[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:]
-            #Mnew = M[max(peaks_mid - 4, 0):min(peaks_mid + 4, rmax),:]
-            #TODO: Just use meta to reduce the number of parameters which are given to optextr
-            if meta.opt_extract==True: [f_opt_0, var_opt_0, numoutliers] = optextr.optextr(spectrum, err, spec_box_0, var_box_0, Mnew, meta.nsmooth, meta.sig_cut, meta.save_optextr_plot, i, ii, meta)
-            else: [f_opt, var_opt] = [spec_box_0,var_box_0]
-
-            #sums up spectra and variance for all the differenced images
-            spec_opt += f_opt_0
-            var_opt += var_opt_0
-            spec_box += spec_box_0
-            var_box += var_box_0
+    if meta.s20_ncpu > 1:
+        print('Extracting the spectra using {0} processes...'.format(meta.s20_ncpu))
+        # meta is only sent once to every worker; afterwards we only send the index of the file
+        with mp.Pool(processes=meta.s20_ncpu, initializer=init_worker, initargs=(meta,)) as pool:
+            # imap returns the results in the same (time) order as the files
+            results = list(tqdm(pool.imap(extract_worker, range(meta.nexp)), total=meta.nexp,
+                                desc='***************** Looping over files', file=sys.stdout))
+    else:
+        results = []
+        for i in tqdm(np.arange(meta.nexp, dtype=int), desc='***************** Looping over files', file=sys.stdout):#tqdm(np.arange(len(files_sp), dtype=int)):
+            results.append(extract_exposure(meta, i))
+
+    # initialize the arrays where we will save the extracted spectra
+    # the spectra of all exposures are stored in (nexp, npix) arrays. The trace might be cut off at the edge of the detector,
+    # so npix_exp stores the number of pixels which were actually extracted in every exposure
+    npix = meta.BEAMA_f - meta.BEAMA_i
+    npix_exp = np.zeros(meta.nexp, dtype=int)
+    ivisit, iorbit, scans = np.zeros(meta.nexp), np.zeros(meta.nexp), np.zeros(meta.nexp)
+    spec_opt_all, var_opt_all, waves_all = np.zeros((meta.nexp, npix)), np.zeros((meta.nexp, npix)), np.zeros((meta.nexp, npix))
+    white = np.zeros((meta.nexp, 4))        # summed spec_opt, var_opt, spec_box, var_box
+    diagnostics = np.zeros((meta.nexp, 3))  # numoutliers, skymedian, # nans
+
+    #########################################################################################################################################################
+    # Post-pass over all exposures in time order: wavelength drift correction and saving of the results                 #
+    #########################################################################################################################################################
+    for i, res in enumerate(results):
+        visnum, orbnum, scan = res['visnum'], res['orbnum'], res['scan']
+        cmin, cmax = res['cmin'], res['cmax']
+        spec_opt, var_opt = res['spec_opt'], res['var_opt']
+        spec_box, var_box = res['spec_box'], res['var_box']
+
+        if meta.save_utr_aper_evo_plot or meta.show_utr_aper_evo_plot:
+            peaks_all.extend(res['peaks'])
+        if meta.save_bkg_evo_plot or meta.show_bkg_evo_plot:
+            bkg_evo.extend(res['skymedians'])
 
         ######################################################################################################################################
         #TODO: Q: int(meta.refpix[orbnum, 1]) + meta.LTV1 is kinda sus
@@ -184,10 +128,12 @@ def run20(eventlabel, workdir, meta=None):
             if i in meta.new_visit_idx_sp:
                 x_data_firstexpvisit, y_data_firstexpvisit, leastsq_res = util.correct_wave_shift_fct_0(meta, orbnum, cmin, cmax, spec_opt, i)
                 wvls = np.copy(x_data_firstexpvisit)
+                # the first exposure is the template for the rest of the visit
+                template_firstexpvisit = util.drift_template(x_data_firstexpvisit, y_data_firstexpvisit)
                 if meta.save_drift_plot or meta.show_drift_plot:
                     leastsq_res_all.append(leastsq_res)
             else:
-                wvls, leastsq_res = util.correct_wave_shift_fct_1(meta, orbnum, cmin, cmax, spec_opt, x_data_firstexpvisit, y_data_firstexpvisit, i)
+                wvls, leastsq_res = util.correct_wave_shift_fct_1(meta, orbnum, cmin, cmax, spec_opt, x_data_firstexpvisit, y_data_firstexpvisit, i, template=template_firstexpvisit)
                 if meta.save_drift_plot or meta.show_drift_plot:
                     leastsq_res_all.append(leastsq_res)
         # If you dont want to correct it:
@@ -207,21 +153,45 @@ def run20(eventlabel, workdir, meta=None):
             else:
                 plots.sp1d(wvls, spec_box, meta, i)
 
-        # Adds rows to the astropy tables
-        table_white.add_row([meta.t_mjd_sp[i], meta.t_bjd_sp[i], meta.t_visit_sp[i], meta.t_orbit_sp[i], visnum, orbnum, scan, sum(spec_opt), sum(var_opt),  sum(spec_box), sum(var_box)])
+        # Stores the results in the arrays
         n = len(spec_opt)
-        for ii in np.arange(n):
-            table_spec.add_row([meta.t_mjd_sp[i], meta.t_bjd_sp[i], meta.t_visit_sp[i], meta.t_orbit_sp[i], visnum, orbnum, scan, spec_opt[ii], var_opt[ii], wvls[ii]])
-        table_diagnostics.add_row([nspectra, meta.t_mjd_sp[i], numoutliers, skymedian, sum(np.isnan(spec_opt))])
-        nspectra += 1
-
-        print('\n')
-
-    # Save results in the astropy tables
+        npix_exp[i] = n
+        ivisit[i], iorbit[i], scans[i] = visnum, orbnum, scan
+        spec_opt_all[i, :n], var_opt_all[i, :n], waves_all[i, :n] = spec_opt, var_opt, wvls
+        white[i] = [sum(spec_opt), sum(var_opt),  sum(spec_box), sum(var_box)]
+        diagnostics[i] = [res['numoutliers'], res['skymedian'], sum(np.isnan(spec_opt))]
+
+    # Save the results
+    # the light curves are saved into binary files (lc_white.h5, lc_spec.h5) which are read in by s21 and s30.
+    # If save_ecsv is True, they are also saved as human readable tables (lc_white.txt, lc_spec.txt)
     if meta.output == True:
-        ascii.write(table_white, dirname + '/lc_white.txt', format='ecsv', overwrite=True)
-        ascii.write(table_spec, dirname + '/lc_spec.txt', format='ecsv', overwrite=True)
+        t_mjd, t_bjd = meta.t_mjd_sp[:meta.nexp], meta.t_bjd_sp[:meta.nexp]
+        t_visit, t_orbit = meta.t_visit_sp[:meta.nexp], meta.t_orbit_sp[:meta.nexp]
+        columns_exp = [np.array(col, dtype=float) for col in [t_mjd, t_bjd, t_visit, t_orbit, ivisit, iorbit, scans]]
+        names_exp = ['t_mjd', 't_bjd', 't_visit','t_orbit', 'ivisit', 'iorbit', 'scan']
+
+        columns_white = dict(zip(names_exp + ['spec_opt', 'var_opt', 'spec_box', 'var_box'], columns_exp + list(white.T)))
+        cube.write_cube(dirname + '/lc_white.h5', columns_white)
+        # the spectra are saved as (nexp, npix) arrays
+        columns_spec = dict(zip(names_exp, columns_exp))
+        columns_spec.update(npix=npix_exp, spec_opt=spec_opt_all, var_opt=var_opt_all, template_waves=waves_all)
+        cube.write_cube(dirname + '/lc_spec.h5', columns_spec)
+
+        if meta.save_ecsv:
+            table_white = QTable(list(columns_white.values()), names=list(columns_white.keys()))
+            # in lc_spec.txt every pixel has its own row
+            valid = np.arange(npix) < npix_exp[:, None]
+            table_spec = QTable([np.repeat(col, npix_exp) for col in columns_exp] + [spec_opt_all[valid], var_opt_all[valid], waves_all[valid]],
+                                names=names_exp + ['spec_opt', 'var_opt', 'template_waves'])
+            ascii.write(table_white, dirname + '/lc_white.txt', format='ecsv', overwrite=True)
+            ascii.write(table_spec, dirname + '/lc_spec.txt', format='ecsv', overwrite=True)
+
+        table_diagnostics = QTable([np.arange(meta.nexp, dtype=float), columns_exp[0]] + list(diagnostics.T),
+                                   names=('nspectra', 't_mjd', 'numoutliers', 'skymedian', "# nans"))
         ascii.write(table_diagnostics, dirname + '/diagnostics.txt', format='ecsv', overwrite=True)
+
+    # the flatfield mask is only needed in s20 and does not have to be saved in the meta file
+    del meta.flat_mask
     print('Saving Metadata')
     me.saveevent(meta, meta.workdir + '/WFC3_' + meta.eventlabel + "_Meta_Save", save=[])
 
@@ -243,3 +213,148 @@ def run20(eventlabel, workdir, meta=None):
     print('Finished s20 \n')
 
     return meta
+
+
+def extract_exposure(meta, i):
+    """
+    Extracts the spectrum of a single exposure by looping over its up-the-ramp samples.
+
+    Parameters
+    ----------
+    meta
+        metadata object. meta.wave_grid and meta.flat_mask have to be set already.
+    i: int
+        index of the spectrum file in meta.files_sp
+
+    Returns
+    -------
+    res: dict
+        the box and optimally extracted spectra and their variances, the trace limits (cmin, cmax)
+        and diagnostics (number of outliers, sky background and aperture peaks of every up-the-ramp sample)
+    """
+    f = meta.files_sp[i]                # current file
+    print("\nFilename: {0}".format(f))
+    d = fits.open(f)                    # opens the file
+    scan = meta.scans_sp[i]             # scan direction of the spectrum.
+
+    # Plot with good visible background
+    if meta.save_sp2d_plot or meta.show_sp2d_plot:
+        plots.sp2d(d, meta, i)
+
+    visnum, orbnum = meta.ivisit_sp[i], meta.iorbit_sp_cumulative[i]     #current visit and cumulative orbit number
+    print('current visit, orbit: ', (visnum, orbnum))
+
+    # Plot trace
+    # y pos in the trace plot is the position of the DI
+    if meta.save_trace_plot or meta.show_trace_plot:
+        plots.trace(d, meta, visnum, orbnum, i)
+
+    #TODO: SPEED UP: calculation of the start and end of the trace could be moved to util.py. It's also used in plots.plot_trace. Also in plots.utr
+    cmin = int(meta.refpix[orbnum, 2] + meta.POSTARG1/meta.platescale) + meta.BEAMA_i + meta.LTV1                      #determines left column for extraction (beginning of the trace)
+    cmax = min(int(meta.refpix[orbnum, 2] + meta.POSTARG1/meta.platescale) + meta.BEAMA_f + meta.LTV1, meta.subarray_size)     #right column (end of trace, or edge of detector)
+    rmin, rmax = int(meta.rmin), int(meta.rmax)                     #top and bottom row for extraction (specified in obs_par.txt)
+
+    M = np.ones_like(d[1].data[rmin:rmax, cmin:cmax])                        #mask for bad pixels
+    bpix = d[3].data[rmin:rmax,cmin:cmax]
+    badpixind =  (bpix==4)|(bpix==512)|meta.flat_mask[orbnum][rmin:rmax, cmin:cmax]    #selects bad pixels
+    #print('bad pixels', sum(bpix==4), sum(bpix==512),sum(flatfield[orbnum][rmin:rmax, cmin:cmax] == -1.), sum(badpixind))
+    M[badpixind] = 0.0                                        #initializes bad pixel mask
+    #store number of bad pixels
+    spec_box = np.zeros(cmax - cmin)                                #box extracted standard spectrum
+    spec_opt = np.zeros(cmax - cmin)                                #optimally extracted spectrum
+    var_box = np.zeros(cmax - cmin)                              #box spectrum variance
+    var_opt = np.zeros(cmax - cmin)                                #optimal spectrum variance
+
+    # the following lists are used for diagnostic plots
+    peaks_all = []
+    skymedians = []
+
+    #########################################################################################################################################################
+    # loops over up-the-ramp-samples (skipping first two very short exposures); gets all needed input for optextr routine                    #
+    #########################################################################################################################################################
+    # in order to not print a new line with tqdm every time, I added leave=True, position=0
+    # source: https://stackoverflow.com/questions/41707229/tqdm-printing-to-newline
+    # every read is only decoded once. The differences between all successive reads are then calculated at once
+    nsamp = d[0].header['nsamp']
+    sci = util.read_ima_sci(d, nsamp - 1)
+    fullframe_diffs = sci[:-1] - sci[1:]                                          #fullframe differences between successive scans
+    for ii in tqdm(np.arange(nsamp-2, dtype=int), desc='--- Looping over up-the-ramp-samples', leave=True, position=0, disable=meta.s20_ncpu > 1):
+        fullframe_diff = fullframe_diffs[ii]
+        diff = fullframe_diff[rmin:rmax,cmin:cmax]                                 #creates image that is the difference between successive scans
+
+        # determine the aperture cutout
+        rowmedian = np.median(diff, axis=1)                   # median of every row
+        rowmedian_absder = abs(rowmedian[1:] - rowmedian[:-1])   # absolute derivative in order to determine where the spectrum is
+        #we use scipy.signal.find_peaks to determine in which rows the spectrum starts and ends
+        #TODO: Think about better values for height and distance
+        #TODO: Finding the row with the highest change in flux (compared to row above and below) isnt robust against outliers!
+        peaks, _ = find_peaks(rowmedian_absder, height=max(rowmedian_absder * 0.2), distance=5)
+        #peaks = peaks[:2] # only take the two biggest peaks (there should be only 2)
+        peaks = np.array([min(peaks[:2]), max(peaks[:2]) + 1])
+        #stores the locations of the peaks for every file and up-the-ramp-samples
+        peaks_all.append(peaks)
+
+        #estimates sky background and variance
+        ### BACKGROUND SUBTRACTION
+        # mask with all pixels below the user defined threshold. If background_mask is 'exposure', the mask from the first read is used for all reads
+        if meta.background_mask == 'read' or ii == 0:
+            below_threshold = fullframe_diff < meta.background_thld
+        # estimates the background counts (by default the flux median of the pixels below the flux threshold) and the variance for the background count estimate
+        skymedian, skyvar = background.get_background(fullframe_diff, meta, below_threshold)
+        skymedians.append(skymedian)
+        if meta.save_bkg_hist_plot or meta.show_bkg_hist_plot:
+            plots.bkg_hist(fullframe_diff, skymedian, meta, i, ii)
+        diff = diff - skymedian                                    #subtracts the background
+
+        #peaks_mid = int((peaks[0]+peaks[1])/2)
+
+        # selects postage stamp centered around spectrum
+        # we use a bit more data by using the user defined window
+        spectrum = diff[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:]
+        #spectrum = diff[max(peaks_mid - 4, 0):min(peaks_mid + 4, rmax),:]
+
+        if meta.save_utr_plot or meta.show_utr_plot:
+            plots.utr(diff, meta, i, ii, orbnum, rowmedian, rowmedian_absder, peaks)
+
+        err = np.zeros_like(spectrum) + float(meta.rdnoise)**2 + skyvar
+        var = abs(spectrum) + float(meta.rdnoise)**2 + skyvar          # variance estimate: Poisson noise from photon counts (first term)  + readnoise (factor of 2 for differencing) + skyvar
+        spec_box_0 = spectrum.sum(axis = 0)                            # initial box-extracted spectrum
+        var_box_0 = var.sum(axis = 0)                                  # initial variance guess
+        #Mnew = np.ones_like(M[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:])
+        Mnew = M[max(min(peaks) - meta.window, 0):min(max(peaks) + meta.window, rmax),:]
+        #Mnew = M[max(peaks_mid - 4, 0):min(peaks_mid + 4, rmax),:]
+        #TODO: Just use meta to reduce the number of parameters which are given to optextr
+        if meta.opt_extract==True: [f_opt_0, var_opt_0, numoutliers] = optextr.optextr(spectrum, err, spec_box_0, var_box_0, Mnew, meta.nsmooth, meta.sig_cut, meta.save_optextr_plot, i, ii, meta)
+        else: [f_opt_0, var_opt_0, numoutliers] = [spec_box_0, var_box_0, 0]
+
+        #sums up spectra and variance for all the differenced images
+        spec_opt += f_opt_0
+        var_opt += var_opt_0
+        spec_box += spec_box_0
+        var_box += var_box_0
+
+    d.close()
+    print('\n')
+
+    return dict(visnum=visnum, orbnum=orbnum, scan=scan, cmin=cmin, cmax=cmax,
+                spec_opt=spec_opt, var_opt=var_opt, spec_box=spec_box, var_box=var_box,
+                numoutliers=numoutliers, skymedian=skymedian, peaks=peaks_all, skymedians=skymedians)
+
+
+# meta object of a worker process in the parallel extraction (set by init_worker)
+worker_meta = None
+
+
+def init_worker(meta):
+    """
+    Stores meta in the worker process, so it does not have to be sent again for every exposure.
+    """
+    global worker_meta
+    worker_meta = meta
+
+
+def extract_worker(i):
+    """
+    Extracts exposure i in a worker process.
+    """
+    return extract_exposure(worker_meta, i)
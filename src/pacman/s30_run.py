@@ -7,6 +7,7 @@ from astropy.io import ascii
 import getopt
 import time
 import shutil
+import multiprocessing as mp
 import time as pythontime
 from .lib import manageevent as me
 from .lib.read_data import Data
@@ -14,6 +15,7 @@ from .lib.model import Model
 from .lib.least_squares import lsq_fit
 from .lib.mcmc import mcmc_fit
 from .lib.nested import nested_sample
+from .lib.joint_fit import joint_fit
 from .lib.formatter import ReturnParams
 from .lib import sort_nicely as sn
 from .lib import nice_fit_par
@@ -24,6 +26,10 @@ from .lib import util
 def run30(eventlabel, workdir, meta=None):
     """
     This functions reads in the spectroscopic or white light curve(s) and fits a model to them.
+
+    Every light curve is fitted independently by fit_file().
+    If s30_ncpu > 1 in the pcf, the light curves are distributed over a pool of worker processes.
+    The results of the fits are gathered afterwards in the order of the light curves.
     """
     print('Starting s30')
 
@@ -47,10 +53,8 @@ def run30(eventlabel, workdir, meta=None):
     #TODO: Check that fit_par is configured correctly. Eg initial value has to be within boundaries!
     fit_par = ascii.read(meta.workdir + "/fit_par.txt", Reader=ascii.CommentedHeader)
 
-    #read in the user wanted fit functions
-    myfuncs = meta.s30_myfuncs
-
     #read in the files (white or spectroscopic) which will be fitted
+    #the binary light curves (.h5) are used if they exist. Otherwise the ECSV files (.txt) are used
     if meta.s30_fit_white:
         print('White light curve fit will be performed')
         files = []
@@ -58,9 +62,13 @@ def run30(eventlabel, workdir, meta=None):
             lst_dir = os.listdir(meta.workdir + "/extracted_lc/")
             lst_dir = sn.sort_nicely(lst_dir)
             white_dir = lst_dir[-1]
-            files.append(meta.workdir + "/extracted_lc/" + white_dir + "/lc_white.txt")
+            white_file = meta.workdir + "/extracted_lc/" + white_dir + "/lc_white"
+            if os.path.exists(white_file + ".h5"):
+                files.append(white_file + ".h5")
+            else:
+                files.append(white_file + ".txt")
         else:
-            files.append(meta.s30_white_file)
+            files.append(meta.s30_white_file_path)
     elif meta.s30_fit_spec:
         print('Spectroscopic light curve fit(s) will be performed')
         if meta.s30_most_recent_s21:
@@ -69,12 +77,12 @@ def run30(eventlabel, workdir, meta=None):
             lst_dir = sn.sort_nicely(lst_dir)
             spec_dir = lst_dir[-1]
             spec_dir_full = meta.workdir + "/extracted_sp/" + spec_dir
-            files = glob.glob(os.path.join(spec_dir_full, "*.txt"))
-            files = sn.sort_nicely(files)
         else:
-            spec_dir_full = meta.s30_spec_dir
-            files = glob.glob(os.path.join(spec_dir_full, "*.txt"))  #
-            files = sn.sort_nicely(files)
+            spec_dir_full = meta.s30_spec_dir_path
+        files = glob.glob(os.path.join(spec_dir_full, "speclc*.h5"))
+        if len(files) == 0:
+            files = glob.glob(os.path.join(spec_dir_full, "*.txt"))
+        files = sn.sort_nicely(files)
         spec_dir_wvl_file = spec_dir_full + '/wvl_table.dat'
         meta.wavelength_list = ascii.read(spec_dir_wvl_file)['wavelengths']
 
@@ -84,92 +92,29 @@ def run30(eventlabel, workdir, meta=None):
 
     print('Identified file(s) for fitting:', files)
 
-    if meta.run_verbose:
-        vals = []
-        errs = []
-        idxs = []
-
-    meta.chi2red_list = []
-
-    for counter, f in enumerate(files):
-        print('\n****** File: {0}/{1}'.format(counter+1, len(files)))
-        meta.s30_file_counter = counter
-        time.sleep(1.1) #sleep to prevent overwriting of data if saved in the same second
-        meta.run_file = f
-        meta.fittime = time.strftime('%Y-%m-%d_%H-%M-%S')
-
-        if meta.run_clipiters == 0:
-            print('\n')
-            data = Data(f, meta, fit_par)
-            model = Model(data, myfuncs)
-            data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True) #not clipping
-            meta.chi2red_list.append(model.chi2red)
-        else:
-            clip_idxs = []
-            for iii in range(meta.run_clipiters+1):
-                print('\n')
-                print('Sigma Iters: ', iii, 'of', meta.run_clipiters)
-                if iii == 0:
-                    data = Data(f, meta, fit_par)
-                else:
-                    data = Data(f, meta, fit_par, clip_idx)
-                model = Model(data, myfuncs)
-                if iii == meta.run_clipiters:
-                    data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True)
-                else:
-                    data, model, params, clip_idx, m = lsq_fit(fit_par, data, meta, model, myfuncs)
-                    print("rms, chi2red = ", model.rms, model.chi2red)
-                    print(clip_idx == [])
-                    if clip_idx == []: break
-                    clip_idxs.append(clip_idx)
-                    print(clip_idxs)
-                    print('length: ', len(clip_idxs) )
-                    if len(clip_idxs)>1:
-                        clip_idx = update_clips(clip_idxs)
-                        print(clip_idx)
-                        clip_idxs = update_clips(clip_idxs)
-                        print(clip_idxs)
-
-
-        """ind = model.resid/data.err > 10.
-        print "num outliers", sum(ind)
-        data.err[ind] = 1e12
-        data, model = lsq_fit(fit_par, data, flags, model, myfuncs)"""
-
-        if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
-
-        #FIXME : make this automatic!
-        """outfile = open("white_systematics.txt", "w")
-        for i in range(len(model.all_sys)): print(model.all_sys[i], file = outfile)
-        outfile.close()"""
-
-        meta.labels = labels_gen(params, meta, fit_par)
-
-        if meta.run_mcmc:
-            time.sleep(1.1)
-            if meta.rescale_uncert:
-                ##rescale error bars so reduced chi-squared is one
-                data.err *= np.sqrt(model.chi2red)
-            data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True)
-            if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
-            mcmc_fit(data, model, params, f, meta, fit_par)
-
-        if meta.run_nested:
-            time.sleep(1.1)
-            if meta.rescale_uncert:
-                ##rescale error bars so reduced chi-squared is one
-                data.err *= np.sqrt(model.chi2red)
-            data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True)
-            if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
-            nested_sample(data, model, params, f, meta, fit_par)
-
-        if meta.run_verbose:
-            val, err, idx = ReturnParams(m, data)
-            vals.append(val)
-            errs.append(err)
-            idxs.append(idx)
+    # every light curve is fitted independently. All output file names contain the number of the light curve (s30_file_counter),
+    # so the light curves can be fitted in parallel without overwriting each other's results
+    # in a joint fit all light curves are fitted at once with the parameters in s30_joint_shared shared between them
+    if meta.s30_joint_fit and len(files) > 1:
+        print('Fitting the light curves jointly, shared parameters:', meta.s30_joint_shared)
+        results = joint_fit(meta, fit_par, files)
+    elif meta.s30_ncpu > 1 and len(files) > 1:
+        print('Fitting the light curves using {0} processes...'.format(meta.s30_ncpu))
+        # meta and fit_par are only sent once to every worker; afterwards we only send the index of the file
+        with mp.Pool(processes=meta.s30_ncpu, initializer=init_worker, initargs=(meta, fit_par, files)) as pool:
+            # imap returns the results in the same order as the files
+            results = list(pool.imap(fit_worker, range(len(files))))
+    else:
+        results = [fit_file(meta, fit_par, files, counter) for counter in range(len(files))]
 
+    # gathers the results of the fits
+    meta.chi2red_list = [result['chi2red'] for result in results]
+    meta.labels = results[-1]['labels']
     if meta.run_verbose:
+        vals = [result['val'] for result in results]
+        errs = [result['err'] for result in results]
+        idxs = [result['idx'] for result in results]
+
         plots.params_vs_wvl(vals, errs, idxs, meta)
 
         if not meta.s30_fit_white:
@@ -186,27 +131,87 @@ def run30(eventlabel, workdir, meta=None):
 
     return meta
 
-def update_clips(clips_array):
-    clips_old = clips_array[0]
-    clips_new = clips_array[1]
-    clips_new[0] + sum([i <= clips_new[0] for i in clips_old])
-    clips_new_updated = [clips_new[ii] + sum([i <= clips_new[ii] for i in clips_old]) for ii in range(len(clips_new))]
-    return np.concatenate((clips_old, clips_new_updated))
-
-
-def labels_gen(params, meta, fit_par):
-    nvisit = int(meta.nvisit)
-    labels = []
-    ii = 0
-    for i in range(int(len(params) / nvisit)):
-        if fit_par['fixed'][ii].lower() == "false":
-            if str(fit_par['tied'][ii]) == "-1":
-                labels.append(fit_par['parameter'][ii])
-                ii = ii + 1
+
+def fit_file(meta, fit_par, files, counter):
+    """
+    Fits the light curve in files[counter] (least squares with sigma clipping and optionally MCMC and nested sampling).
+
+    Returns a dictionary with the reduced chi2 of the least squares fit, the labels of the free parameters
+    and (if run_verbose is True) the fitted values, uncertainties and indices as returned by ReturnParams.
+    """
+    f = files[counter]
+    myfuncs = meta.s30_myfuncs
+
+    print('\n****** File: {0}/{1}'.format(counter+1, len(files)))
+    meta.s30_file_counter = counter
+    meta.run_file = f
+    meta.fittime = time.strftime('%Y-%m-%d_%H-%M-%S')
+
+    data = Data(f, meta, fit_par)
+    model = Model(data, myfuncs)
+    if meta.run_clipiters == 0:
+        print('\n')
+        data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True) #not clipping
+    else:
+        # the light curve stays in memory, the outliers are only masked (see Data.clip)
+        # every iteration starts from the parameters of the previous iteration
+        params = None
+        for iii in range(meta.run_clipiters+1):
+            print('\n')
+            print('Sigma Iters: ', iii, 'of', meta.run_clipiters)
+            if iii == meta.run_clipiters:
+                data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True, params_start=params)
             else:
-                for j in range(nvisit):
-                    labels.append(fit_par['parameter'][ii] + str(j))
-                    ii = ii + 1
-        else:
-            ii = ii + 1
-    return labels
+                data, model, params, clip_idx, m = lsq_fit(fit_par, data, meta, model, myfuncs, params_start=params)
+                print("rms, chi2red = ", model.rms, model.chi2red)
+                if len(clip_idx) == 0: break
+                data.clip(clip_idx)
+                print('Clipped exposures in total: ', np.sum(~data.valid))
+                model.resize(data)
+
+    result = dict(chi2red=model.chi2red)
+
+    if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
+
+    meta.labels = data.param_map.labels
+    result['labels'] = meta.labels
+
+    if meta.run_mcmc:
+        if meta.rescale_uncert:
+            ##rescale error bars so reduced chi-squared is one
+            data.err *= np.sqrt(model.chi2red)
+        data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True)
+        if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
+        mcmc_fit(data, model, params, f, meta, fit_par)
+
+    if meta.run_nested:
+        if meta.rescale_uncert:
+            ##rescale error bars so reduced chi-squared is one
+            data.err *= np.sqrt(model.chi2red)
+        data, model, params, m = lsq_fit(fit_par, data, meta, model, myfuncs, noclip=True)
+        if meta.run_verbose == True: print("rms, chi2red = ", model.rms, model.chi2red)
+        nested_sample(data, model, params, f, meta, fit_par)
+
+    if meta.run_verbose:
+        result['val'], result['err'], result['idx'] = ReturnParams(m, data)
+
+    return result
+
+
+worker_meta, worker_fit_par, worker_files = None, None, None
+
+
+def init_worker(meta, fit_par, files):
+    """
+    Stores meta, fit_par and the list of files in the worker process, so they do not have to be sent again for every light curve.
+    """
+    global worker_meta, worker_fit_par, worker_files
+    worker_meta, worker_fit_par, worker_files = meta, fit_par, files
+
+
+def fit_worker(counter):
+    """
+    Fits light curve number counter in a worker process.
+    """
+    return fit_file(worker_meta, worker_fit_par, worker_files, counter)
+
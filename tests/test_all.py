@@ -24,6 +24,10 @@ from pacman.lib import sort_nicely as sn
 from pacman.lib.suntimecorr import getcoords as getcoords
 from pacman.lib.gaussfitter import gaussfit as gaussfit
 from pacman.lib import optextr
+from pacman.lib import cube
+from pacman.lib import background
+from pacman.lib import binning
+from pacman.lib.parameter_map import ParameterMap
 
 from importlib import reload
 from astropy.table import Table
@@ -363,6 +367,9 @@ def test_s20(capsys):
     assert os.path.exists(s20_lc_spec_file)
     assert os.path.exists(s20_lc_white_file)
 
+    #The wavelength grid and the flatfield should have been saved for the next run
+    assert len(glob.glob(workdir + '/ancil/calibration/calibration_*.npz')) == 1
+
     s20_lc_spec = ascii.read(s20_lc_spec_file)
     s20_lc_white = ascii.read(s20_lc_white_file)
 
@@ -370,6 +377,14 @@ def test_s20(capsys):
     assert len(s20_lc_spec.colnames) == 10
     assert len(s20_lc_white.colnames) == 11
 
+    #The binary files should contain the same light curves as the ECSV tables
+    s20_lc_spec_h5 = cube.read_cube(s20_dir + '/lc_spec.h5')
+    s20_lc_white_h5 = cube.read_cube_table(s20_dir + '/lc_white.h5')
+    assert np.array_equal(s20_lc_spec_h5['spec_opt'].flatten(), s20_lc_spec['spec_opt'])
+    assert np.array_equal(s20_lc_spec_h5['template_waves'].flatten(), s20_lc_spec['template_waves'])
+    assert s20_lc_white_h5.colnames == s20_lc_white.colnames
+    assert np.array_equal(s20_lc_white_h5['spec_opt'], s20_lc_white['spec_opt'])
+
 
     #test_optextr
     spectrum = np.ones((20,9))
@@ -391,6 +406,545 @@ def test_s20(capsys):
     assert numoutliers == 0 # we didnt introduce any outliers
 
 
+@pytest.mark.run(order=28)
+def test_optextr_stack(capsys):
+    """
+    The vectorized optimal extraction of a stack of reads should give the same results as extracting the reads one by one.
+    """
+    rng = np.random.default_rng(0)
+    profile = np.exp(-0.5*((np.arange(20) - 10)/3.)**2)
+    D = (profile[None, :, None]*rng.uniform(100, 1000, (4, 1, 50)) + rng.normal(0, 5, (4, 20, 50))).astype(np.float32)
+    D[1, 10, 7] += 1e4 #cosmic rays
+    D[3, 12, 30] += 1e4
+    err = np.zeros_like(D) + 25.
+    f_std = D.sum(axis=1)
+
+    #smoothing all rows at once
+    x = D[0]*(rng.uniform(size=D[0].shape) > 0.1)
+    assert np.array_equal(optextr.smooth_rows(x, 9), np.array([optextr.smooth(np.copy(row), 9) for row in x]))
+
+    M_stack = np.ones_like(D)
+    f_opt, var_opt, numoutliers, profile, outlier_array = optextr.optextr_stack(D, err, f_std, M_stack, 9, 15)
+
+    for i in range(len(D)):
+        M = np.ones_like(D[i])
+        f_opt_i, var_opt_i, numoutliers_i = optextr.optextr(D[i], err[i], f_std[i], None, M, 9, 15, False, 0, 0, None)
+        assert np.array_equal(f_opt[i], f_opt_i)
+        assert np.array_equal(var_opt[i], var_opt_i)
+        assert numoutliers[i] == numoutliers_i
+        assert np.array_equal(M_stack[i], M)
+    assert numoutliers[1] > 0 and numoutliers[3] > 0
+
+
+@pytest.mark.run(order=28)
+def test_background(capsys):
+    """
+    Checks the background estimators on a frame with a known background.
+    """
+    class Meta:
+        background_thld = 1000
+
+    meta = Meta()
+    rng = np.random.default_rng(0)
+    frame = rng.normal(20, 3, (256, 256)).astype(np.float32)
+    frame[100:120, 20:230] += rng.uniform(0, 3000, (20, 210)) #spectrum
+
+    meta.background_method = 'median'
+    skymedian, skyvar = background.get_background(frame, meta)
+    # the partition based estimates should be identical to the original implementation
+    meta.background_method = 'partition'
+    assert background.get_background(frame, meta) == (skymedian, skyvar)
+    for n in [1, 2, 1000, 1001]:
+        vec = frame.flatten()[:n]
+        assert background.median_partition(vec) == np.median(vec)
+        assert background.median_abs_dev_partition(vec) == util.median_abs_dev(vec)
+
+    meta.background_method = 'mode'
+    skymode, skyvar_mode = background.get_background(frame, meta)
+    assert abs(skymode - 20) < 0.1
+    assert skyvar_mode == skyvar
+
+
+@pytest.mark.run(order=29)
+def test_binning(capsys):
+    """
+    The sparse rebinning of all exposures at once should give the same light curves as binning every exposure for every bin.
+    """
+    rng = np.random.default_rng(0)
+    nexp, npix = 5, 50
+    w = np.linspace(11000, 17000, npix)[None, :] + rng.normal(0, 5, (nexp, 1))
+    spec_opt = rng.uniform(1e4, 2e4, (nexp, npix))
+    var_opt = spec_opt + 100.
+    wave_edges = np.linspace(11500, 16500, 8)
+    w_hires = np.linspace(max(w[:, 0]), min(w[:, -1]), 1000)
+
+    meanflux, meanvar, f_interp = binning.bin_interp(w_hires, w, spec_opt, var_opt, wave_edges)
+
+    oversample_factor = len(w_hires)/npix
+    for j in range(nexp):
+        assert np.allclose(f_interp[j], np.interp(w_hires, w[j], spec_opt[j]), rtol=1e-12)
+        variance_interp = np.interp(w_hires, w[j], var_opt[j])*oversample_factor
+        for i in range(len(wave_edges) - 1):
+            inds = (w_hires >= wave_edges[i]) & (w_hires <= wave_edges[i+1])
+            weights = 1./variance_interp[inds]
+            assert np.isclose(meanflux[j, i], np.sum(f_interp[j, inds]*weights)/np.sum(weights), rtol=1e-12)
+            assert np.isclose(meanvar[j, i], 1./np.sum(weights), rtol=1e-12)
+
+    # exact pixel overlap: compares with the overlap fractions calculated for every pixel and bin
+    binflux, binvar = binning.bin_overlap(w, spec_opt, var_opt, wave_edges)
+    for j in range(nexp):
+        edges = binning.pixel_edges(w[j])
+        lo = np.maximum(edges[None, :-1], wave_edges[:-1, None])
+        hi = np.minimum(edges[None, 1:], wave_edges[1:, None])
+        frac = np.clip(hi - lo, 0, None)/np.diff(edges)[None, :]
+        assert np.allclose(binflux[j], frac @ spec_opt[j], rtol=1e-12)
+        assert np.allclose(binvar[j], frac**2 @ var_opt[j], rtol=1e-12)
+
+    # the flux is conserved, also for bins narrower than a pixel
+    edges = binning.pixel_edges(w[0])
+    binflux, binvar = binning.bin_overlap(w[:1], spec_opt[:1], var_opt[:1], np.linspace(edges[0] - 10, edges[-1] + 10, 500))
+    assert np.isclose(np.sum(binflux), np.sum(spec_opt[0]), rtol=1e-12)
+
+
+@pytest.mark.run(order=29)
+def test_transit_model_cache(capsys):
+    """
+    The light curves calculated with the cached batman models should be identical to the ones from a new batman.TransitModel.
+    """
+    import batman
+    from pacman.lib.models.transit import transit
+    from pacman.lib.models.eclipse import eclipse
+
+    class Data:
+        exp_time = 103.
+        toffset = 0.
+
+    t = np.linspace(-0.1, 0.1, 200)
+    for rp in [0.1, 0.12]:
+        for t0 in [0., 0.01]:
+            p = batman.TransitParams()
+            p.t0, p.per, p.rp, p.a, p.inc, p.ecc, p.w, p.u, p.limb_dark = t0, 1.58, rp, 15., 89., 0., 90., [0.3, 0.2], 'quadratic'
+            lc = batman.TransitModel(p, t, supersample_factor=3, exp_time=103./24./60./60.).light_curve(p)
+            params = [[t0], [1.58], [rp], [15.], [89.], [0.], [90.], [0.3], [0.2], [2]]
+            assert np.array_equal(transit(t, Data, params, 0), lc)
+
+            p = batman.TransitParams()
+            p.t_secondary, p.per, p.rp, p.fp, p.a, p.inc, p.ecc, p.w, p.u, p.limb_dark = 0.79 + t0, 1.58, rp, 5e-4, 15., 89., 0.1, 80., [0.1, 0.2], 'quadratic'
+            lc = batman.TransitModel(p, t + 0.79, transittype="secondary", supersample_factor=3, exp_time=103./24./60./60.).light_curve(p)
+            params = [[0.79 + t0], [1.58], [rp], [5e-4], [15.], [89.], [0.1], [80.]]
+            assert np.array_equal(eclipse(t + 0.79, Data, params, 0), lc)
+
+    # the least recently used model is removed from the full cache, a model which is used again is kept
+    from pacman.lib.models import batman_cache
+    batman_cache._models.clear()
+    times = [t + i for i in range(batman_cache._max_models + 1)]
+    first = batman_cache.get_transit_model(p, times[0], 103./24./60./60.)
+    for ti in times[1:-1]: batman_cache.get_transit_model(p, ti, 103./24./60./60.)
+    assert batman_cache.get_transit_model(p, times[0], 103./24./60./60.) is first
+    batman_cache.get_transit_model(p, times[-1], 103./24./60./60.)
+    cached = [key[0] for key in batman_cache._models]
+    assert len(cached) == batman_cache._max_models
+    assert times[0].tobytes() in cached and times[1].tobytes() not in cached
+
+
+@pytest.mark.run(order=29)
+def test_visit_slice(capsys):
+    """
+    Contiguous visits are selected with slices, other visits with their indices.
+    """
+    from pacman.lib.read_data import visit_slice
+    vis_num = np.array([0, 0, 0, 1, 1, 2, 0])
+    for i in range(4):
+        idx = vis_num == i
+        assert np.array_equal(vis_num[visit_slice(idx)], vis_num[idx])
+    assert visit_slice(vis_num == 1) == slice(3, 5)
+    assert np.array_equal(visit_slice(vis_num == 0), [0, 1, 2, 6])
+
+
+class ToyData:
+    """
+    Light curve with two visits, which is fitted with the constant, polynomial1 and transit models.
+    """
+    nvisit = 2
+    time = np.linspace(-0.1, 0.1, 100)
+    vis_slice = [slice(0, 50), slice(50, 100)]
+    vis_time = [time[:50], time[50:]]
+    vis_t_vis = [time[:50] - time[0], time[50:] - time[50]]
+    flux = 1e4*(1 + 1e-3*np.random.default_rng(0).normal(size=100))
+    err = np.sqrt(flux)
+    exp_time = 103.
+    toffset = 0.
+    wavelength = 1.4
+    dof = 90.
+    nfree_param = 5
+    npoints = 100
+    parnames = ['t0', 'per', 'rp', 'a', 'inc', 'ecc', 'w', 'u1', 'u2', 'limb_dark', 'c', 'v']
+    par_order = {name: i for i, name in enumerate(parnames)}
+    prior = [['U', 0.05, 0.2], ['X', 0., 0.], ['N', 4., 0.01], ['U', -1., 1.], ['U', -1., 1.]]
+    myfuncs = ['constant', 'polynomial1', 'transit']
+    # rp is free and tied over the visits. c and v have one row per visit
+    fit_par = Table({'parameter': parnames[:10] + ['c', 'c', 'v', 'v'],
+                     'fixed': ['true']*2 + ['false'] + ['true']*7 + ['false']*4, 'tied': [-1]*10 + [0, 0, 1, 1],
+                     'value': [0., 1.58, 0.1, 15., 89., 0., 90., 0.3, 0.2, 2., 4., 4., 0., 0.],
+                     'lo_lim': ['False']*14, 'lo_val': [0.]*14, 'hi_lim': ['False']*2 + ['True'] + ['False']*11,
+                     'hi_val': [0.]*2 + [0.2] + [0.]*11, 'step_size': [0.]*2 + [0.001] + [0.]*7 + [0.1]*4})
+    param_map = ParameterMap(fit_par, nvisit)
+    params = param_map.value
+    # free parameters: rp of the first visit and c and v of both visits
+    free_idx = np.array([4, 20, 21, 22, 23])
+
+
+@pytest.mark.run(order=29)
+def test_parameter_map(capsys):
+    """
+    The parameter map should pack and unpack the free parameters, broadcast the tied parameters over the visits and set up mpfit.
+    """
+    param_map = ToyData.param_map
+    params = ToyData.params
+    assert np.array_equal(param_map.free_idx, ToyData.free_idx)
+    assert param_map.labels == ['rp', 'c0', 'c1', 'v0', 'v1']
+    assert np.array_equal(param_map.step[param_map.free_idx], [0.001, 0.1, 0.1, 0.1, 0.1])
+    assert np.array_equal(params, np.repeat([0., 1.58, 0.1, 15., 89., 0., 90., 0.3, 0.2, 2.], 2).tolist() + [4., 4., 0., 0.])
+
+    theta = np.array([0.12, 5., 6., 1., 2.])
+    updated_params = param_map.unpack(theta, params)
+    assert np.array_equal(updated_params[[4, 5, 20, 21, 22, 23]], [0.12, 0.12, 5., 6., 1., 2.])
+    assert np.array_equal(np.delete(updated_params, [4, 5, 20, 21, 22, 23]), np.delete(params, [4, 5, 20, 21, 22, 23]))
+    assert np.array_equal(param_map.pack(updated_params), theta)
+    batch = param_map.unpack(np.stack([theta, 2*theta]), params)
+    assert batch.shape == (2, 24) and np.array_equal(batch[1], param_map.unpack(2*theta, params))
+
+    parinfo = param_map.parinfo(params)
+    assert [par.get('tied') for par in parinfo[4:6]] == [None, 'p[4]'] and 'tied' not in parinfo[21]
+    assert parinfo[5]['limited'] == [False, True] and parinfo[5]['limits'] == [0., 0.2]
+    assert [bool(par['fixed']) for par in parinfo[18:]] == [True, True, False, False, False, False]
+
+
+@pytest.mark.run(order=29)
+def test_lnprob_vectorized(capsys):
+    """
+    The log-probability of a batch of walkers should agree with the log-probability of the walkers one by one.
+    """
+    from pacman.lib.model import Model
+    from pacman.lib import mcmc
+
+    model = Model(ToyData, ToyData.myfuncs)
+    params, free_idx = ToyData.params, ToyData.free_idx
+    thetas = params[free_idx] + np.random.default_rng(1).normal(size=(20, 5))*[0.02, 0.01, 0.01, 0.1, 0.1]
+    thetas[0, 0] = 0.3
+
+    lnprob = mcmc.lnprob_vectorized(thetas, params, ToyData, model)
+    for k in range(len(thetas)):
+        p = np.copy(params)
+        p[free_idx] = thetas[k]
+        p[5] = thetas[k, 0]
+        expected = model.fit(ToyData, p).ln_like + mcmc.lnprior(thetas[k], ToyData)
+        if np.isfinite(expected):
+            assert np.isclose(lnprob[k], expected, rtol=1e-13)
+        else:
+            assert lnprob[k] == expected
+
+
+@pytest.mark.run(order=29)
+def test_model_jacobian(capsys):
+    """
+    The partial derivatives of the model should agree with finite differences of the whole model.
+    """
+    from pacman.lib.model import Model
+
+    class Data(ToyData):
+        vis_t_orb = ToyData.vis_t_vis
+        vis_t_delay = [np.zeros(50), np.ones(50)]
+        vis_scan_direction = [np.tile([0., 1.], 25)]*2
+        parnames = ToyData.parnames + ['scale', 'r1', 'r2', 'r3']
+        par_order = {name: i for i, name in enumerate(parnames)}
+
+    model = Model(Data, ['constant', 'polynomial1', 'upstream_downstream', 'model_ramp', 'transit'])
+    params = np.concatenate([ToyData.params, np.repeat([1e-3, 20., 3., 0.5], 2)])
+    free = np.zeros(len(params), dtype=bool)
+    free[[0, 4, 5, 14, 20, 21, 22, 23, 24, 26, 28, 30, 31]] = True
+    step = 1e-7*np.maximum(np.abs(params), 1.)
+
+    jac = model.jacobian(Data, params, free, step)
+    lc = np.copy(model.fit(Data, params).model)
+    for j in range(len(params)):
+        if not free[j]:
+            assert np.all(jac[:, j] == 0)
+            continue
+        p = np.copy(params)
+        p[j] += step[j]
+        deriv = (model.fit(Data, p).model - lc)/step[j]
+        assert np.allclose(jac[:, j], deriv, rtol=1e-5, atol=1e-6*np.max(np.abs(deriv)))
+
+
+@pytest.mark.run(order=29)
+def test_sampler_pool(capsys):
+    """
+    The log-probability calculated by the workers of the sampler pool should be the same as in the main process.
+    """
+    from pacman.lib.model import Model
+    from pacman.lib import mcmc
+    from pacman.lib.pool import make_pool, close_pool
+
+    class Meta:
+        nvisit = 2
+        run_ncpu = 1
+        run_mpi = False
+
+    model = Model(ToyData, ToyData.myfuncs)
+    params, free_idx = ToyData.params, ToyData.free_idx
+    assert make_pool(Meta, mcmc.init_worker, (params, ToyData, model)) is None
+
+    Meta.run_ncpu = 2
+    pool = make_pool(Meta, mcmc.init_worker, (params, ToyData, model))
+    thetas = [params[free_idx] + [0.001*k, 0., 0.01, 0., 0.1] for k in range(6)]
+    try:
+        lnprob = list(pool.map(mcmc.lnprob_worker, thetas))
+    finally:
+        close_pool(pool)
+    assert lnprob == [mcmc.lnprob(theta, params, ToyData, model) for theta in thetas]
+
+
+@pytest.mark.run(order=29)
+def test_read_mcmc_chain(capsys, tmp_path):
+    """
+    Reads parts of a chain which was saved by the HDF5 backend of emcee, also if the run was interrupted.
+    """
+    import emcee
+
+    chain_file = str(tmp_path / 'mcmc_chain_bin0_wvl1.000.h5')
+    backend = emcee.backends.HDFBackend(chain_file, name='mcmc')
+    backend.reset(8, 2)
+    sampler = emcee.EnsembleSampler(8, 2, lambda x: -0.5*np.sum(x**2), backend=backend)
+    sampler.run_mcmc(np.random.default_rng(0).normal(size=(8, 2)), 30)
+    chain = backend.get_chain()
+
+    assert np.array_equal(util.read_mcmc_chain(chain_file), chain)
+    assert np.array_equal(util.read_mcmc_chain(chain_file, 10, 3), chain[10::3])
+    assert np.array_equal(util.read_mcmc_chain(chain_file, 10, idx=1), chain[10:, :, 1])
+
+    # the steps of an interrupted run which were not done yet are not read
+    backend.grow(20, None)
+    assert np.array_equal(util.read_mcmc_chain(chain_file), chain)
+
+
+@pytest.mark.run(order=29)
+def test_mcmc_autocorr(capsys):
+    """
+    The sampler should stop once the chains are much longer than the autocorrelation time.
+    """
+    import emcee
+    from pacman.lib.mcmc import run_until_converged
+
+    class Meta:
+        run_autocorr_factor = 20
+        run_autocorr_rtol = 0.2
+
+    np.random.seed(0)
+    sampler = emcee.EnsembleSampler(16, 2, lambda x: -0.5*np.sum(x**2))
+    assert run_until_converged(sampler, np.random.normal(size=(16, 2)), 20000, Meta)
+    assert sampler.iteration < 20000 and sampler.iteration % 100 == 0
+    assert np.all(20*sampler.get_autocorr_time(tol=0) < sampler.iteration)
+
+    # stops after nsteps if the chains did not converge
+    sampler = emcee.EnsembleSampler(16, 2, lambda x: -0.5*np.sum(x**2))
+    assert not run_until_converged(sampler, np.random.normal(size=(16, 2)), 150, Meta)
+    assert sampler.iteration == 150
+
+
+@pytest.mark.run(order=29)
+def test_data_clip(capsys):
+    """
+    Clipping outliers in several iterations should mask the same exposures as clipping them all at once.
+    """
+    from pacman.lib.read_data import Data
+
+    n = 40
+    vis_num = np.repeat([0, 1], n//2)
+    full = dict(time=np.linspace(0, 1, n), flux=np.arange(n) + 100., err=np.ones(n), vis_num=vis_num, orb_num=vis_num,
+                scan_direction=np.zeros(n), t_vis=np.zeros(n), t_orb=np.zeros(n), t_delay=np.zeros(n))
+    data = Data.__new__(Data)
+    data.nvisit, data.nfree_param = 2, 3
+    data._full = full
+    data.valid = np.ones(n, dtype=bool)
+    data.apply_mask()
+
+    # the indices refer to the light curve after the previous clipping
+    data.clip([3, 10, 20])
+    data.clip([3, 4, 25])
+    expected = np.delete(np.delete(np.arange(n), [3, 10, 20]), [3, 4, 25])
+    assert np.array_equal(np.flatnonzero(data.valid), expected)
+    assert np.array_equal(data.flux, full['flux'][expected])
+    assert data.npoints == n - 6 and data.dof == n - 9
+    assert data.vis_slice == [slice(0, 16), slice(16, 34)]
+    assert np.array_equal(data.vis_time[1], full['time'][expected][16:])
+
+    # the model keeps its functions and only reallocates the arrays for the clipped light curve
+    from pacman.lib.model import Model
+    data.par_order, data.toffset = ToyData.par_order, 0.
+    model = Model(data, ['constant', 'polynomial1'])
+    myfuncs = model.myfuncs
+    data.clip([0, 30])
+    model.resize(data).fit(data, ToyData.params)
+    assert model.myfuncs is myfuncs and len(model.resid) == data.npoints == n - 8
+    expected = Model(data, ['constant', 'polynomial1']).fit(data, ToyData.params)
+    assert np.array_equal(model.model, expected.model) and model.ln_like == expected.ln_like
+
+
+@pytest.mark.run(order=29)
+def test_ackbar(capsys):
+    """
+    The orbit-wise ramp model should agree with the loop over the exposures, also when the trap populations are clipped.
+    """
+    from types import SimpleNamespace
+    from pacman.lib.models.ackbar import ackbar, ackbar_reference
+
+    exptime = 103.
+    # 3 orbits with 15 exposures each and a buffer download in the second orbit
+    t = [i*96*60 + np.arange(15)*(exptime + 20) for i in range(3)]
+    t[1][8:] += 500
+    t = np.concatenate(t)/86400.
+    data = SimpleNamespace(exp_time=exptime)
+
+    for values in [(100., 20., 50., 30.), (-500., -100., 2000., 300.), (3000., 50., -800., -200.)]:
+        params = [np.array([v]) for v in values]
+        np.testing.assert_allclose(ackbar(t, data, params), ackbar_reference(t, data, params), rtol=1e-14)
+
+
+@pytest.mark.run(order=29)
+def test_prior_transform(capsys):
+    """
+    The prior transform for dynesty should transform every parameter like the scalar transforms, also for a batch of points.
+    """
+    from pacman.lib import nested
+
+    u = np.random.default_rng(2).uniform(size=(10, 5))
+    prior_transform = nested.PriorTransform(ToyData.prior)
+    p = prior_transform(u)
+    for k in range(len(u)):
+        expected = [nested.transform_uniform(u[k, 0], 0.05, 0.2), 0., nested.transform_normal(u[k, 2], 4., 0.01),
+                    nested.transform_uniform(u[k, 3], -1., 1.), nested.transform_uniform(u[k, 4], -1., 1.)]
+        assert np.array_equal(prior_transform(u[k]), p[k])
+        np.testing.assert_allclose(p[k], expected, rtol=1e-15)
+
+
+@pytest.mark.run(order=29)
+def test_nested_checkpoint(capsys, tmp_path):
+    """
+    Nested sampling should save a checkpoint and the statistics of the run, and continue from the checkpoint of an earlier run.
+    """
+    from pacman.lib.model import Model
+    from pacman.lib import nested
+
+    class Meta:
+        workdir, fitdir = str(tmp_path), '/fit_a'
+        s30_file_counter, fittime = 0, 'test'
+        labels = ToyData.param_map.labels
+        run_nlive, run_dlogz = 30, 1.
+        run_nested_dynamic, run_nested_checkpoint, run_resume = False, 1, None
+        run_ncpu, run_mpi = 1, False
+
+    model = Model(ToyData, ToyData.myfuncs)
+    nested.nested_sample(ToyData, model, ToyData.params, '', Meta, None)
+    assert os.path.isfile(str(tmp_path) + '/fit_a/nested_res/nested_checkpoint_bin0_wvl1.400.save')
+
+    Meta.fitdir, Meta.run_resume = '/fit_b', str(tmp_path) + '/fit_a'
+    nested.nested_sample(ToyData, model, ToyData.params, '', Meta, None)
+    stats = [open(str(tmp_path) + '/{0}/nested_res/nested_stats_bin0_wvl1.400.txt'.format(d)).readline() for d in ['fit_a', 'fit_b']]
+    assert 'resumed: False' in stats[0] and 'resumed: True' in stats[1]
+    # the resumed run had already finished, so it has the same iterations
+    assert stats[0].split(',')[:2] == stats[1].split(',')[:2]
+
+
+@pytest.mark.run(order=29)
+def test_joint_fit(capsys):
+    """
+    The joint fit should share t0 between the light curves and find the same parameters and uncertainties as a fit of the full problem.
+    """
+    from pacman.lib.model import Model
+    from pacman.lib.joint_fit import JointFit
+    from scipy.optimize import least_squares
+
+    fit_par = ToyData.fit_par.copy()
+    fit_par['fixed'][0] = 'false'
+    # small steps, so the derivatives of the transit model can be compared with finite differences of the residuals
+    fit_par['step_size'][[0, 2]] = 1e-7
+
+    def channel(rp, seed):
+        class Data(ToyData):
+            param_map = ParameterMap(fit_par, ToyData.nvisit)
+        truth = np.copy(Data.param_map.value)
+        truth[[0, 1, 4, 5]] = [2e-3, 2e-3, rp, rp]
+        model = Model(Data, ToyData.myfuncs)
+        Data.flux = model.fit(Data, truth).model*(1 + 1e-4*np.random.default_rng(seed).normal(size=100))
+        Data.err = 1e-4*Data.flux
+        return Data, model
+
+    channels = [channel(0.1, 1), channel(0.12, 2), channel(0.11, 3)]
+    fit = JointFit([c[0] for c in channels], [c[1] for c in channels], ['t0'])
+    assert fit.nshared == 1 and fit.nfree == 1 + 3*5
+    assert fit.labels[:7] == ['t0', 'rp_0', 'c0_0', 'c1_0', 'v0_0', 'v1_0', 'rp_1']
+
+    # every light curve only depends on t0 and its own five parameters
+    params = [data.param_map.value for data, model in channels]
+    theta = fit.pack(params) + 1e-3
+    jac = np.zeros((300, fit.nfree))
+    for c, (resid, block) in enumerate(fit.blocks(theta, params)):
+        assert block.shape == (100, 6) and fit.idx[c][0] == 0
+        jac[100*c:100*(c + 1), fit.idx[c]] = block
+    for j in range(fit.nfree):
+        theta_step = np.copy(theta)
+        theta_step[j] += 1e-7
+        deriv = (fit.residuals(theta_step, params) - fit.residuals(theta, params))/1e-7
+        assert np.allclose(jac[:, j], deriv, rtol=1e-3, atol=1e-4*np.max(np.abs(deriv)))
+
+    best, perrors = fit.fit(params)
+    assert fit.converged
+    for p, perror, rp in zip(best, perrors, [0.1, 0.12, 0.11]):
+        assert p[0] == best[0][0] and p[1] == p[0]
+        assert np.isclose(p[4], rp, atol=1e-3) and perror[0] > 0 and perror[1] == 0
+    assert np.isclose(best[0][0], 2e-3, atol=3e-4)
+    # the same minimum and uncertainties as a fit of the full problem
+    full = least_squares(fit.residuals, fit.pack(params), args=(params,), xtol=1e-12, ftol=1e-12)
+    assert np.allclose(fit.pack(best), full.x, rtol=1e-5, atol=1e-7)
+    cov = np.linalg.inv(full.jac.T @ full.jac)
+    assert np.allclose(fit.pack(perrors), np.sqrt(np.diag(cov)), rtol=1e-3)
+
+
+@pytest.mark.run(order=29)
+def test_gp_exp(capsys):
+    """
+    The log-likelihood with the Gaussian process should be the one of a multivariate normal distribution with the full covariance matrix.
+    """
+    from pacman.lib.model import Model
+
+    class Data(ToyData):
+        parnames = ToyData.parnames + ['gp_amp', 'gp_tau']
+        par_order = {name: i for i, name in enumerate(parnames)}
+
+    model = Model(Data, ToyData.myfuncs + ['gp_exp'])
+    params = np.concatenate([ToyData.params, [3e-4, 5e-4, 0.01, 0.02]])
+    fit = model.fit(Data, params)
+
+    ln_like = 0.
+    for visit, s in enumerate(Data.vis_slice):
+        t, resid, norm = Data.time[s], fit.resid[s], np.mean(Data.flux[s])
+        amp, tau = params[24 + visit], params[26 + visit]
+        cov = np.diag(Data.err[s]**2) + (norm*amp)**2*np.exp(-np.abs(t[:, None] - t[None, :])/tau)
+        ln_like += -0.5*(resid @ np.linalg.solve(cov, resid) + np.linalg.slogdet(2*np.pi*cov)[1])
+        # the prediction of the Gaussian process is the conditional mean of the correlated part of the residuals
+        gp_cov = cov - np.diag(Data.err[s]**2)
+        assert np.allclose(fit.model_gp[s], gp_cov @ np.linalg.solve(cov, resid))
+    assert np.isclose(fit.ln_like, ln_like, rtol=1e-12)
+    # the residuals used by mpfit have the same sum of squares up to a constant
+    assert np.isclose(np.sum(fit.gp_resid**2), -2*ln_like - np.sum(np.log(2*np.pi*Data.err**2)), rtol=1e-10)
+
+    batch = np.stack([params]*3)
+    batch[1:, [4, 5, 20, 24, 27]] *= [[1.01], [0.99]]
+    expected = [Model(Data, ToyData.myfuncs + ['gp_exp']).fit(Data, p).ln_like for p in batch]
+    assert np.allclose(model.ln_like_batch(Data, batch), expected, rtol=1e-12)
+
+
 @pytest.mark.run(order=29)
 def test_s21(capsys):
     """
@@ -428,6 +982,54 @@ def test_s21(capsys):
     extracted_sp_lc_0 = ascii.read(extracted_sp_lc_file_0)
     assert len(extracted_sp_lc_0.colnames) == 10
 
+    #Every light curve should also be saved as a binary file
+    extracted_sp_lc_0_h5 = cube.read_cube_table(extracted_sp_lc_file_0.replace('.txt', '.h5'))
+    assert extracted_sp_lc_0_h5.colnames == extracted_sp_lc_0.colnames
+    assert np.array_equal(extracted_sp_lc_0_h5['spec_opt'], extracted_sp_lc_0['spec_opt'])
+
+
+@pytest.mark.run(order=29)
+def test_s21_truncated_trace(capsys, tmp_path):
+    """
+    s20 pads the spectrum of an exposure with a truncated trace with zeros. s21 should only bin the pixels extracted in every exposure.
+    """
+    from types import SimpleNamespace
+    rng = np.random.default_rng(0)
+    nexp, npix = 5, 50
+    npix_exp = np.full(nexp, npix)
+    npix_exp[2] = 40
+    w = np.linspace(11000, 17000, npix)[None, :] + rng.normal(0, 5, (nexp, 1))
+    spec_opt = rng.uniform(1e4, 2e4, (nexp, npix))
+    var_opt = spec_opt + 100.
+    w[2, 40:], spec_opt[2, 40:], var_opt[2, 40:] = 0., 0., 0.
+
+    w_cut, spec_cut, var_cut = binning.common_width(npix_exp, w, spec_opt, var_opt)
+    assert w_cut.shape == spec_cut.shape == var_cut.shape == (nexp, 40)
+    assert np.all(w_cut > 0) and np.all(spec_cut > 0)
+    with pytest.raises(ValueError):
+        binning.common_width(np.array([50, 1, 50]), w[:3], spec_opt[:3], var_opt[:3])
+
+    def run_s21(name, method, npix_exp, w, spec_opt, var_opt):
+        spec_dir = tmp_path / name / 'extracted_lc' / 'run'
+        spec_dir.mkdir(parents=True)
+        t = np.linspace(58000, 58001, nexp)
+        cube.write_cube(str(spec_dir / 'lc_spec.h5'), dict(t_mjd=t, t_bjd=t, t_visit=t - t[0], t_orbit=t - t[0],
+                                                           ivisit=np.zeros(nexp, dtype=int), iorbit=np.zeros(nexp, dtype=int),
+                                                           scan=np.zeros(nexp, dtype=int), npix=npix_exp, spec_opt=spec_opt,
+                                                           var_opt=var_opt, template_waves=w))
+        meta = SimpleNamespace(use_wvl_list=False, wvl_bins=4, wvl_min=1.15, wvl_max=1.55, s21_most_recent_s20=False,
+                               s21_spec_dir_path_s20=str(spec_dir), nexp=nexp, BEAMA_i=0, BEAMA_f=npix, s21_binning=method,
+                               save_ecsv=False, workdir=str(tmp_path / name), eventlabel='test')
+        s21.run21('test', meta.workdir, meta=meta)
+        lc_files = sn.sort_nicely(glob.glob(meta.workdir + '/extracted_sp/*/speclc*.h5'))
+        return np.array([cube.read_cube(f)['spec_opt'] for f in lc_files]).T
+
+    # the light curves should be the same as the ones of the spectra without the zero padding
+    for method in ['interp', 'overlap']:
+        binflux = run_s21('truncated_' + method, method, npix_exp, w, spec_opt, var_opt)
+        assert np.array_equal(binflux, run_s21('cut_' + method, method, np.full(nexp, 40), w_cut, spec_cut, var_cut))
+        assert np.all(binflux > 1e4)
+
 
 @pytest.mark.run(order=30)
 def test_s30(capsys):